@@ -0,0 +1,208 @@
+import argparse
+import asyncio
+import json
+import os
+from typing import AsyncIterator, Iterable, Set
+from fastapi import HTTPException
+from config import Config
+from protocol import ChatCompletionRequest, ChatCompletionResponse, CompletionRequest, CompletionResponse, Usage, stop_reason
+from sampling import SamplingOptions
+from scheduler import GenerationResult
+
+async def read_records(lines: AsyncIterator[str], done_ids: Set[str] = frozenset()) -> AsyncIterator[dict]:
+    """
+    Parses JSONL request records. A record without an "id" gets its position among the non-empty lines as one, so IDs
+    stay stable when the same file is run again, and records whose ID is in done_ids are skipped.
+    A line that isn't a JSON object is yielded as {"id", "error"}, so one bad line fails only its own request.
+    """
+    index = 0
+    async for line in lines:
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            error = None if isinstance(record, dict) else f"Expected a JSON object, got {type(record).__name__}"
+        except json.JSONDecodeError as e:
+            record, error = None, f"Invalid JSON: {e}"
+        record_id = str(record.pop("id", index)) if error is None else str(index)
+        index += 1
+        if record_id in done_ids:
+            continue
+        yield {"id": record_id, "request": record} if error is None else {"id": record_id, "error": error}
+
+async def run_batch(input_processor, records: AsyncIterator[dict]) -> AsyncIterator[dict]:
+    """
+    Runs Llama Stack CompletionRequest/ChatCompletionRequest records through the model and yields one result per record,
+    in the order they finish: {"id", "response"} or {"id", "error"}.
+
+    Records are read in windows of BATCH_SORT_WINDOW, tokenized, and handed to the scheduler shortest prompt first, so
+    prompts admitted together have similar lengths and are prefilled in one padded forward pass with little padding.
+    Only a couple of batches' worth of requests are in flight at a time, which keeps the queue from overflowing.
+    """
+    scheduler = input_processor.scheduler
+    in_flight = asyncio.Semaphore(scheduler.max_batch_size * 2)
+
+    async def windows() -> AsyncIterator[list]:
+        window = []
+        async for record in records:
+            window.append(record)
+            if len(window) >= Config.BATCH_SORT_WINDOW:
+                yield window
+                window = []
+        if window:
+            yield window
+
+    async for window in windows():
+        results = _run_window(input_processor, window, in_flight)
+        try:
+            async for result in results:
+                yield result
+        finally:
+            await results.aclose()  # cancels the window's requests if we were closed early
+
+async def _run_window(input_processor, window, in_flight: asyncio.Semaphore) -> AsyncIterator[dict]:
+    async def prepare(record: dict) -> dict:
+        if "error" in record:
+            return record
+        try:
+            request_data = record["request"]
+            is_chat = "messages" in request_data
+            request = ChatCompletionRequest(**request_data) if is_chat else CompletionRequest(**request_data)
+            record.update(
+                is_chat=is_chat,
+                max_tokens=min(request.sampling_params.max_tokens or float('inf'), Config.DEFAULT_MAX_TOKENS),
+                sampling=SamplingOptions.from_sampling_params(request.sampling_params),
+                stop=request.stop,
+                stop_token_ids=request.stop_token_ids,
+                model_inputs=await (input_processor.prepare_chat_input(request.messages) if is_chat else input_processor.prepare_input(request.content))
+            )
+        except HTTPException as e:
+            record["error"] = e.detail
+        except Exception as e:
+            record["error"] = f"{type(e).__name__}: {e}"
+        return record
+
+    async def generate(record: dict) -> dict:
+        if "error" in record:
+            return {"id": record["id"], "error": record["error"]}
+        result = GenerationResult()
+        async with in_flight:
+            while True:
+                try:
+                    sequence = input_processor.scheduler.add_request(
+                        record["model_inputs"],
+                        record["max_tokens"],
+                        record["sampling"],
+                        record["stop"],
+                        record["stop_token_ids"],
+                        result=result
+                    )
+                    break
+                except HTTPException as e:
+                    if e.status_code != 503:
+                        return {"id": record["id"], "error": e.detail}
+                    await asyncio.sleep(float(e.headers.get("Retry-After", 1)))  # the queue is full of other traffic
+            record["model_inputs"] = None
+            try:
+                output_text = "".join([token async for token in sequence.stream()])
+            except HTTPException as e:
+                return {"id": record["id"], "error": e.detail}
+            except Exception as e:
+                return {"id": record["id"], "error": f"{type(e).__name__}: {e}"}
+
+        completion_message = {"content": output_text, "stop_reason": stop_reason(result)}
+        if record["is_chat"]:
+            response = ChatCompletionResponse(completion_message={"role": "assistant", **completion_message}, usage=Usage(**result.usage()))
+        else:
+            response = CompletionResponse(completion_message=completion_message, usage=Usage(**result.usage()))
+        return {"id": record["id"], "response": json.loads(response.model_dump_json())}
+
+    prepared = await asyncio.gather(*(prepare(record) for record in window))
+    prepared.sort(key=lambda record: record["model_inputs"]["input_ids"].shape[1] if record.get("model_inputs") and "input_ids" in record["model_inputs"] else 0)
+    # tasks are created shortest prompt first, and the semaphore lets them in in that order
+    tasks = [asyncio.create_task(generate(record)) for record in prepared]
+    try:
+        for finished in asyncio.as_completed(tasks):
+            yield await finished
+    finally:
+        # the consumer went away (e.g. the client disconnected), so stop generating for it
+        for task in tasks:
+            task.cancel()
+
+def completed_ids(output_path: str) -> Set[str]:
+    """
+    Returns the IDs already answered successfully in a results file, so an interrupted job can pick up where it left off.
+    Failed requests (e.g. an image fetch that timed out) aren't counted, so they are retried and their new result is
+    appended after the error. A partially written last line (from a crash mid-write) is ignored.
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path) as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+                if "response" in result:
+                    done.add(str(result["id"]))
+            except (json.JSONDecodeError, KeyError, TypeError):
+                continue
+    return done
+
+def _ends_mid_line(path: str) -> bool:
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() == 0:
+            return False
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) != b"\n"
+
+async def _file_lines(lines: Iterable[str]) -> AsyncIterator[str]:
+    for line in lines:
+        yield line
+
+async def main(args):
+    done_ids = completed_ids(args.output)
+    if done_ids:
+        print(f"Resuming: skipping {len(done_ids)} requests already in {args.output}")
+
+    with open(args.input) as input_file, open(args.output, "a") as output_file:
+        if _ends_mid_line(args.output):
+            output_file.write("\n")  # so a partial line left by a crash doesn't swallow the next result
+        records = read_records(_file_lines(input_file), done_ids)
+
+        if args.url:
+            import httpx
+
+            async def upload():
+                async for record in records:
+                    if "error" in record:  # never sent, the server couldn't parse it either
+                        output_file.write(json.dumps(record) + "\n")
+                        output_file.flush()
+                        continue
+                    yield (json.dumps({"id": record["id"], **record["request"]}) + "\n").encode("utf-8")
+
+            async with httpx.AsyncClient(timeout=None) as client:
+                async with client.stream("POST", f"{args.url}/inference/batch_completion", content=upload()) as response:
+                    response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        if line:
+                            output_file.write(line + "\n")
+                            output_file.flush()
+        else:
+            from processor import create_input_processor
+            input_processor = create_input_processor()
+            input_processor.scheduler.start()
+            try:
+                async for result in run_batch(input_processor, records):
+                    output_file.write(json.dumps(result) + "\n")
+                    output_file.flush()
+            finally:
+                input_processor.scheduler.stop()
+                await input_processor.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a JSONL file of completion or chat completion requests offline and write the results as JSONL.")
+    parser.add_argument("input", help="JSONL file of CompletionRequest/ChatCompletionRequest objects, each with an optional \"id\"")
+    parser.add_argument("output", help="JSONL results file, appended to; requests already answered in it are skipped, failed ones are retried")
+    parser.add_argument("--url", help="send the job to a running server's /inference/batch_completion instead of loading the model here")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,254 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+from typing import Awaitable, Callable, List, Optional
+from config import Config
+
+WORDS = ["the", "model", "server", "request", "token", "batch", "latency", "memory", "cache", "stream", "prompt", "answer"]
+
+class RequestResult:
+    """
+    Timings for a single benchmarked request. All times are in seconds.
+    """
+    def __init__(self):
+        self.start = 0.0
+        self.first_chunk = None
+        self.chunk_times: List[float] = []
+        self.end = 0.0
+        self.text = ""
+        self.output_tokens = 0
+        self.error: Optional[str] = None
+
+    def add_chunk(self, delta: str):
+        now = time.perf_counter()
+        if self.first_chunk is None:
+            self.first_chunk = now
+        self.chunk_times.append(now)
+        self.text += delta
+
+    @property
+    def ttft(self) -> Optional[float]:
+        return self.first_chunk - self.start if self.first_chunk is not None else None
+
+    @property
+    def inter_token_latencies(self) -> List[float]:
+        """
+        Gaps between consecutive chunks when every chunk carried one token. Otherwise the chunks can't be mapped to
+        tokens, so the request's gaps are spread evenly over its tokens.
+        """
+        gaps = [later - earlier for earlier, later in zip(self.chunk_times, self.chunk_times[1:])]
+        tokens_after_first = max(self.output_tokens - 1, len(gaps))
+        if not gaps or tokens_after_first == 0:
+            return []
+        if len(gaps) == tokens_after_first:
+            return gaps
+        per_token = sum(gaps) / tokens_after_first
+        return [per_token] * tokens_after_first
+
+    @property
+    def latency(self) -> float:
+        return self.end - self.start
+
+def load_workload(path: str) -> List[dict]:
+    """
+    Reads a JSONL file with one Llama Stack CompletionRequest or ChatCompletionRequest per line.
+    """
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def synthetic_workload(num_requests: int, prompt_tokens: int, output_tokens: int, distribution: str, seed: int) -> List[dict]:
+    """
+    Builds completion requests whose prompt and output lengths are drawn around the given means.
+    fixed uses the means exactly, uniform draws from [1, 2 * mean], and exponential draws with the given mean.
+    Prompt length is approximate, since it counts words rather than tokens.
+    """
+    rng = random.Random(seed)
+
+    def draw(mean: int) -> int:
+        if distribution == "uniform":
+            return rng.randint(1, 2 * mean)
+        if distribution == "exponential":
+            return max(1, round(rng.expovariate(1 / mean)))
+        return mean
+
+    return [
+        {
+            "model": Config.MODEL_NAME,
+            "content": " ".join(rng.choice(WORDS) for _ in range(draw(prompt_tokens))),
+            "sampling_params": {"max_tokens": draw(output_tokens)},
+            "stream": True
+        }
+        for _ in range(num_requests)
+    ]
+
+async def send_to_server(client, base_url: str, payload: dict, result: RequestResult):
+    """
+    Streams one request from the server, recording when each chunk arrives.
+    """
+    is_chat = "messages" in payload
+    url = f"{base_url}/inference/{'chat_completion' if is_chat else 'completion'}"
+    async with client.stream("POST", url, json={**payload, "stream": True}) as response:
+        if response.status_code != 200:
+            result.error = f"HTTP {response.status_code}: {(await response.aread()).decode(errors='replace')}"
+            return
+        async for line in response.aiter_lines():
+            if not line:
+                continue
+            chunk = json.loads(line)
+            delta = chunk["event"]["delta"] if is_chat else chunk.get("delta", "")
+            if delta:
+                result.add_chunk(delta)
+            if chunk.get("usage"):  # the last chunk
+                result.output_tokens = chunk["usage"]["completion_tokens"]
+
+def in_process_sender(input_processor) -> Callable[[dict, RequestResult], Awaitable[None]]:
+    """
+    Returns a sender that drives InputProcessor directly, so model and scheduler time can be measured without HTTP
+    and serialization overhead.
+    """
+    from protocol import ChatCompletionRequest, CompletionRequest
+    from sampling import SamplingOptions
+    from scheduler import GenerationResult
+
+    async def send(payload: dict, result: RequestResult):
+        is_chat = "messages" in payload
+        request = ChatCompletionRequest(**payload) if is_chat else CompletionRequest(**payload)
+        max_tokens = min(request.sampling_params.max_tokens or float('inf'), Config.DEFAULT_MAX_TOKENS)
+        sampling = SamplingOptions.from_sampling_params(request.sampling_params)
+        generation = GenerationResult()
+        if is_chat:
+            tokens = input_processor.generate_chat_tokens(request.messages, max_tokens, sampling, request.stop, request.stop_token_ids, result=generation)
+        else:
+            tokens = input_processor.generate_tokens(request.content, max_tokens, sampling, request.stop, request.stop_token_ids, result=generation)
+        async for delta in tokens:
+            result.add_chunk(delta)
+        result.output_tokens = generation.completion_tokens
+    return send
+
+async def run_workload(workload: List[dict], send: Callable[[dict, RequestResult], Awaitable[None]], concurrency: int, rate: Optional[float], seed: int):
+    """
+    Fires the workload with at most `concurrency` requests in flight. With a rate, arrivals follow a Poisson process
+    at that many requests per second, and latencies are measured from each request's arrival, so time spent waiting for
+    a free slot counts against the server instead of being hidden. Otherwise every request is queued at once, and
+    latencies are measured from when it is sent.
+    Returns each request's result and the wall clock duration of the whole run.
+    """
+    rng = random.Random(seed)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(payload: dict) -> RequestResult:
+        result = RequestResult()
+        result.start = time.perf_counter()
+        async with semaphore:
+            if not rate:
+                result.start = time.perf_counter()
+            try:
+                await send(payload, result)
+            except Exception as e:
+                result.error = f"{type(e).__name__}: {e}"
+            result.end = time.perf_counter()
+        return result
+
+    tasks = []
+    start = time.perf_counter()
+    for payload in workload:
+        tasks.append(asyncio.create_task(run_one(payload)))
+        if rate:
+            await asyncio.sleep(rng.expovariate(rate))
+    results = await asyncio.gather(*tasks)
+    return results, time.perf_counter() - start
+
+def percentiles(values: List[float]) -> dict:
+    """
+    Returns p50, p95 and p99 of the values (linearly interpolated), in milliseconds.
+    """
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    values = sorted(values)
+
+    def percentile(p: float) -> float:
+        position = (len(values) - 1) * p / 100
+        lower = int(position)
+        upper = min(lower + 1, len(values) - 1)
+        return (values[lower] + (values[upper] - values[lower]) * (position - lower)) * 1000
+
+    return {"p50": percentile(50), "p95": percentile(95), "p99": percentile(99)}
+
+def summarize(results: List[RequestResult], duration: float) -> dict:
+    succeeded = [result for result in results if result.error is None]
+    output_tokens = sum(result.output_tokens for result in succeeded)
+    return {
+        "requests": len(results),
+        "failed": len(results) - len(succeeded),
+        "duration_s": duration,
+        "requests_per_second": len(succeeded) / duration if duration > 0 else 0,
+        "output_tokens": output_tokens,
+        "output_tokens_per_second": output_tokens / duration if duration > 0 else 0,
+        "ttft_ms": percentiles([result.ttft for result in succeeded if result.ttft is not None]),
+        "inter_token_latency_ms": percentiles([latency for result in succeeded for latency in result.inter_token_latencies]),
+        "e2e_latency_ms": percentiles([result.latency for result in succeeded]),
+        "errors": sorted({result.error for result in results if result.error is not None})[:10]
+    }
+
+async def main(args):
+    if args.workload:
+        workload = load_workload(args.workload)
+    else:
+        workload = synthetic_workload(args.num_requests, args.prompt_tokens, args.output_tokens, args.distribution, args.seed)
+
+    tokenizer = None
+    if args.in_process:
+        from processor import create_input_processor
+        input_processor = create_input_processor()
+        input_processor.scheduler.start()
+        tokenizer = input_processor.model_manager.get_tokenizer()
+        results, duration = await run_workload(workload, in_process_sender(input_processor), args.concurrency, args.rate, args.seed)
+        input_processor.scheduler.stop()
+    else:
+        import httpx
+        if args.tokenizer:
+            from transformers import AutoTokenizer
+            tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+        limits = httpx.Limits(max_connections=args.concurrency)
+        async with httpx.AsyncClient(timeout=None, limits=limits) as client:
+            results, duration = await run_workload(
+                workload,
+                lambda payload, result: send_to_server(client, args.url, payload, result),
+                args.concurrency,
+                args.rate,
+                args.seed
+            )
+
+    # the server reports token counts; without them, count tokens from the final text when we have a tokenizer,
+    # otherwise one streamed chunk is one token
+    for result in results:
+        if not result.output_tokens:
+            result.output_tokens = len(tokenizer.encode(result.text, add_special_tokens=False)) if tokenizer else len(result.chunk_times)
+
+    report = summarize(results, duration)
+    report["mode"] = "in_process" if args.in_process else "server"
+    report["concurrency"] = args.concurrency
+    report["rate"] = args.rate
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a workload against the inference server and report latency and throughput as JSON.")
+    parser.add_argument("--url", default=f"http://localhost:{Config.PORT}", help="server to benchmark")
+    parser.add_argument("--workload", help="JSONL file of CompletionRequest/ChatCompletionRequest objects, otherwise a synthetic workload is used")
+    parser.add_argument("--num-requests", type=int, default=100, help="synthetic workload size")
+    parser.add_argument("--prompt-tokens", type=int, default=128, help="mean synthetic prompt length")
+    parser.add_argument("--output-tokens", type=int, default=64, help="mean synthetic output length")
+    parser.add_argument("--distribution", choices=["fixed", "uniform", "exponential"], default="fixed", help="synthetic length distribution")
+    parser.add_argument("--concurrency", type=int, default=8, help="max requests in flight")
+    parser.add_argument("--rate", type=float, help="Poisson arrival rate in requests/sec, default sends everything at once")
+    parser.add_argument("--in-process", action="store_true", help="drive InputProcessor directly instead of going through HTTP")
+    parser.add_argument("--tokenizer", help="tokenizer used to count output tokens in server mode when the server doesn't report usage, default counts streamed chunks")
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
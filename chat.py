@@ -0,0 +1,103 @@
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+from fastapi import HTTPException
+from config import Config
+
+# used for models whose tokenizer has no chat template (e.g. base models like phi-1_5)
+FALLBACK_CHAT_TEMPLATE = (
+    "{% for message in messages %}"
+    "{% if message['role'] == 'system' %}{{ message['content'] }}\n\n"
+    "{% else %}{{ message['role'] | capitalize }}: {{ message['content'] }}\n"
+    "{% endif %}"
+    "{% endfor %}"
+    "{% if add_generation_prompt %}Assistant:{% endif %}"
+)
+
+class ChatTokenizer:
+    """
+    Renders whole conversations with the tokenizer's chat template and tokenizes them incrementally.
+
+    The token IDs of every conversation seen are cached, keyed by a chained hash over its messages. When the next turn
+    of that conversation arrives (the same messages plus the reply and a new user message), only the text after the
+    cached conversation is tokenized and the cached IDs are reused as they are. So a conversation's prompt always starts
+    with exactly the tokens its previous turn had, which is also what lets the prefix cache reuse that turn's KV cache.
+    Templates that render a conversation differently once more messages follow it are tokenized in full instead.
+    """
+    def __init__(self, tokenizer, max_entries: int = Config.CHAT_TOKEN_CACHE_SIZE):
+        self.tokenizer = tokenizer
+        self.chat_template = getattr(tokenizer, "chat_template", None)
+        # chat templates add their own BOS token, the fallback gets whatever the tokenizer normally starts with
+        self.prefix_ids = []
+        if self.chat_template is None:
+            self.chat_template = FALLBACK_CHAT_TEMPLATE
+            self.prefix_ids = tokenizer.encode("", add_special_tokens=True)
+        self.max_entries = max_entries
+        self.entries: OrderedDict = OrderedDict()  # chained message hash -> (rendered conversation, token IDs)
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, messages: List[dict]) -> List[int]:
+        """
+        Returns the prompt token IDs for the conversation, ending with the template's generation prompt.
+        messages are {"role", "content"} dicts with text content.
+        """
+        if not messages:
+            raise HTTPException(status_code=400, detail="A chat completion needs at least one message.")
+        message_hashes = self._message_hashes(messages)
+        cached_text, cached_ids = self._lookup(message_hashes)
+
+        conversation = self._render(messages, add_generation_prompt=False)
+        if cached_ids is not None and conversation.startswith(cached_text):
+            token_ids = cached_ids + self._tokenize(conversation[len(cached_text):])
+        else:
+            token_ids = self.prefix_ids + self._tokenize(conversation)
+        self._insert(message_hashes[-1], conversation, token_ids)
+
+        prompt = self._render(messages, add_generation_prompt=True)
+        if not prompt.startswith(conversation):
+            return self.prefix_ids + self._tokenize(prompt)
+        return token_ids + self._tokenize(prompt[len(conversation):])
+
+    def _message_hashes(self, messages: List[dict]) -> List[int]:
+        hashes = []
+        previous = None
+        for message in messages:
+            previous = hash((previous, message["role"], message["content"]))
+            hashes.append(previous)
+        return hashes
+
+    def _lookup(self, message_hashes: List[int]) -> Tuple[str, Optional[List[int]]]:
+        """
+        Finds the longest already tokenized prefix of the conversation.
+        """
+        for message_hash in reversed(message_hashes):
+            entry = self.entries.get(message_hash)
+            if entry is not None:
+                self.entries.move_to_end(message_hash)
+                self.hits += 1
+                return entry
+        self.misses += 1
+        return "", None
+
+    def _insert(self, message_hash: int, text: str, token_ids: List[int]):
+        self.entries[message_hash] = (text, token_ids)
+        self.entries.move_to_end(message_hash)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _render(self, messages: List[dict], add_generation_prompt: bool) -> str:
+        try:
+            return self.tokenizer.apply_chat_template(
+                messages,
+                chat_template=self.chat_template,
+                add_generation_prompt=add_generation_prompt,
+                tokenize=False
+            )
+        except Exception as e:  # templates raise on conversations they don't support, e.g. non-alternating roles
+            raise HTTPException(status_code=400, detail=f"Could not apply the chat template: {e}")
+
+    def _tokenize(self, text: str) -> List[int]:
+        return self.tokenizer.encode(text, add_special_tokens=False) if text else []
+
+    def stats(self) -> dict:
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
@@ -5,7 +5,42 @@ dotenv.load_dotenv()
 
 class Config:
     MODEL_NAME: str = "microsoft/phi-1_5"
+    MODELS: list = []  # other Huggingface models served alongside MODEL_NAME, picked by a request's model field and loaded on first use
+    MODEL_MEMORY_GB: float = 0  # memory budget for resident models, past it the least recently used are unloaded; 0 uses the free memory at startup
+    MODEL_KV_CACHE_GB: float = 0  # KV cache pool of each model, must be set with MODELS; 0 gives a lone model everything left after loading it
     PORT: int = 8000
     DEFAULT_MAX_TOKENS: int = 100
     DEFAULT_TEMPERATURE: float = 1
+    NUM_WORKERS: int = 1  # inference processes sharing one copy of the weights, each pinned to its own cores (CPU only)
+    MAX_BATCH_SIZE: int = 16  # max sequences decoded together in one forward pass
+    MAX_QUEUE_DEPTH: int = 64  # max requests waiting for a batch slot before new ones get a 503
+    BATCH_SORT_WINDOW: int = 1024  # batch jobs sort this many requests at a time by prompt length before running them
+    PREFILL_CHUNK_SIZE: int = 512  # longer prompts are prefilled this many tokens at a time, between decode steps
+    MAX_PREFILL_TOKENS_PER_STEP: int = 2048  # prompt tokens prefilled per decode step, bounds how long running sequences wait for their next token
+    KV_CACHE_MEMORY_FRACTION: float = 0.9  # share of the memory left after loading the model that running sequences' KV caches may use
+    KV_CACHE_BLOCK_SIZE: int = 16  # KV cache memory is reserved in blocks of this many tokens
+    PREFIX_CACHE_MAX_GB: float = 1  # memory budget for reusing prompt prefix KV caches across requests, 0 disables it
+    PREFIX_CACHE_BLOCK_SIZE: int = 16  # prefixes are cached and matched in blocks of this many tokens
+    CHAT_TOKEN_CACHE_SIZE: int = 4096  # conversations whose tokenized prompts are kept so the next turn only tokenizes new messages
+    STREAM_COALESCE: bool = True  # merge tokens generated while a slow client is still reading into one streamed chunk
+    RESPONSE_CACHE_SIZE: int = 0  # deterministic (greedy or seeded) responses kept for replaying exact repeats, 0 disables it
+    RESPONSE_CACHE_TTL: float = 3600  # seconds a cached response stays valid
+    RESPONSE_CACHE_PATH: str = ""  # sqlite file that also stores cached responses across restarts, empty keeps them in memory only
+    IMAGE_CACHE_MAX_GB: float = 0.5  # memory budget for caching preprocessed images by URL or content hash, 0 disables it
+    IMAGE_FETCH_TIMEOUT: float = 10  # seconds before an image download is abandoned
+    IMAGE_FETCH_MAX_CONNECTIONS: int = 32  # size of the pooled HTTP client used to download images
+    IMAGE_MAX_BYTES: int = 20 * 1024 * 1024  # largest image download (or file) accepted, in bytes
+    IMAGE_ALLOW_FILE_URLS: bool = False  # let requests read file:// image URLs from the server's disk (for local testing only)
+    IMAGE_PREPROCESS_THREADS: int = 4  # threads decoding and preprocessing images off the event loop
+    DRAFT_MODEL_NAME: str = ""  # small model sharing MODEL_NAME's tokenizer, enables speculative decoding when set
+    SPECULATIVE_TOKENS: int = 4  # tokens the draft model proposes per speculative decoding round
+    SPECULATIVE_MAX_BATCH_SIZE: int = 4  # speculate only while at most this many sequences are decoding, past that the batched decode is faster
+    QUANTIZATION_MODE: str = "none"  # one of none, bf16, fp16, int8_dynamic (CPU only), int8_weight_only, int4_weight_only
+    WARMUP: bool = True  # run a warmup forward pass before serving the first request
+    COMPILE_DECODE: bool = False  # run decode steps through torch.compile, cuts Python and dispatch overhead for small models on CPU
+    COMPILE_MODE: str = "default"  # torch.compile mode for the decode step, e.g. max-autotune-no-cudagraphs
+    COMPILE_CACHE_DIR: str = os.path.expanduser("~/.cache/torch_compile")  # compiled kernels are cached here, so restarts skip most of the compiling
+    TRACE_REQUESTS: bool = True  # record per-request timing spans, served as JSON at /traces
+    TRACE_HISTORY: int = 100  # how many of the most recent request traces are kept
+    OFFLINE_MODE: bool = os.getenv("HF_HUB_OFFLINE", "0") == "1"  # only use models already in the local Huggingface cache
     HUGGINGFACE_ACCESS_TOKEN: str = os.getenv("HUGGINGFACE_ACCESS_TOKEN", "")
@@ -0,0 +1,82 @@
+from typing import List, Optional
+
+# how many prompt tokens to decode alongside the first output tokens, so tokenizers that
+# decide on leading spaces from context (e.g. SentencePiece) get them right
+PROMPT_CONTEXT_TOKENS = 5
+
+class IncrementalDetokenizer:
+    """
+    Turns a stream of token IDs into a stream of text deltas for one sequence.
+    Only a small window of tokens is decoded per step: the tokens since the last released text, plus a few before them
+    for context. Text that ends in an incomplete UTF-8 sequence (byte fallback tokens, multi-token characters) is held
+    back until the rest of the character arrives, so clients never see U+FFFD mid-stream.
+
+    Stop strings are matched against the decoded text, so they are found even when they span token boundaries. Text
+    that could be the start of a stop string is held back until it is clear whether the stop string completes.
+    """
+    def __init__(self, tokenizer, prompt_ids: Optional[List[int]] = None, stop_strings: Optional[List[str]] = None):
+        self.tokenizer = tokenizer
+        self.token_ids: List[int] = list(prompt_ids[-PROMPT_CONTEXT_TOKENS:]) if prompt_ids else []
+        self.prefix_offset = 0  # start of the context window that is decoded each step
+        self.read_offset = len(self.token_ids)  # tokens before this have already been turned into text
+        self.stop_strings = [stop for stop in (stop_strings or []) if stop]
+        self.max_stop_len = max((len(stop) for stop in self.stop_strings), default=0)
+        self.text = ""  # all output text decoded so far
+        self.released = 0  # how much of self.text has been handed out
+        self.stopped = False  # a stop string was hit, self.text is cut right before it
+
+    def add_token(self, token_id: int) -> str:
+        """
+        Adds one token and returns the text that can now safely be sent to the client (possibly empty).
+        """
+        self.token_ids.append(token_id)
+        prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset:])
+        if len(new_text) <= len(prefix_text) or new_text.endswith("\ufffd"):
+            return ""  # nothing new yet, or a character is still incomplete
+
+        self._append_text(new_text[len(prefix_text):])
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.token_ids)
+        return self._release(final=False)
+
+    def flush(self) -> str:
+        """
+        Returns whatever text is still held back once generation is over.
+        """
+        if not self.stopped and self.read_offset < len(self.token_ids):
+            prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+            new_text = self._decode(self.token_ids[self.prefix_offset:])
+            self._append_text(new_text[len(prefix_text):])
+            self.read_offset = len(self.token_ids)
+        return self._release(final=True)
+
+    def _decode(self, token_ids: List[int]) -> str:
+        return self.tokenizer.decode(token_ids, skip_special_tokens=True)
+
+    def _append_text(self, text: str):
+        # only the tail of the old text can be part of a stop string that ends in the new text
+        search_start = max(len(self.text) - self.max_stop_len + 1, 0)
+        self.text += text
+        matches = [index for index in (self.text.find(stop, search_start) for stop in self.stop_strings) if index != -1]
+        if matches:
+            self.text = self.text[:min(matches)]
+            self.stopped = True
+
+    def _release(self, final: bool) -> str:
+        end = len(self.text)
+        if not final and not self.stopped:
+            end -= self._partial_stop_length()
+        delta = self.text[self.released:end]
+        self.released = max(self.released, end)
+        return delta
+
+    def _partial_stop_length(self) -> int:
+        """
+        Length of the longest suffix of the text that is a prefix of some stop string.
+        """
+        for length in range(min(self.max_stop_len - 1, len(self.text)), 0, -1):
+            suffix = self.text[-length:]
+            if any(stop.startswith(suffix) for stop in self.stop_strings):
+                return length
+        return 0
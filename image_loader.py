@@ -0,0 +1,161 @@
+import asyncio
+import hashlib
+import time
+import httpx
+import torch
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+from fastapi import HTTPException
+from PIL import Image
+from llama_models.llama3.api.datatypes import ImageMedia, URL
+from config import Config
+from metrics import Trace
+
+class ImageLoader:
+    """
+    Turns ImageMedia into the model's pixel_values without blocking the event loop.
+    URLs are downloaded with one pooled async HTTP client, up to max_image_bytes each, and decoding and the Huggingface
+    processor run in a thread pool. file:// URLs are read from the server's disk only when allow_file_urls is set, since
+    otherwise any client could read local files. The preprocessed pixel_values are cached by URL, or by a hash of the
+    pixels for inline images, so a repeated image skips both the download and the preprocessing. Concurrent requests
+    for the same image share one load.
+    """
+    def __init__(
+        self,
+        processor,
+        device: torch.device,
+        max_gb: float = Config.IMAGE_CACHE_MAX_GB,
+        timeout: float = Config.IMAGE_FETCH_TIMEOUT,
+        max_connections: int = Config.IMAGE_FETCH_MAX_CONNECTIONS,
+        preprocess_threads: int = Config.IMAGE_PREPROCESS_THREADS,
+        max_image_bytes: int = Config.IMAGE_MAX_BYTES,
+        allow_file_urls: bool = Config.IMAGE_ALLOW_FILE_URLS
+    ):
+        self.processor = processor
+        self.device = device
+        self.max_bytes = int(max_gb * (1024 ** 3))
+        self.max_image_bytes = max_image_bytes
+        self.allow_file_urls = allow_file_urls
+        self.client = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections),
+            follow_redirects=True
+        )
+        self.executor = ThreadPoolExecutor(max_workers=preprocess_threads, thread_name_prefix="image-preprocess")
+        self.entries: OrderedDict = OrderedDict()  # cache key -> pixel_values, only touched on the event loop
+        self.used_bytes = 0
+        self.pending: Dict[str, asyncio.Task] = {}  # loads in flight, so concurrent requests for one image share them
+        self.hits = 0
+        self.misses = 0
+
+    async def load(self, image_media: ImageMedia, trace: Optional[Trace] = None) -> torch.Tensor:
+        """
+        Returns the pixel_values for one image, from the cache when possible.
+        """
+        image = image_media.image
+        uri = image.uri if isinstance(image, URL) else image if isinstance(image, str) else None
+        key = f"url:{uri}" if uri is not None else await self._run_in_thread(self._content_hash, image)
+
+        pixel_values = self.entries.get(key)
+        if pixel_values is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return pixel_values
+
+        self.misses += 1
+        task = self.pending.get(key)
+        if task is None:
+            task = asyncio.create_task(self._load(key, uri, image, trace))
+            self.pending[key] = task
+            task.add_done_callback(lambda _: self.pending.pop(key, None))
+        # shielded, so a client disconnecting doesn't cancel a load other requests are waiting on
+        return await asyncio.shield(task)
+
+    async def load_all(self, images: List[ImageMedia], trace: Optional[Trace] = None) -> List[torch.Tensor]:
+        """
+        Loads every image concurrently, keeping their order.
+        """
+        return list(await asyncio.gather(*(self.load(image_media, trace) for image_media in images)))
+
+    async def _load(self, key: str, uri: Optional[str], image, trace: Optional[Trace]) -> torch.Tensor:
+        if uri is not None:
+            start = time.perf_counter()
+            data = await self._fetch(uri)
+            if trace is not None:
+                trace.add_span("image_fetch", start, time.perf_counter())
+            image = data
+
+        start = time.perf_counter()
+        pixel_values = await self._run_in_thread(self._preprocess, image)
+        if trace is not None:
+            trace.add_span("image_preprocess", start, time.perf_counter())
+        self._insert(key, pixel_values)
+        return pixel_values
+
+    async def _fetch(self, uri: str) -> bytes:
+        parsed = urlparse(uri)
+        try:
+            if parsed.scheme == "file" and self.allow_file_urls:
+                return await self._run_in_thread(self._read_file, url2pathname(parsed.path))
+            if parsed.scheme not in ("http", "https"):
+                raise HTTPException(status_code=400, detail=f"Unsupported image URL scheme: {parsed.scheme or uri}")
+            async with self.client.stream("GET", uri) as response:
+                response.raise_for_status()
+                if int(response.headers.get("content-length") or 0) > self.max_image_bytes:
+                    raise self._too_large(uri)
+                data = bytearray()
+                async for chunk in response.aiter_bytes():
+                    data += chunk
+                    if len(data) > self.max_image_bytes:
+                        raise self._too_large(uri)
+                return bytes(data)
+        except (httpx.HTTPError, OSError) as e:
+            raise HTTPException(status_code=400, detail=f"Could not fetch image {uri}: {e}")
+
+    def _read_file(self, path: str) -> bytes:
+        with open(path, "rb") as f:
+            data = f.read(self.max_image_bytes + 1)
+        if len(data) > self.max_image_bytes:
+            raise self._too_large(path)
+        return data
+
+    def _too_large(self, uri: str) -> HTTPException:
+        return HTTPException(status_code=400, detail=f"Image {uri} is larger than {self.max_image_bytes} bytes.")
+
+    def _content_hash(self, image: Image.Image) -> str:
+        digest = hashlib.sha256(f"{image.mode}:{image.size}".encode())
+        digest.update(image.tobytes())
+        return f"sha256:{digest.hexdigest()}"
+
+    def _preprocess(self, image) -> torch.Tensor:
+        if isinstance(image, bytes):
+            try:
+                image = Image.open(BytesIO(image))
+                image.load()
+            except OSError as e:
+                raise HTTPException(status_code=400, detail=f"Could not decode image: {e}")
+        return self.processor(images=image, return_tensors="pt")["pixel_values"].to(self.device)
+
+    async def _run_in_thread(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    def _insert(self, key: str, pixel_values: torch.Tensor):
+        nbytes = pixel_values.numel() * pixel_values.element_size()
+        if nbytes > self.max_bytes or key in self.entries:
+            return
+        while self.entries and self.used_bytes + nbytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.used_bytes -= evicted.numel() * evicted.element_size()
+        self.entries[key] = pixel_values
+        self.used_bytes += nbytes
+
+    def stats(self) -> dict:
+        return {"entries": len(self.entries), "used_gb": self.used_bytes / (1024 ** 3), "hits": self.hits, "misses": self.misses}
+
+    async def close(self):
+        await self.client.aclose()
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,242 @@
+import torch
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+# A KV cache in "legacy" format: one (key, value) pair per layer, each shaped [batch, heads, seq_len, head_dim].
+LegacyCache = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
+def to_legacy_cache(past) -> Optional[LegacyCache]:
+    """
+    Normalizes whatever the model returned as past_key_values (tuples or a transformers Cache object) into legacy tuples.
+    """
+    if past is None:
+        return None
+    if hasattr(past, "to_legacy_cache"):
+        return past.to_legacy_cache()
+    return tuple((layer[0], layer[1]) for layer in past)
+
+def to_model_cache(model, past: Optional[LegacyCache]):
+    """
+    Converts legacy tuples into the cache format the model expects.
+    Newer transformers versions want a DynamicCache object, older ones (and older model classes) take plain tuples.
+    A fresh cache object is built every call so the model never mutates tensors we still hold a reference to.
+    """
+    if past is None:
+        return None
+    if not getattr(model, "_supports_cache_class", True):
+        return past
+    try:
+        from transformers import DynamicCache
+    except ImportError:
+        return past
+    return DynamicCache.from_legacy_cache(past)
+
+def cache_length(past: Optional[LegacyCache]) -> int:
+    """
+    Returns the number of positions (including any padding) held by the cache.
+    """
+    if past is None:
+        return 0
+    return past[0][0].shape[-2]
+
+def truncate_cache(past: LegacyCache, length: int) -> LegacyCache:
+    """
+    Keeps only the first length positions of every layer of the cache.
+    """
+    return tuple((key[..., :length, :], value[..., :length, :]) for key, value in past)
+
+def left_pad_cache(past: LegacyCache, length: int) -> LegacyCache:
+    """
+    Left pads every layer of the cache with zeros along the sequence dimension up to the given length.
+    Padded positions must be masked out with a 0 in the attention mask.
+    """
+    if length <= cache_length(past):
+        return past
+    return tuple((_left_pad(key, length), _left_pad(value, length)) for key, value in past)
+
+def merge_caches(first, first_mask: torch.Tensor, second, second_mask: torch.Tensor) -> Tuple[LegacyCache, torch.Tensor]:
+    """
+    Concatenates two batched caches along the batch dimension, left padding the shorter one so their lengths line up.
+    Returns the merged cache and its [batch, seq_len] attention mask.
+    The caches are copied one layer at a time, and a cache passed as a list is emptied as its layers are copied, so at
+    most one layer is held twice.
+    """
+    length = max(cache_length(first), cache_length(second))
+    merged = []
+    for (k1, v1), (k2, v2) in zip(_layers(first), _layers(second)):
+        merged.append((
+            torch.cat([_left_pad(k1, length), _left_pad(k2, length)], dim=0),
+            torch.cat([_left_pad(v1, length), _left_pad(v2, length)], dim=0)
+        ))
+    return tuple(merged), torch.cat([_left_pad_mask(first_mask, length), _left_pad_mask(second_mask, length)], dim=0)
+
+def select_rows(past, mask: torch.Tensor, rows: List[int]) -> Tuple[LegacyCache, torch.Tensor]:
+    """
+    Keeps only the given batch rows of the cache, and trims leading columns that are padding for every remaining row.
+    Like merge_caches, a cache passed as a list is emptied one layer at a time.
+    """
+    index = torch.tensor(rows, dtype=torch.long, device=mask.device)
+    mask = mask.index_select(0, index)
+
+    # drop the left padding that only existed for the rows we just removed, before copying anything
+    used_columns = mask.any(dim=0).nonzero()
+    start = used_columns[0].item() if used_columns.numel() > 0 else mask.shape[1]
+    mask = mask[:, start:]
+    past = tuple(
+        (key[..., start:, :].index_select(0, index), value[..., start:, :].index_select(0, index))
+        for key, value in _layers(past)
+    )
+    return past, mask
+
+def padded_batch_tokens(rows: List[Tuple[int, int]]) -> int:
+    """
+    The most tokens a left padded batch will hold at once, given each row's (cache length, tokens still to generate).
+    Every row is as long as the longest one, so one long prompt makes every short row cost its length too. The batch
+    grows by one column per step until its rows finish, so the peak is at some row's last step.
+    """
+    if not rows:
+        return 0
+    length = max(cached for cached, _ in rows)
+    remaining = sorted((left for _, left in rows), reverse=True)
+    return max((alive + 1) * (length + left) for alive, left in enumerate(remaining))
+
+def append_mask_column(mask: torch.Tensor, spare_columns: int = 64) -> torch.Tensor:
+    """
+    Returns the attention mask with a column of ones appended for the next decode step.
+    The mask is kept as a view into a wider buffer, so most steps write one column in place instead of copying the
+    whole mask; the buffer is only reallocated, with spare_columns to spare, when it runs out.
+    """
+    rows, length = mask.shape
+    row_stride = mask.stride(0)
+    storage_size = mask.untyped_storage().nbytes() // mask.element_size()
+    has_spare_column = (
+        mask.stride(1) == 1
+        and row_stride > 0
+        and mask.storage_offset() % row_stride + length < row_stride
+        and mask.storage_offset() + (rows - 1) * row_stride + length < storage_size
+    )
+    if has_spare_column:
+        mask = mask.as_strided((rows, length + 1), mask.stride())
+    else:
+        buffer = mask.new_zeros(rows, length + 1 + spare_columns)
+        buffer[:, :length] = mask
+        mask = buffer[:, :length + 1]
+    mask[:, length] = 1
+    return mask
+
+def _layers(past):
+    if isinstance(past, list):
+        while past:
+            yield past.pop(0)
+    else:
+        yield from past
+
+def _left_pad(tensor: torch.Tensor, length: int) -> torch.Tensor:
+    pad = length - tensor.shape[-2]
+    if pad <= 0:
+        return tensor
+    return torch.cat([tensor.new_zeros(tensor.shape[:-2] + (pad, tensor.shape[-1])), tensor], dim=-2)
+
+def _left_pad_mask(mask: torch.Tensor, length: int) -> torch.Tensor:
+    pad = length - mask.shape[1]
+    if pad <= 0:
+        return mask
+    return torch.cat([mask.new_zeros(mask.shape[0], pad), mask], dim=1)
+
+def kv_cache_bytes_per_token(model) -> int:
+    """
+    Returns how many bytes of KV cache one token takes across all layers, from the model's config and dtype.
+    """
+    dtype_bytes = model.get_input_embeddings().weight.element_size()  # activations (and so the cache) follow the embeddings' dtype
+    return config_kv_cache_bytes_per_token(model.config, dtype_bytes)
+
+def config_kv_cache_bytes_per_token(config, dtype_bytes: int) -> int:
+    """
+    Same as kv_cache_bytes_per_token, from a model config alone, so it can be sized before loading any weights.
+    """
+    config = getattr(config, "text_config", None) or config  # multimodal models nest the language model config
+    num_layers = config.num_hidden_layers
+    num_heads = config.num_attention_heads
+    num_kv_heads = getattr(config, "num_key_value_heads", None) or num_heads
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // num_heads
+    return 2 * num_layers * num_kv_heads * head_dim * dtype_bytes  # keys and values
+
+class BlockAllocator:
+    """
+    Paged accounting for KV cache memory.
+    The memory left over after loading the model is split into a pool of fixed-size blocks of block_size tokens.
+    Each sequence owns a block table covering its prompt plus its max_tokens, reserved up front on admission, so a
+    sequence that was admitted can always run to completion. When the pool is exhausted, new sequences wait instead of
+    running the process out of memory.
+    Tables can also be resized, which the scheduler uses to reserve the padding its batched cache needs on top.
+    """
+    def __init__(self, num_blocks: int, block_size: int, bytes_per_block: int = 0, num_layers: int = 1):
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.bytes_per_block = bytes_per_block
+        self.num_layers = num_layers  # a copy of one layer is the most the cache ever holds twice
+        self.free_blocks = deque(range(num_blocks))
+        self.block_tables: Dict[int, List[int]] = {}  # seq_id -> block IDs owned by that sequence
+
+    @classmethod
+    def from_memory(cls, available_gb: float, model, block_size: int):
+        """
+        Sizes the pool so that every block's worth of KV cache fits in available_gb.
+        """
+        bytes_per_block = kv_cache_bytes_per_token(model) * block_size
+        num_blocks = max(int(available_gb * (1024 ** 3)) // bytes_per_block, 0)
+        config = getattr(model.config, "text_config", None) or model.config
+        return cls(num_blocks, block_size, bytes_per_block, config.num_hidden_layers)
+
+    def blocks_needed(self, num_tokens: int) -> int:
+        return -(-num_tokens // self.block_size)
+
+    def can_allocate(self, num_tokens: int) -> bool:
+        return self.blocks_needed(num_tokens) <= len(self.free_blocks)
+
+    def allocate(self, seq_id: int, num_tokens: int) -> List[int]:
+        """
+        Reserves enough blocks for num_tokens and records them in the sequence's block table.
+        """
+        needed = self.blocks_needed(num_tokens)
+        if needed > len(self.free_blocks):
+            raise MemoryError(f"KV cache pool exhausted: need {needed} blocks, {len(self.free_blocks)} free.")
+        table = self.block_tables.setdefault(seq_id, [])
+        table.extend(self.free_blocks.popleft() for _ in range(needed))
+        return table
+
+    def blocks_to_resize(self, seq_id: int, num_tokens: int) -> int:
+        """
+        How many more blocks seq_id's table needs to cover num_tokens, negative if it would give blocks back.
+        """
+        return self.blocks_needed(num_tokens) - len(self.block_tables.get(seq_id, []))
+
+    def resize(self, seq_id: int, num_tokens: int) -> bool:
+        """
+        Grows or shrinks seq_id's table to exactly cover num_tokens. Returns False, leaving the table as it is, when
+        there aren't enough free blocks to grow it.
+        """
+        change = self.blocks_to_resize(seq_id, num_tokens)
+        if change > len(self.free_blocks):
+            return False
+        table = self.block_tables.setdefault(seq_id, [])
+        if change > 0:
+            table.extend(self.free_blocks.popleft() for _ in range(change))
+        elif change < 0:
+            self.free_blocks.extend(table[change:])
+            del table[change:]
+        if not table:
+            del self.block_tables[seq_id]
+        return True
+
+    def free(self, seq_id: int):
+        """
+        Returns a sequence's blocks to the pool. Safe to call more than once.
+        """
+        self.free_blocks.extend(self.block_tables.pop(seq_id, []))
+
+    def used_blocks(self) -> int:
+        return self.num_blocks - len(self.free_blocks)
+
+    def used_gb(self) -> float:
+        return self.used_blocks() * self.bytes_per_block / (1024 ** 3)
@@ -1,77 +1,269 @@
-from fastapi import FastAPI
-from fastapi.responses import StreamingResponse
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
+from fastapi.responses import Response, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+import json
 import uvicorn
 from config import Config
-from utils import check_system_resources, serialize
 from llama_stack.apis.inference.inference import (
+    ChatCompletionResponseStreamChunk as LlamaStackChatCompletionResponseStreamChunk,
+    CompletionResponseStreamChunk as LlamaStackCompletionResponseStreamChunk
+)
+from pydantic import BaseModel
+from typing import AsyncIterator, Callable, Union
+from batch import read_records, run_batch
+from metrics import REQUESTS, recent_traces, start_trace
+from protocol import (
+    ChatCompletionRequest,
     ChatCompletionResponse,
     ChatCompletionResponseStreamChunk,
-    ChatCompletionRequest,
-    StopReason,
     CompletionRequest,
     CompletionResponse,
-    CompletionResponseStreamChunk
+    CompletionResponseStreamChunk,
+    Usage,
+    stop_reason
 )
-from typing import Union
-from model import ModelManager
-from processor import InputProcessor
+from registry import ModelRegistry
+from sampling import SamplingOptions
+from scheduler import GenerationResult
+from streaming import STREAM_FORMATS, StreamEncoder, coalesce
+
+model_registry = ModelRegistry()
+
+# built once, so streaming a token only costs escaping its text
+completion_encoders = {
+    stream_format: StreamEncoder(lambda delta: LlamaStackCompletionResponseStreamChunk(delta=delta), stream_format)
+    for stream_format in STREAM_FORMATS
+}
+chat_completion_encoders = {
+    stream_format: StreamEncoder(lambda delta: LlamaStackChatCompletionResponseStreamChunk(event={"event_type": "progress", "delta": delta}), stream_format)
+    for stream_format in STREAM_FORMATS
+}
+
+async def start_stream(items: AsyncIterator) -> AsyncIterator:
+    """
+    Runs the stream up to its first item before any response is sent, so a request that fails before generating
+    anything (the queue is full, the prompt is too long, the model failed to load) gets a proper error response rather
+    than a 200 followed by a truncated stream. Returns the whole stream, first item included.
+    """
+    try:
+        first = await items.__anext__()
+    except StopAsyncIteration:
+        return items
+
+    async def resumed():
+        yield first
+        async for item in items:
+            yield item
+    return resumed()
+
+async def stream_tokens(
+    http_request: Request,
+    tokens: AsyncIterator[str],
+    result: GenerationResult,
+    encoders: dict,
+    last_chunk: Callable[[], BaseModel]
+) -> StreamingResponse:
+    """
+    Streams tokens as newline delimited JSON chunks, or as server-sent events when the client accepts text/event-stream.
+    Once the tokens run out, last_chunk() is sent, with the stop reason and usage.
+    A response cache replay is never coalesced, since all of its chunks are ready at once and would go out as one.
+    """
+    encoder = encoders["sse" if "text/event-stream" in http_request.headers.get("accept", "") else "ndjson"]
+    tokens = await start_stream(tokens)
+    if Config.STREAM_COALESCE and not result.cached:
+        tokens = coalesce(tokens)
+
+    async def chunks():
+        async for token in tokens:
+            yield encoder.encode(token)
+        yield encoder.encode_chunk(last_chunk())
+    return StreamingResponse(chunks(), media_type=encoder.media_type)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Starts the inference workers (or worker processes) of the resident models alongside the server and stops them on shutdown.
+    """
+    model_registry.start()
+    yield
+    await model_registry.stop()
 
-check_system_resources(Config.MODEL_NAME)
+class CountRequests:
+    """
+    Counts every HTTP request by route and status code. Written as a plain ASGI middleware, since @app.middleware would
+    pass every streamed chunk through an extra memory stream and task, and get in the way of disconnects reaching the
+    stream.
+    """
+    def __init__(self, app):
+        self.app = app
 
-model_manager = ModelManager()
-input_processor = InputProcessor(model_manager)
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = False
+
+        def count(status: int):
+            route = scope.get("route")  # set by the router once it has matched the request
+            REQUESTS.labels(endpoint=route.path if route else "unmatched", status=status).inc()
+
+        async def counted_send(message):
+            nonlocal started
+            if message["type"] == "http.response.start":
+                started = True
+                count(message["status"])
+            await send(message)
+        try:
+            await self.app(scope, receive, counted_send)
+        except Exception:
+            if not started:
+                count(500)  # the server's error handler answers for us
+            raise
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(CountRequests)
 
 @app.post("/inference/completion")
 async def completion(
-    request: CompletionRequest
+    request: CompletionRequest,
+    http_request: Request
 ) -> Union[CompletionResponse, CompletionResponseStreamChunk]:
     """
     Inferences completion for your chosen huggingface model, with Image inputs allowed!
     """
     max_tokens = min(request.sampling_params.max_tokens or float('inf'), Config.DEFAULT_MAX_TOKENS)
-    temperature = request.sampling_params.temperature or Config.DEFAULT_TEMPERATURE
+    sampling = SamplingOptions.from_sampling_params(request.sampling_params)
+    trace = start_trace("completion")
+    result = GenerationResult()
+    tokens = model_registry.generate(
+        model_registry.resolve(request.model),
+        lambda input_processor: input_processor.generate_tokens(
+            request.content, max_tokens, sampling, request.stop, request.stop_token_ids, trace=trace, result=result
+        )
+    )
 
     if request.stream:
-        async def stream_generator():
-            async for token in input_processor.generate_tokens(request.content, max_tokens, temperature):
-                yield serialize(CompletionResponseStreamChunk(delta=token)).encode('utf-8') + b'\n'
-        return StreamingResponse(stream_generator(), media_type="application/json")
+        return await stream_tokens(
+            http_request,
+            tokens,
+            result,
+            completion_encoders,
+            lambda: CompletionResponseStreamChunk(delta="", stop_reason=stop_reason(result), usage=Usage(**result.usage()))
+        )
     else:
         output_text = ""
-        async for token in input_processor.generate_tokens(request.content, max_tokens, temperature):
+        async for token in tokens:
             output_text += token
-        return CompletionResponse(completion_message={
-            "content": output_text,
-            "stop_reason": StopReason.out_of_tokens if len(output_text) >= max_tokens else StopReason.end_of_message
-        })
+        return CompletionResponse(
+            completion_message={"content": output_text, "stop_reason": stop_reason(result)},
+            usage=Usage(**result.usage())
+        )
     
 @app.post("/inference/chat_completion")
 async def chat_completion(
-    request: ChatCompletionRequest
+    request: ChatCompletionRequest,
+    http_request: Request
 ) -> Union[ChatCompletionResponse, ChatCompletionResponseStreamChunk]:
     """
     Inferences chat completion for your chosen huggingface model, with Image inputs allowed!
     """
-    input_content = request.messages[-1].content
     max_tokens = min(request.sampling_params.max_tokens or float('inf'), Config.DEFAULT_MAX_TOKENS)
-    temperature = request.sampling_params.temperature or Config.DEFAULT_TEMPERATURE
+    sampling = SamplingOptions.from_sampling_params(request.sampling_params)
+    trace = start_trace("chat_completion")
+    result = GenerationResult()
+    tokens = model_registry.generate(
+        model_registry.resolve(request.model),
+        lambda input_processor: input_processor.generate_chat_tokens(
+            request.messages, max_tokens, sampling, request.stop, request.stop_token_ids, trace=trace, result=result
+        )
+    )
 
     if request.stream:
-        async def stream_generator():
-            async for token in input_processor.generate_tokens(input_content, max_tokens, temperature):
-                yield serialize(ChatCompletionResponseStreamChunk(event={"event_type": "progress", "delta": token})).encode('utf-8') + b'\n'
-        return StreamingResponse(stream_generator(), media_type="application/json")
+        return await stream_tokens(
+            http_request,
+            tokens,
+            result,
+            chat_completion_encoders,
+            lambda: ChatCompletionResponseStreamChunk(
+                event={"event_type": "complete", "delta": "", "stop_reason": stop_reason(result)},
+                usage=Usage(**result.usage())
+            )
+        )
     else:
         output_text = ""
-        async for token in input_processor.generate_tokens(input_content, max_tokens, temperature):
+        async for token in tokens:
             output_text += token
-        return ChatCompletionResponse(completion_message={
-            "role": "assistant",
-            "content": output_text,
-            "stop_reason": StopReason.out_of_tokens if len(output_text) >= max_tokens else StopReason.end_of_message
-        })
+        return ChatCompletionResponse(
+            completion_message={"role": "assistant", "content": output_text, "stop_reason": stop_reason(result)},
+            usage=Usage(**result.usage())
+        )
+
+@app.post("/inference/batch_completion")
+async def batch_completion(request: Request) -> StreamingResponse:
+    """
+    Runs a JSONL body of completion and chat completion requests (each with an optional "id") as an offline batch job,
+    streaming back one JSONL result per request as soon as it finishes. Batch jobs run on MODEL_NAME.
+    """
+    # the body has to be read up front, since a streaming response listens on the same channel for client disconnects
+    body = await request.body()
+
+    async def lines() -> AsyncIterator[str]:
+        for line in body.decode("utf-8").splitlines():
+            yield line
+
+    async def results(input_processor):
+        async for result in run_batch(input_processor, read_records(lines())):
+            yield (json.dumps(result) + "\n").encode("utf-8")
+    return StreamingResponse(await start_stream(model_registry.generate(model_registry.default_model, results)), media_type="application/x-ndjson")
+
+@app.get("/stats")
+async def stats() -> dict:
+    """
+    Reports, for every resident model, the scheduler's queue depth, KV cache usage, prefix cache hit rate, speculative
+    decoding acceptance rate, chat tokenization, response cache and image cache hit rates, and the memory it holds.
+    """
+    return model_registry.stats()
+
+@app.get("/models")
+async def models() -> dict:
+    """
+    Lists the models this server can serve and the ones currently loaded.
+    """
+    return {"served": model_registry.served, "resident": list(model_registry.models)}
+
+@app.post("/models/load")
+async def load_model(model: str, reload: bool = False) -> dict:
+    """
+    Loads a model ahead of its first request. With reload=true, swaps a loaded model for a fresh copy (e.g. after its
+    weights were updated) without a restart; its in-flight requests finish on the old copy.
+    """
+    if reload:
+        await model_registry.reload(model)
+    else:
+        model_registry.release(await model_registry.acquire(model))
+    return await models()
+
+@app.post("/models/unload")
+async def unload_model(model: str) -> dict:
+    """
+    Unloads a model once its in-flight requests finish. The next request for it loads it again.
+    """
+    await model_registry.unload(model)
+    return await models()
+
+@app.get("/metrics")
+async def metrics() -> Response:
+    """
+    Exposes queue depth, active sequences, token throughput, latency histograms, KV cache memory and request counts for Prometheus.
+    """
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/traces")
+async def traces(limit: int = Config.TRACE_HISTORY) -> dict:
+    """
+    Returns the timing spans of the most recently finished requests, newest first.
+    """
+    return {"traces": [trace.to_json() for trace in reversed(list(recent_traces))][:limit]}
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=Config.PORT)
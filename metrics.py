@@ -0,0 +1,79 @@
+import itertools
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, List, Optional, Tuple
+from prometheus_client import Counter, Gauge, Histogram
+from config import Config
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1, 2.5, 5, 10, 30)
+
+REQUESTS = Counter("inference_requests_total", "HTTP requests handled, by endpoint and status code.", ["endpoint", "status"])
+PREFILL_TOKENS = Counter("inference_prefill_tokens_total", "Prompt tokens run through the model. rate() gives prefill tokens/sec.")
+DECODE_TOKENS = Counter("inference_decode_tokens_total", "Tokens generated. rate() gives decode tokens/sec.")
+TIME_TO_FIRST_TOKEN = Histogram("inference_time_to_first_token_seconds", "Time from a request being queued to its first token being sampled.", buckets=LATENCY_BUCKETS)
+INTER_TOKEN_LATENCY = Histogram("inference_inter_token_latency_seconds", "Time between consecutive tokens of the same sequence.", buckets=LATENCY_BUCKETS)
+QUEUE_DEPTH = Gauge("inference_queue_depth", "Requests waiting to be admitted into the running batch.")
+ACTIVE_SEQUENCES = Gauge("inference_active_sequences", "Sequences currently being decoded.")
+KV_CACHE_MEMORY = Gauge("inference_kv_cache_memory_bytes", "KV cache memory reserved by running sequences.")
+
+# the most recently finished request traces, served by /traces
+recent_traces: deque = deque(maxlen=Config.TRACE_HISTORY)
+
+def register_schedulers(schedulers: Callable[[], List]):
+    """
+    Points the scheduler gauges at the schedulers (one per resident model) that schedulers() returns, so they are only
+    computed when /metrics is scraped.
+    """
+    QUEUE_DEPTH.set_function(lambda: sum(len(scheduler.waiting) for scheduler in schedulers()))
+    ACTIVE_SEQUENCES.set_function(lambda: sum(len(scheduler.running) + len(scheduler.speculating) for scheduler in schedulers()))
+    KV_CACHE_MEMORY.set_function(lambda: sum(scheduler.block_allocator.used_blocks() * scheduler.block_allocator.bytes_per_block for scheduler in schedulers()))
+
+class Trace:
+    """
+    Timing spans for one request, from preparing its input until its last token.
+    Spans are plain (name, start, end) tuples of time.perf_counter() readings, so recording one costs two clock reads
+    and a list append. Batched work (decode steps, sampling) is recorded on every sequence in the batch.
+    """
+    _ids = itertools.count()
+
+    def __init__(self, name: str):
+        self.trace_id = next(Trace._ids)
+        self.name = name
+        self.wall_start = time.time()
+        self.start = time.perf_counter()
+        self.spans: List[Tuple[str, float, float]] = []
+        self.attributes = {}
+
+    @contextmanager
+    def span(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans.append((name, start, time.perf_counter()))
+
+    def add_span(self, name: str, start: float, end: float):
+        self.spans.append((name, start, end))
+
+    def finish(self):
+        self.attributes["duration_ms"] = (time.perf_counter() - self.start) * 1000
+        recent_traces.append(self)
+
+    def to_json(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "start_time": self.wall_start,
+            **self.attributes,
+            "spans": [
+                {"name": name, "start_ms": (start - self.start) * 1000, "duration_ms": (end - start) * 1000}
+                for name, start, end in self.spans
+            ]
+        }
+
+def start_trace(name: str) -> Optional[Trace]:
+    """
+    Returns a new trace for a request, or None when tracing is turned off.
+    """
+    return Trace(name) if Config.TRACE_REQUESTS else None
@@ -1,22 +1,108 @@
-from transformers import AutoTokenizer, AutoModelForCausalLM, AutoProcessor
+from transformers import AutoConfig, AutoTokenizer, AutoModelForCausalLM, AutoProcessor
+import os
 import torch
+from typing import Set
 from config import Config
-from huggingface_hub import login
+from quantization import load_dtype, quantize_model, validate_mode
 
 class ModelManager:
-    def __init__(self):
+    def __init__(self, model_name: str = Config.MODEL_NAME, draft_model_name: str = Config.DRAFT_MODEL_NAME):
+        self.model_name = model_name
+        self.draft_model_name = draft_model_name
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         print(f"API Using Device: {self.device}")
+        validate_mode(Config.QUANTIZATION_MODE)
+        print(f"API Using Quantization Mode: {Config.QUANTIZATION_MODE}")
 
-        if Config.HUGGINGFACE_ACCESS_TOKEN:
-            login(token=Config.HUGGINGFACE_ACCESS_TOKEN)
-        self.use_auth = bool(Config.HUGGINGFACE_ACCESS_TOKEN)
+        # the token is passed per call instead of logging in, so nothing talks to the hub unless a file is missing
+        self.hub_kwargs = {
+            "token": Config.HUGGINGFACE_ACCESS_TOKEN or None,
+            "local_files_only": Config.OFFLINE_MODE
+        }
 
-        self.is_multimodal = hasattr(AutoModelForCausalLM.from_pretrained(Config.MODEL_NAME, use_auth_token=self.use_auth), "vision_tower")
+        # the config alone tells us the architecture, no need to load the weights to find a vision tower
+        config = AutoConfig.from_pretrained(model_name, **self.hub_kwargs)
+        self.is_multimodal = getattr(config, "vision_config", None) is not None
 
-        self.tokenizer = AutoTokenizer.from_pretrained(Config.MODEL_NAME, use_auth_token=self.use_auth)
-        self.model = AutoModelForCausalLM.from_pretrained(Config.MODEL_NAME, use_auth_token=self.use_auth).to(self.device)
-        self.processor = AutoProcessor.from_pretrained(Config.MODEL_NAME, use_auth_token=self.use_auth) if self.is_multimodal else None
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, **self.hub_kwargs)
+        self.model = self.load_model(model_name)
+        self.processor = AutoProcessor.from_pretrained(model_name, **self.hub_kwargs) if self.is_multimodal else None
+
+        self.draft_model = None
+        if draft_model_name:
+            draft_tokenizer = AutoTokenizer.from_pretrained(draft_model_name, **self.hub_kwargs)
+            if draft_tokenizer.get_vocab() != self.tokenizer.get_vocab():
+                raise ValueError(f"Draft model {draft_model_name} must share a tokenizer with {model_name} for speculative decoding.")
+            self.draft_model = self.load_model(draft_model_name)
+            print(f"Speculative decoding enabled with draft model: {draft_model_name}")
+
+        # chat models often end a turn with a token other than the tokenizer's EOS token, listed in the generation config
+        generation_eos = getattr(getattr(self.model, "generation_config", None), "eos_token_id", None)
+        generation_eos = generation_eos if isinstance(generation_eos, list) else [generation_eos]
+        self.eos_token_ids = {token_id for token_id in [self.tokenizer.eos_token_id] + generation_eos if token_id is not None}
+
+        self.decode_model = compile_for_decode(self.model) if Config.COMPILE_DECODE else self.model
+
+    def load_model(self, model_name: str):
+        """
+        Loads the weights exactly once, in the dtype of the configured quantization mode, then quantizes them.
+        Safetensors checkpoints are memory-mapped and copied straight into the model's parameters, instead of first
+        building a randomly initialized model and then overwriting it.
+        """
+        model = AutoModelForCausalLM.from_pretrained(
+            model_name,
+            torch_dtype=load_dtype(Config.QUANTIZATION_MODE),
+            low_cpu_mem_usage=True,
+            **self.hub_kwargs
+        )
+        model = model.to(self.device).eval()
+        return quantize_model(model, Config.QUANTIZATION_MODE)
+
+    def warmup(self):
+        """
+        Runs a short forward pass through every loaded model, so one-time setup (allocator pools, kernel selection,
+        lazy initialization) happens before the first request instead of during it.
+        """
+        input_ids = torch.full((1, 8), self.tokenizer.eos_token_id or 0, dtype=torch.long, device=self.device)
+        with torch.no_grad():
+            for model in (self.model, self.draft_model):
+                if model is not None:
+                    model(input_ids=input_ids, attention_mask=torch.ones_like(input_ids), use_cache=True)
+
+    def warmup_decode(self):
+        """
+        Compiles the decode step up front (or loads it from the compile cache), by running two decode steps for a batch of
+        one and a batch of two: torch.compile specializes on size 1, and every larger batch shares the dynamic graph.
+        The first step compiles, the second hits the graph for growing cache lengths.
+        """
+        if self.decode_model is self.model:
+            return
+        print("Compiling the decode step")
+        with torch.no_grad():
+            for batch_size in (1, 2):
+                input_ids = torch.full((batch_size, 8), self.tokenizer.eos_token_id or 0, dtype=torch.long, device=self.device)
+                past = self.model(input_ids=input_ids, attention_mask=torch.ones_like(input_ids), use_cache=True).past_key_values
+                for length in (8, 9):
+                    outputs = self.decode_model(
+                        input_ids=input_ids[:, :1],
+                        attention_mask=torch.ones(batch_size, length + 1, dtype=torch.long, device=self.device),
+                        position_ids=torch.full((batch_size, 1), length, dtype=torch.long, device=self.device),
+                        past_key_values=past,
+                        use_cache=True
+                    )
+                    past = outputs.past_key_values
+
+    def get_decode_model(self):
+        """
+        Returns the model to run decode steps with: the compiled model when COMPILE_DECODE is set, otherwise the model itself.
+        """
+        return self.decode_model
+
+    def get_eos_token_ids(self) -> Set[int]:
+        """
+        Returns every token ID that ends a sequence: the tokenizer's EOS token and the generation config's.
+        """
+        return self.eos_token_ids
 
     def get_tokenizer(self):
         return self.tokenizer
@@ -24,6 +110,9 @@ class ModelManager:
     def get_model(self):
         return self.model
 
+    def get_draft_model(self):
+        return self.draft_model
+
     def get_processor(self):
         return self.processor
 
@@ -32,4 +121,16 @@ class ModelManager:
 
     def get_device(self):
         return self.device
-    
\ No newline at end of file
+
+def compile_for_decode(model):
+    """
+    Wraps the model in torch.compile for decode steps. Shapes are compiled as dynamic, so neither the batch size nor the
+    growing cache length recompiles. Inductor's kernels and FX graphs are cached
+    in COMPILE_CACHE_DIR, so a restart reuses them instead of compiling from scratch.
+    """
+    os.makedirs(Config.COMPILE_CACHE_DIR, exist_ok=True)
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", Config.COMPILE_CACHE_DIR)
+    os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+    os.environ.setdefault("TRITON_CACHE_DIR", os.path.join(Config.COMPILE_CACHE_DIR, "triton"))
+    print(f"Compiling the decode step with torch.compile (mode {Config.COMPILE_MODE}, cache {Config.COMPILE_CACHE_DIR})")
+    return torch.compile(model, mode=Config.COMPILE_MODE, dynamic=True)
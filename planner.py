@@ -0,0 +1,196 @@
+import argparse
+import json
+import time
+import torch
+from huggingface_hub import constants
+from transformers import AutoConfig
+from typing import List
+from config import Config
+from kv_cache import config_kv_cache_bytes_per_token
+from quantization import linear_weight_bits, load_dtype
+from utils import (
+    count_weight_bytes,
+    find_local_snapshot,
+    get_available_disk_space,
+    get_available_memory,
+    get_available_vram,
+    get_weight_tensors
+)
+
+GB = 1024 ** 3
+
+class ResourcePlan:
+    """
+    What serving a model takes and what it leaves for the KV cache, worked out from the safetensors headers and the
+    model config alone: no weights are downloaded or loaded, so planning takes milliseconds.
+    """
+    def __init__(
+        self,
+        model_name: str,
+        device: str,
+        available_gb: float,
+        weights_gb: float,
+        activation_gb: float,
+        kv_cache_gb: float,
+        kv_bytes_per_token: int,
+        max_context_len: int,
+        disk_needed_gb: float,
+        disk_free_gb: float,
+        cache_dir: str,
+        planning_ms: float
+    ):
+        self.model_name = model_name
+        self.device = device
+        self.available_gb = available_gb
+        self.weights_gb = weights_gb  # main and draft model, in the configured dtype and quantization
+        self.activation_gb = activation_gb
+        self.kv_cache_gb = kv_cache_gb
+        self.kv_bytes_per_token = kv_bytes_per_token
+        self.max_context_len = max_context_len  # 0 if the config doesn't say
+        self.disk_needed_gb = disk_needed_gb  # 0 once the checkpoint is in the local cache
+        self.disk_free_gb = disk_free_gb
+        self.cache_dir = cache_dir
+        self.planning_ms = planning_ms
+
+    def max_kv_tokens(self) -> int:
+        return int(self.kv_cache_gb * GB) // self.kv_bytes_per_token if self.kv_bytes_per_token else 0
+
+    def max_sequences(self, context_len: int) -> int:
+        """
+        How many sequences of context_len tokens (prompt plus output) fit in the KV cache at once.
+        """
+        return self.max_kv_tokens() // context_len
+
+    def context_lengths(self) -> List[int]:
+        lengths = [512, 2048, 8192, 32768, 131072]
+        if self.max_context_len:
+            lengths = [length for length in lengths if length < self.max_context_len] + [self.max_context_len]
+        return lengths
+
+    def report(self) -> str:
+        lines = [
+            "=" * 50,
+            f"Resource Plan for Model: {self.model_name} (planned in {self.planning_ms:.1f} ms)",
+            "=" * 50,
+            f"Memory ({self.device}): {self.available_gb:.2f} GB available",
+            f"  - Weights: {self.weights_gb:.2f} GB ({Config.QUANTIZATION_MODE} quantization)",
+            f"  - Activations (peak estimate): {self.activation_gb:.2f} GB",
+            f"  - Prefix cache: {Config.PREFIX_CACHE_MAX_GB * Config.NUM_WORKERS:.2f} GB",
+            f"  - KV cache pool: {self.kv_cache_gb:.2f} GB at {self.kv_bytes_per_token / 1024:.1f} KB per token = {self.max_kv_tokens()} tokens",
+            f"Disk ({self.cache_dir}): {self.disk_free_gb:.2f} GB free, {self.disk_needed_gb:.2f} GB to download",
+            f"Max context length: {self.max_context_len or 'unknown'}",
+            "Concurrent sequences that fit, by context length:"
+        ]
+        lines += [f"  - {length} tokens: {self.max_sequences(length)}" for length in self.context_lengths()]
+        lines.append("=" * 50)
+        return "\n".join(lines)
+
+    def to_json(self) -> dict:
+        return {
+            "model": self.model_name,
+            "device": self.device,
+            "available_gb": self.available_gb,
+            "weights_gb": self.weights_gb,
+            "activation_gb": self.activation_gb,
+            "kv_cache_gb": self.kv_cache_gb,
+            "kv_bytes_per_token": self.kv_bytes_per_token,
+            "max_kv_tokens": self.max_kv_tokens(),
+            "max_context_len": self.max_context_len,
+            "max_sequences": {str(length): self.max_sequences(length) for length in self.context_lengths()},
+            "disk_needed_gb": self.disk_needed_gb,
+            "disk_free_gb": self.disk_free_gb
+        }
+
+def plan_resources(model_name: str = Config.MODEL_NAME, draft_model_name: str = "", max_kv_cache_gb: float = 0) -> ResourcePlan:
+    """
+    Plans memory and disk for serving the model (and draft model) on this machine: exact weight bytes in the configured
+    dtype and quantization from the safetensors headers (estimated from the config for checkpoints without them), a
+    peak activation estimate and KV cache bytes per token from the config, and the KV cache pool (at most
+    max_kv_cache_gb, if given) from what's left.
+    Raises a ValueError if the model can't be sized, the weights and activations don't fit in memory, what's left can't
+    hold one full length sequence's KV cache per worker, or the download doesn't fit on disk.
+    """
+    start = time.perf_counter()
+    dtype = load_dtype(Config.QUANTIZATION_MODE)
+    dtype_bytes = torch.tensor([], dtype=dtype).element_size()
+    available_vram = get_available_vram()
+    available_gb = available_vram if available_vram > 0 else get_available_memory()
+
+    weights_bytes = 0
+    disk_bytes = 0
+    for name in filter(None, (model_name, draft_model_name)):
+        tensors = get_weight_tensors(name)
+        weights_bytes += count_weight_bytes(tensors, dtype, linear_weight_bits(Config.QUANTIZATION_MODE))
+        if find_local_snapshot(name) is None:
+            disk_bytes += count_weight_bytes(tensors)
+
+    config = AutoConfig.from_pretrained(model_name, token=Config.HUGGINGFACE_ACCESS_TOKEN or None, local_files_only=Config.OFFLINE_MODE)
+    text_config = getattr(config, "text_config", None) or config
+    kv_bytes_per_token = config_kv_cache_bytes_per_token(config, dtype_bytes)
+    max_context_len = getattr(text_config, "max_position_embeddings", None) or 0
+    activation_bytes = _activation_bytes(text_config, dtype_bytes, max_context_len)
+
+    free_gb = available_gb - (weights_bytes + activation_bytes) / GB
+    # every worker process keeps its own prefix cache
+    kv_cache_gb = max(free_gb * Config.KV_CACHE_MEMORY_FRACTION - Config.PREFIX_CACHE_MAX_GB * Config.NUM_WORKERS, 0)
+    if max_kv_cache_gb > 0:
+        kv_cache_gb = min(kv_cache_gb, max_kv_cache_gb)
+
+    cache_dir = constants.HF_HUB_CACHE
+    plan = ResourcePlan(
+        model_name=model_name,
+        device="cuda" if available_vram > 0 else "cpu",
+        available_gb=available_gb,
+        weights_gb=weights_bytes / GB,
+        activation_gb=activation_bytes / GB,
+        kv_cache_gb=kv_cache_gb,
+        kv_bytes_per_token=kv_bytes_per_token,
+        max_context_len=max_context_len,
+        disk_needed_gb=disk_bytes / GB,
+        disk_free_gb=get_available_disk_space(cache_dir),
+        cache_dir=cache_dir,
+        planning_ms=(time.perf_counter() - start) * 1000
+    )
+    if free_gb < 0:
+        raise ValueError(f"The model ({plan.weights_gb:.2f} GB of weights, {plan.activation_gb:.2f} GB of activations) exceeds available {plan.device} memory ({available_gb:.2f} GB).")
+    # otherwise the scheduler would turn every request away for lack of KV cache
+    sequence_tokens = max_context_len or Config.DEFAULT_MAX_TOKENS
+    sequence_gb = _sequence_kv_bytes(sequence_tokens, kv_bytes_per_token, text_config.num_hidden_layers) / GB
+    if kv_cache_gb / Config.NUM_WORKERS < sequence_gb:
+        raise ValueError(
+            f"The KV cache pool ({kv_cache_gb:.2f} GB over {Config.NUM_WORKERS} worker(s)) can't hold one {sequence_tokens} token sequence "
+            f"({sequence_gb:.2f} GB per worker). Free up memory, lower PREFIX_CACHE_MAX_GB or NUM_WORKERS, or raise MODEL_KV_CACHE_GB."
+        )
+    if plan.disk_needed_gb > plan.disk_free_gb:
+        raise ValueError(f"Not enough disk space in {cache_dir} to download the model. Required: {plan.disk_needed_gb:.2f} GB, Available: {plan.disk_free_gb:.2f} GB")
+    return plan
+
+def _sequence_kv_bytes(tokens: int, kv_bytes_per_token: int, num_layers: int) -> int:
+    """
+    KV cache a single sequence of tokens needs from the scheduler's block pool: its whole blocks, plus the headroom for
+    copying one layer that the scheduler checks requests against.
+    """
+    tokens += tokens // num_layers
+    return -(-tokens // Config.KV_CACHE_BLOCK_SIZE) * Config.KV_CACHE_BLOCK_SIZE * kv_bytes_per_token
+
+def _activation_bytes(config, dtype_bytes: int, max_context_len: int) -> int:
+    """
+    Rough upper bound on the memory one scheduler step needs besides weights and KV cache: hidden states, MLP
+    activations and float32 logits for every token prefilled in the step, plus one prefill chunk's attention scores
+    over the longest context.
+    """
+    tokens = max(Config.MAX_PREFILL_TOKENS_PER_STEP, Config.MAX_BATCH_SIZE)
+    hidden_size = config.hidden_size
+    intermediate_size = getattr(config, "intermediate_size", None) or 4 * hidden_size
+    per_token = (4 * hidden_size + 2 * intermediate_size) * dtype_bytes + config.vocab_size * 4
+    attention_scores = Config.PREFILL_CHUNK_SIZE * (max_context_len or Config.PREFILL_CHUNK_SIZE) * config.num_attention_heads * dtype_bytes
+    return tokens * per_token + attention_scores
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show what serving a model takes on this machine, without loading it.")
+    parser.add_argument("--model", default=Config.MODEL_NAME)
+    parser.add_argument("--draft-model", default=Config.DRAFT_MODEL_NAME)
+    parser.add_argument("--json", action="store_true", help="print the plan as JSON instead of a report")
+    args = parser.parse_args()
+    plan = plan_resources(args.model, args.draft_model)
+    print(json.dumps(plan.to_json(), indent=2) if args.json else plan.report())
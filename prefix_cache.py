@@ -0,0 +1,100 @@
+import hashlib
+from array import array
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from config import Config
+from kv_cache import LegacyCache, cache_length
+
+class PrefixCache:
+    """
+    Caches the KV cache of prompt prefixes so a request that starts with already-seen tokens (system prompt, chat history)
+    only has to prefill its unseen suffix.
+
+    Prefixes are cut at multiples of block_size tokens and keyed by a chained SHA-256 over those blocks, so looking up the
+    longest cached prefix of a prompt costs one hash per block. Each inserted prompt is stored as one clone of its longest
+    block aligned prefix, and every block boundary inside it is registered too, so a later prompt that only shares its
+    first blocks (the same system prompt in another conversation) gets a view of that clone. A hit is only served when
+    the clone's token IDs match the prompt, so a colliding key can never hand one request another request's KV cache.
+    Clones are evicted least recently used first once they exceed the memory budget, along with their block boundaries.
+    """
+    def __init__(self, max_gb: float = Config.PREFIX_CACHE_MAX_GB, block_size: int = Config.PREFIX_CACHE_BLOCK_SIZE):
+        self.max_bytes = int(max_gb * (1024 ** 3))
+        self.block_size = block_size
+        self.entries: OrderedDict = OrderedDict()  # chained hash of a clone's last block -> (token IDs, past, block hashes, nbytes)
+        self.blocks: Dict[bytes, List[bytes]] = {}  # chained block hash -> keys of the clones holding that prefix, newest last
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.hit_tokens = 0
+
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _block_hashes(self, token_ids: List[int]) -> List[bytes]:
+        """
+        Returns one digest per full block, where the i-th digest covers every token up to the end of block i.
+        """
+        hashes = []
+        previous = b""
+        for start in range(0, len(token_ids) - self.block_size + 1, self.block_size):
+            previous = hashlib.sha256(previous + array("q", token_ids[start:start + self.block_size]).tobytes()).digest()
+            hashes.append(previous)
+        return hashes
+
+    def lookup(self, token_ids: List[int]) -> Tuple[int, Optional[LegacyCache]]:
+        """
+        Finds the longest cached prefix of token_ids. At least one token is always left uncached, since the model needs
+        to run on something to produce the next token's logits.
+        Returns the number of cached tokens and their KV cache (views of the clone holding them, which must not be
+        modified in place), or (0, None) on a miss.
+        """
+        hashes = self._block_hashes(token_ids[:-1])
+        for blocks in range(len(hashes), 0, -1):
+            length = blocks * self.block_size
+            for key in reversed(self.blocks.get(hashes[blocks - 1], [])):
+                cached_ids, past, _, _ = self.entries[key]
+                if cached_ids[:length] == tuple(token_ids[:length]):
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    self.hit_tokens += length
+                    return length, tuple((k[..., :length, :], v[..., :length, :]) for k, v in past)
+        self.misses += 1
+        return 0, None
+
+    def insert(self, token_ids: List[int], past: LegacyCache):
+        """
+        Stores the KV cache of the longest block aligned prefix of token_ids. past must hold exactly those tokens, unpadded.
+        Nothing is stored when that prefix is already cached, on its own or inside a longer prompt.
+        """
+        hashes = self._block_hashes(token_ids[:cache_length(past)])
+        if not hashes or hashes[-1] in self.blocks:
+            return
+        length = len(hashes) * self.block_size
+        # clone so we only keep the prefix alive, not the full prompt tensors it was sliced from
+        prefix = tuple((key[..., :length, :].clone(), value[..., :length, :].clone()) for key, value in past)
+        nbytes = sum(key.numel() * key.element_size() + value.numel() * value.element_size() for key, value in prefix)
+        if nbytes > self.max_bytes:
+            return
+
+        self.entries[hashes[-1]] = (tuple(token_ids[:length]), prefix, hashes, nbytes)
+        for block_hash in hashes:
+            self.blocks.setdefault(block_hash, []).append(hashes[-1])
+        self.used_bytes += nbytes
+        while self.used_bytes > self.max_bytes:
+            evicted_key, (_, _, evicted_hashes, evicted_bytes) = self.entries.popitem(last=False)
+            for block_hash in evicted_hashes:
+                owners = self.blocks[block_hash]
+                owners.remove(evicted_key)
+                if not owners:
+                    del self.blocks[block_hash]
+            self.used_bytes -= evicted_bytes
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_tokens": self.hit_tokens,
+            "entries": len(self.entries),
+            "blocks": len(self.blocks),
+            "used_gb": self.used_bytes / (1024 ** 3)
+        }
@@ -1,34 +1,39 @@
+import time
 import torch
-from typing import Union, AsyncGenerator, List
+from typing import Union, AsyncGenerator, List, Optional, Tuple
 from fastapi import HTTPException
-from PIL import Image
-import requests
-from io import BytesIO
-from llama_models.llama3.api.datatypes import ImageMedia
+from llama_models.llama3.api.datatypes import ImageMedia, Message
+from chat import ChatTokenizer
+from config import Config
+from image_loader import ImageLoader
+from kv_cache import BlockAllocator
+from metrics import Trace
+from response_cache import ResponseCache
 from model import ModelManager
+from planner import ResourcePlan, plan_resources
+from sampling import SamplingOptions
+from scheduler import GenerationResult, Scheduler
+from workers import WorkerPool
 
 class InputProcessor:
-    def __init__(self, model_manager: ModelManager):
+    def __init__(self, model_manager: ModelManager, scheduler: Scheduler, resource_plan: Optional[ResourcePlan] = None):
         self.model_manager = model_manager
+        self.scheduler = scheduler
+        self.resource_plan = resource_plan
+        self.image_loader = ImageLoader(model_manager.get_processor(), model_manager.get_device()) if model_manager.is_multimodal_model() else None
+        self.chat_tokenizer = ChatTokenizer(model_manager.get_tokenizer())
+        self.response_cache = ResponseCache(model_name=model_manager.model_name, draft_model_name=model_manager.draft_model_name)
 
-    def process_image(self, image_media: ImageMedia) -> torch.Tensor:
+    async def process_images(self, images: List[ImageMedia], trace: Optional[Trace] = None) -> List[torch.Tensor]:
         """
-        Processes the image into a Tensor so we can use it if the model is multimodal.
+        Processes the images into Tensors so we can use them if the model is multimodal.
+        All images are fetched and preprocessed concurrently, and repeated images come straight from the image cache.
         """
         if not self.model_manager.is_multimodal_model():
             raise HTTPException(status_code=400, detail="This model does not support image inputs.")
-        
-        if isinstance(image_media.image, str):  # URL case
-            response = requests.get(image_media.image)
-            image = Image.open(BytesIO(response.content))
-        else:  # PIL Image case
-            image = image_media.image
-        
-        processor = self.model_manager.get_processor()
-        processed_image = processor(images=image, return_tensors="pt")["pixel_values"].to(self.model_manager.get_device())
-        return processed_image
+        return await self.image_loader.load_all(images, trace)
 
-    def prepare_input(self, content: Union[str, ImageMedia, List[Union[str, ImageMedia]]]) -> dict:
+    async def prepare_input(self, content: Union[str, ImageMedia, List[Union[str, ImageMedia]]], trace: Optional[Trace] = None) -> dict:
         """
         Prepares the input into the model for ideal inference. 
         """
@@ -43,19 +48,11 @@ class InputProcessor:
         
         if self.model_manager.is_multimodal_model():
             if isinstance(content, ImageMedia):
-                model_inputs["pixel_values"] = self.process_image(content)
+                model_inputs["pixel_values"] = (await self.process_images([content], trace))[0]
                 return model_inputs
             
-            text_parts = []
-            image_features_list = []
-            
-            for item in content:
-                if isinstance(item, str):
-                    text_parts.append(item)
-                elif isinstance(item, ImageMedia):
-                    image_features = self.process_image(item)
-                    if image_features is not None:
-                        image_features_list.append(image_features)
+            text_parts = [item for item in content if isinstance(item, str)]
+            image_features_list = await self.process_images([item for item in content if isinstance(item, ImageMedia)], trace)
             
             if text_parts:
                 model_inputs["input_ids"] = tokenizer.encode(" ".join(text_parts), return_tensors="pt").to(device)
@@ -78,42 +75,176 @@ class InputProcessor:
         
         return model_inputs
 
+    async def prepare_chat_input(self, messages: List[Message], trace: Optional[Trace] = None) -> dict:
+        """
+        Prepares a whole conversation for inference, rendered with the model's chat template.
+        Text is templated and tokenized incrementally per conversation, and the images of every message are passed
+        along in order (multimodal models only).
+        """
+        template_messages = []
+        images = []
+        for message in messages:
+            text, message_images = split_content(message.content)
+            images += message_images
+            if getattr(message, "context", None) is not None:  # retrieved context attached to a user message
+                context_text, context_images = split_content(message.context)
+                text = f"{text}\n\n{context_text}"
+                images += context_images
+            template_messages.append({"role": "tool" if message.role == "ipython" else message.role, "content": text})
+
+        model_inputs = {}
+        device = self.model_manager.get_device()
+        if images:
+            model_inputs["pixel_values"] = torch.cat(await self.process_images(images, trace), dim=0)
+        input_ids = self.chat_tokenizer.encode(template_messages)
+        model_inputs["input_ids"] = torch.tensor([input_ids], dtype=torch.long, device=device)
+        model_inputs["attention_mask"] = torch.ones_like(model_inputs["input_ids"])
+        return model_inputs
+
     async def generate_tokens(
         self,
         content: Union[str, ImageMedia, List[Union[str, ImageMedia]]], 
         max_tokens: int, 
-        temperature: float
+        sampling: SamplingOptions,
+        stop: Optional[List[str]] = None,
+        stop_token_ids: Optional[List[int]] = None,
+        trace: Optional[Trace] = None,
+        result: Optional[GenerationResult] = None
     ) -> AsyncGenerator[str, None]:
         """
         Generates the tokens and does the actual inference!
+        The request is handed to the scheduler, which batches it with every other in-flight request.
+        Yields text as soon as it is complete; generation ends early if any of the stop strings or stop token IDs is
+        produced. Once the text is exhausted, result (if given) holds the stop reason and token counts.
+        If a trace is given, the request's timing spans are recorded on it.
+        Deterministic requests are answered from the response cache when they have been seen before.
         """
-        model_inputs = self.prepare_input(content)
-        model = self.model_manager.get_model()
-        tokenizer = self.model_manager.get_tokenizer()
-        device = self.model_manager.get_device()
-        past = None
-        
-        for _ in range(max_tokens):
-            with torch.no_grad():
-                if past is not None:
-                    model_inputs["past_key_values"] = past
-                model_inputs["use_cache"] = True
-                
-                outputs = model(**model_inputs)
-                logits = outputs.logits[:, -1, :]
-        
-                scaled_logits = logits / max(temperature, 1e-8)
-                probs = torch.softmax(scaled_logits, dim=-1)
-                token = torch.multinomial(probs, num_samples=1).squeeze(-1)
-                
-                token_str = tokenizer.decode(token.item())
+        result = result if result is not None else GenerationResult()
+
+        async def generate():
+            start = time.perf_counter()
+            model_inputs = await self.prepare_input(content, trace)
+            if trace is not None:
+                trace.add_span("prepare_input", start, time.perf_counter())
+            async for token_str in self.generate_from_inputs(model_inputs, max_tokens, sampling, stop, stop_token_ids, trace, result):
+                yield token_str
+
+        cache_key = self.response_cache.key("completion", content, max_tokens, sampling, stop, stop_token_ids)
+        async for token_str in self._through_response_cache(cache_key, generate(), trace, result):
+            yield token_str
+
+    async def generate_chat_tokens(
+        self,
+        messages: List[Message],
+        max_tokens: int,
+        sampling: SamplingOptions,
+        stop: Optional[List[str]] = None,
+        stop_token_ids: Optional[List[int]] = None,
+        trace: Optional[Trace] = None,
+        result: Optional[GenerationResult] = None
+    ) -> AsyncGenerator[str, None]:
+        """
+        Same as generate_tokens, for the next assistant turn of a conversation.
+        """
+        result = result if result is not None else GenerationResult()
+
+        async def generate():
+            start = time.perf_counter()
+            model_inputs = await self.prepare_chat_input(messages, trace)
+            if trace is not None:
+                trace.add_span("prepare_input", start, time.perf_counter())
+            async for token_str in self.generate_from_inputs(model_inputs, max_tokens, sampling, stop, stop_token_ids, trace, result):
                 yield token_str
 
-                if token.item() == tokenizer.eos_token_id:
-                    break
-                
-                model_inputs = {
-                    "input_ids": token.unsqueeze(0),
-                    "attention_mask": torch.ones(1, 1).to(device)
-                }
-                past = outputs.past_key_values
+        cache_key = self.response_cache.key("chat", messages, max_tokens, sampling, stop, stop_token_ids)
+        async for token_str in self._through_response_cache(cache_key, generate(), trace, result):
+            yield token_str
+
+    async def generate_from_inputs(
+        self,
+        model_inputs: dict,
+        max_tokens: int,
+        sampling: SamplingOptions,
+        stop: Optional[List[str]] = None,
+        stop_token_ids: Optional[List[int]] = None,
+        trace: Optional[Trace] = None,
+        result: Optional[GenerationResult] = None
+    ) -> AsyncGenerator[str, None]:
+        sequence = self.scheduler.add_request(model_inputs, max_tokens, sampling, stop, stop_token_ids, trace, result)
+        async for token_str in sequence.stream():
+            yield token_str
+
+    async def _through_response_cache(
+        self,
+        cache_key: Optional[str],
+        tokens: AsyncGenerator[str, None],
+        trace: Optional[Trace],
+        result: GenerationResult
+    ) -> AsyncGenerator[str, None]:
+        """
+        Replays a cached response chunk by chunk, or streams the generated one and caches it once it completes.
+        """
+        cached = self.response_cache.get(cache_key) if cache_key is not None else None
+        if cached is not None:
+            if trace is not None:
+                trace.attributes["response_cache_hit"] = True
+                trace.finish()
+            chunks, cached_result = cached
+            vars(result).update(cached_result)
+            result.cached = True
+            for chunk in chunks:
+                yield chunk
+            return
+
+        chunks = []
+        async for token_str in tokens:
+            chunks.append(token_str)
+            yield token_str
+        if cache_key is not None:
+            self.response_cache.put(cache_key, chunks, dict(vars(result)))
+
+    def stats(self) -> dict:
+        """
+        Returns the scheduler's stats along with the chat tokenization, response cache and image cache hit rates, and the
+        capacity planned at startup.
+        """
+        stats = self.scheduler.stats()
+        stats["chat_token_cache"] = self.chat_tokenizer.stats()
+        stats["response_cache"] = self.response_cache.stats()
+        if self.image_loader is not None:
+            stats["image_cache"] = self.image_loader.stats()
+        if self.resource_plan is not None:
+            stats["capacity"] = self.resource_plan.to_json()
+        return stats
+
+    async def close(self):
+        if self.image_loader is not None:
+            await self.image_loader.close()
+
+def split_content(content: Union[str, ImageMedia, List[Union[str, ImageMedia]]]) -> Tuple[str, List[ImageMedia]]:
+    """
+    Splits interleaved content into its text (parts joined with spaces) and its images.
+    """
+    items = content if isinstance(content, list) else [content]
+    text = " ".join(item for item in items if isinstance(item, str))
+    return text, [item for item in items if isinstance(item, ImageMedia)]
+
+def create_input_processor(model_name: str = Config.MODEL_NAME, max_kv_cache_gb: float = 0) -> InputProcessor:
+    """
+    Plans resources (failing fast, before any weights are loaded, if the model won't fit), loads the model, and wires up
+    the scheduler with the planned KV cache pool (at most max_kv_cache_gb, if given) and context length limit, or the
+    worker pool when NUM_WORKERS is above 1 (the pool splits the KV cache pool between its workers).
+    The draft model is only used with MODEL_NAME.
+    The scheduler's worker still needs to be started before generating.
+    """
+    draft_model_name = Config.DRAFT_MODEL_NAME if model_name == Config.MODEL_NAME else ""
+    plan = plan_resources(model_name, draft_model_name, max_kv_cache_gb)
+    print(plan.report())
+
+    model_manager = ModelManager(model_name, draft_model_name)
+    if Config.NUM_WORKERS > 1:
+        return InputProcessor(model_manager, WorkerPool(model_manager, plan.kv_cache_gb, Config.NUM_WORKERS, max_context_len=plan.max_context_len), plan)
+
+    block_allocator = BlockAllocator.from_memory(plan.kv_cache_gb, model_manager.get_model(), Config.KV_CACHE_BLOCK_SIZE)
+    print(f"KV cache pool: {block_allocator.num_blocks} blocks of {block_allocator.block_size} tokens ({plan.kv_cache_gb:.2f} GB)")
+    return InputProcessor(model_manager, Scheduler(model_manager, block_allocator, max_context_len=plan.max_context_len), plan)
@@ -0,0 +1,43 @@
+from typing import List, Optional
+from pydantic import BaseModel
+from llama_stack.apis.inference import inference
+from llama_stack.apis.inference.inference import StopReason
+from scheduler import GenerationResult
+
+# Llama Stack's request and response models, plus the stop conditions and token usage this server supports.
+# Clients that don't send the extra fields, or ignore the extra ones in responses, see no difference.
+
+class StopConditions(BaseModel):
+    stop: Optional[List[str]] = None  # generation ends before any of these strings, which are left out of the output
+    stop_token_ids: Optional[List[int]] = None  # generation ends at any of these tokens (besides end of sequence)
+
+class CompletionRequest(inference.CompletionRequest, StopConditions):
+    pass
+
+class ChatCompletionRequest(inference.ChatCompletionRequest, StopConditions):
+    pass
+
+class Usage(BaseModel):
+    prompt_tokens: int
+    completion_tokens: int
+    total_tokens: int
+
+class CompletionResponse(inference.CompletionResponse):
+    usage: Optional[Usage] = None
+
+class ChatCompletionResponse(inference.ChatCompletionResponse):
+    usage: Optional[Usage] = None
+
+# only the last chunk of a stream carries the stop reason and usage, the others are plain Llama Stack chunks
+class CompletionResponseStreamChunk(inference.CompletionResponseStreamChunk):
+    usage: Optional[Usage] = None
+
+class ChatCompletionResponseStreamChunk(inference.ChatCompletionResponseStreamChunk):
+    usage: Optional[Usage] = None
+
+def stop_reason(result: GenerationResult) -> StopReason:
+    """
+    Maps a GenerationResult's stop reason to Llama Stack's: out_of_tokens when max_tokens was reached, otherwise
+    end_of_message.
+    """
+    return StopReason.out_of_tokens if result.stop_reason == "length" else StopReason.end_of_message
@@ -0,0 +1,146 @@
+import argparse
+import json
+import time
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from config import Config
+
+QUANTIZATION_MODES = ("none", "bf16", "fp16", "int8_dynamic", "int8_weight_only", "int4_weight_only")
+
+def validate_mode(mode: str):
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown quantization mode {mode!r}, expected one of: {', '.join(QUANTIZATION_MODES)}")
+
+def load_dtype(mode: str) -> torch.dtype:
+    """
+    Returns the dtype the weights are loaded in before any quantization is applied.
+    """
+    if mode == "bf16":
+        return torch.bfloat16
+    if mode == "fp16":
+        return torch.float16
+    return torch.get_default_dtype()
+
+def linear_weight_bits(mode: str):
+    """
+    Returns how many bits each Linear weight takes in this mode, or None if Linear layers keep the load dtype.
+    """
+    if mode in ("int8_dynamic", "int8_weight_only"):
+        return 8
+    if mode == "int4_weight_only":
+        return 4
+    return None
+
+def quantize_model(model: nn.Module, mode: str) -> nn.Module:
+    """
+    Applies the quantization mode to an already loaded model.
+    int8_dynamic uses PyTorch's dynamic quantization (int8 weights and activations, CPU only). The weight only modes
+    store Linear weights as int8 or packed int4 and keep activations in the load dtype.
+    The output projection (lm_head) is left alone, since quantizing it hurts quality the most for the least savings.
+    """
+    validate_mode(mode)
+    bits = linear_weight_bits(mode)
+    if bits is None:
+        return model
+
+    output_embeddings = model.get_output_embeddings()
+    if mode == "int8_dynamic":
+        if next(model.parameters()).device.type != "cpu":
+            raise ValueError("int8_dynamic quantization is only supported on CPU, use int8_weight_only on GPU.")
+        skip = {name for name, module in model.named_modules() if module is output_embeddings}
+        layers = {name for name, module in model.named_modules() if isinstance(module, nn.Linear) and name not in skip}
+        return torch.ao.quantization.quantize_dynamic(model, layers, dtype=torch.qint8, inplace=True)  # a copy would hold the weights twice
+
+    for parent in list(model.modules()):
+        for name, child in list(parent.named_children()):
+            # packed int4 needs an even number of input features
+            if isinstance(child, nn.Linear) and child is not output_embeddings and (bits == 8 or child.in_features % 2 == 0):
+                setattr(parent, name, WeightOnlyLinear(child, bits))
+    return model
+
+class WeightOnlyLinear(nn.Module):
+    """
+    A Linear layer whose weight is stored as symmetric int8 (one scale per output channel) or as int4 packed two per
+    byte (one scale per group of group_size input features).
+    int8 on CPU runs on PyTorch's int8 weight matmul kernel when one is available. Otherwise the weight is dequantized on
+    the fly, which still saves the memory but not the compute.
+    """
+    def __init__(self, linear: nn.Linear, bits: int, group_size: int = 128):
+        super().__init__()
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+        self.bits = bits
+        if bits == 8 or self.in_features % group_size != 0:
+            group_size = self.in_features
+        self.group_size = group_size
+
+        weight = linear.weight.detach().float().reshape(self.out_features, -1, group_size)
+        max_int = 2 ** (bits - 1) - 1
+        scales = weight.abs().amax(dim=-1, keepdim=True).clamp(min=1e-8) / max_int
+        quantized = torch.clamp(torch.round(weight / scales), -max_int - 1, max_int).to(torch.int8).reshape(self.out_features, self.in_features)
+        if bits == 4:
+            nibbles = (quantized + 8).to(torch.uint8).reshape(self.out_features, -1, 2)
+            quantized = nibbles[..., 0] | (nibbles[..., 1] << 4)
+
+        self.register_buffer("weight_quantized", quantized)
+        self.register_buffer("scales", scales.reshape(self.out_features, -1).to(linear.weight.dtype))
+        self.bias = linear.bias
+
+    def dequantize(self) -> torch.Tensor:
+        quantized = self.weight_quantized
+        if self.bits == 4:
+            low = (quantized & 0x0F).to(torch.int8) - 8
+            high = (quantized >> 4).to(torch.int8) - 8
+            quantized = torch.stack([low, high], dim=-1).reshape(self.out_features, self.in_features)
+        grouped = quantized.reshape(self.out_features, -1, self.group_size).to(self.scales.dtype)
+        return (grouped * self.scales.unsqueeze(-1)).reshape(self.out_features, self.in_features)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if self.bits == 8 and x.device.type == "cpu" and x.dtype == self.scales.dtype and hasattr(torch, "_weight_int8pack_mm"):
+            output = torch._weight_int8pack_mm(x.reshape(-1, self.in_features), self.weight_quantized, self.scales.reshape(-1))
+            output = output.reshape(x.shape[:-1] + (self.out_features,))
+            return output + self.bias if self.bias is not None else output
+        return F.linear(x, self.dequantize().to(x.dtype), self.bias)
+
+def benchmark(model_name: str, modes, prompt: str, max_tokens: int) -> dict:
+    """
+    Loads the model in every mode and compares each one against full precision: memory, decode tokens/sec, and quality
+    drift (how often the greedy next token agrees with full precision, and the KL divergence between their next token
+    distributions over the prompt).
+    """
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    from utils import calculate_model_size
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    input_ids = tokenizer.encode(prompt, return_tensors="pt")
+    results = {}
+    reference_log_probs = None
+    for mode in ["none"] + [mode for mode in modes if mode != "none"]:
+        model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=load_dtype(mode), low_cpu_mem_usage=True).eval()
+        model = quantize_model(model, mode)
+        with torch.no_grad():
+            log_probs = torch.log_softmax(model(input_ids).logits[0].float(), dim=-1)
+            start = time.perf_counter()
+            model.generate(input_ids, attention_mask=torch.ones_like(input_ids), max_new_tokens=max_tokens, min_new_tokens=max_tokens, do_sample=False)
+            elapsed = time.perf_counter() - start
+
+        result = {"size_gb": calculate_model_size(model), "tokens_per_second": max_tokens / elapsed}
+        if reference_log_probs is None:
+            reference_log_probs = log_probs
+        else:
+            result["top1_agreement"] = (log_probs.argmax(-1) == reference_log_probs.argmax(-1)).float().mean().item()
+            result["kl_divergence"] = F.kl_div(log_probs, reference_log_probs, log_target=True, reduction="batchmean").item()
+        results[mode] = result
+        print(f"{mode}: {result}")
+        del model
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare memory, speed and quality drift across quantization modes.")
+    parser.add_argument("--model", default=Config.MODEL_NAME)
+    parser.add_argument("--modes", nargs="+", default=list(QUANTIZATION_MODES), choices=QUANTIZATION_MODES)
+    parser.add_argument("--prompt", default="The capital of France is Paris. It is known for the Eiffel Tower, the Louvre, and its cafes.")
+    parser.add_argument("--max-tokens", type=int, default=32)
+    args = parser.parse_args()
+    print(json.dumps(benchmark(args.model, args.modes, args.prompt, args.max_tokens), indent=2))
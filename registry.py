@@ -0,0 +1,237 @@
+import asyncio
+import gc
+import time
+import torch
+from fastapi import HTTPException
+from typing import AsyncGenerator, Callable, Dict, List, Optional
+from config import Config
+from metrics import register_schedulers
+from processor import InputProcessor, create_input_processor
+from quantization import linear_weight_bits, load_dtype
+from scheduler import Scheduler
+from utils import calculate_model_size, estimate_model_size, get_available_memory, get_available_vram
+
+class ServedModel:
+    """
+    A resident model: its input processor (and scheduler), the memory it holds, and how many requests are using it.
+    """
+    def __init__(self, name: str, input_processor: InputProcessor, memory_gb: float):
+        self.name = name
+        self.input_processor = input_processor
+        self.memory_gb = memory_gb
+        self.in_flight = 0
+        self.last_used = time.monotonic()
+        self.idle = asyncio.Event()  # set while no request is using the model
+        self.idle.set()
+
+class ModelRegistry:
+    """
+    Serves MODEL_NAME and every model in MODELS from one process, routing each request by its model field.
+
+    MODEL_NAME is loaded at startup and the others the first time they are asked for, each with its own scheduler and KV
+    cache pool (weights are memory-mapped from their safetensors files, see ModelManager.load_model). When loading a
+    model would take the resident models past the memory budget, the least recently used ones are unloaded first, as
+    soon as their in-flight requests have finished. A request for an unloaded model loads it again.
+
+    reload() swaps a model for a freshly loaded copy without a restart: new requests go to the new copy straight away,
+    while the old one finishes its in-flight requests and is then unloaded.
+
+    With NUM_WORKERS above 1, worker processes are forked when a model starts. Forking is only safe at startup, before
+    any inference or image threads exist, so that mode serves MODEL_NAME alone and can't reload or unload it.
+    """
+    def __init__(
+        self,
+        default_model: str = Config.MODEL_NAME,
+        models: List[str] = Config.MODELS,
+        memory_gb: float = Config.MODEL_MEMORY_GB,
+        max_kv_cache_gb: float = Config.MODEL_KV_CACHE_GB
+    ):
+        self.default_model = default_model
+        self.served = [default_model] + [model for model in models if model != default_model]
+        if len(self.served) > 1 and Config.NUM_WORKERS > 1:
+            raise ValueError("NUM_WORKERS above 1 can only serve MODEL_NAME, since worker processes can't be safely forked for models loaded later.")
+        if len(self.served) > 1 and max_kv_cache_gb <= 0:
+            raise ValueError("Set MODEL_KV_CACHE_GB when serving several models, otherwise every model's KV cache pool takes all the free memory.")
+        self.max_kv_cache_gb = max_kv_cache_gb
+        self.memory_gb = memory_gb or get_available_vram() or get_available_memory()
+        self.models: Dict[str, ServedModel] = {}
+        self.retiring: List[ServedModel] = []  # evicted or replaced models still finishing their requests
+        self._lock = asyncio.Lock()  # serializes loading and unloading
+        self.models[default_model] = self._load(default_model)
+        register_schedulers(self.schedulers)
+
+    def start(self):
+        for served in self.models.values():
+            served.input_processor.scheduler.start()
+
+    async def stop(self):
+        for served in list(self.models.values()) + self.retiring:
+            served.input_processor.scheduler.stop()
+            await served.input_processor.close()
+        self.models = {}
+        self.retiring = []
+
+    def resolve(self, model_name: str) -> str:
+        """
+        Returns the served model a request's model field refers to. A server with a single model answers every request
+        with it, whatever the model field says.
+        """
+        if model_name in self.served:
+            return model_name
+        if len(self.served) == 1:
+            return self.default_model
+        raise HTTPException(status_code=404, detail=f"Model {model_name} is not served here. Served models: {', '.join(self.served)}")
+
+    async def generate(self, model_name: str, generate: Callable[[InputProcessor], AsyncGenerator]) -> AsyncGenerator:
+        """
+        Streams generate(input_processor) on the model, loading it first if it isn't resident. The model isn't unloaded
+        until the stream ends.
+        """
+        served = await self.acquire(model_name)
+        try:
+            async for item in generate(served.input_processor):
+                yield item
+        finally:
+            self.release(served)
+
+    async def acquire(self, model_name: str) -> ServedModel:
+        """
+        Returns the resident model, loading it if needed, and counts one more request as using it. Pair with release().
+        """
+        model_name = self.resolve(model_name)
+        served = self.models.get(model_name)
+        if served is None:
+            async with self._lock:
+                served = self.models.get(model_name)
+                if served is None:
+                    served = await self._load_in_background(model_name)
+                    self.models[model_name] = served
+        served.in_flight += 1
+        served.idle.clear()
+        served.last_used = time.monotonic()
+        return served
+
+    def release(self, served: ServedModel):
+        served.in_flight -= 1
+        if served.in_flight == 0:
+            served.idle.set()
+
+    async def reload(self, model_name: str):
+        """
+        Hot swaps the model for a freshly loaded copy (e.g. after its weights were updated). The old copy is unloaded once
+        its in-flight requests finish.
+        """
+        model_name = self.resolve(model_name)
+        self._check_can_swap()
+        async with self._lock:
+            old = self.models.get(model_name)
+            self.models[model_name] = await self._load_in_background(model_name, keep=old)
+        if old is not None:
+            asyncio.create_task(self._retire(old))
+
+    async def unload(self, model_name: str):
+        """
+        Unloads the model once its in-flight requests finish. New requests for it load it again.
+        """
+        model_name = self.resolve(model_name)
+        self._check_can_swap()
+        async with self._lock:
+            served = self.models.get(model_name)
+            if served is not None:
+                await self._retire(served)
+
+    def _check_can_swap(self):
+        if Config.NUM_WORKERS > 1:
+            raise HTTPException(status_code=400, detail="Models can't be reloaded or unloaded with NUM_WORKERS above 1, since worker processes are only forked at startup.")
+
+    def resident_gb(self) -> float:
+        return sum(served.memory_gb for served in list(self.models.values()) + self.retiring)
+
+    def schedulers(self) -> List[Scheduler]:
+        """
+        Returns the in-process schedulers of every resident model (worker pools keep theirs in the worker processes).
+        """
+        processors = [served.input_processor for served in list(self.models.values()) + self.retiring]
+        return [processor.scheduler for processor in processors if isinstance(processor.scheduler, Scheduler)]
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "served_models": self.served,
+            "memory_budget_gb": self.memory_gb,
+            "resident_gb": self.resident_gb(),
+            "models": {
+                name: {
+                    **served.input_processor.stats(),
+                    "memory_gb": served.memory_gb,
+                    "in_flight": served.in_flight,
+                    "idle_seconds": now - served.last_used if served.in_flight == 0 else 0
+                }
+                for name, served in list(self.models.items())
+            }
+        }
+
+    async def _load_in_background(self, model_name: str, keep: Optional[ServedModel] = None) -> ServedModel:
+        """
+        Sizes the model and makes room for it, then loads and starts it, all on threads so the event loop keeps serving the
+        resident models meanwhile (sizing may have to ask the Huggingface hub). Called with the lock held.
+        """
+        loop = asyncio.get_running_loop()
+
+        def load() -> ServedModel:
+            served = self._load(model_name)
+            served.input_processor.scheduler.start()
+            return served
+        try:
+            await self._make_room(await loop.run_in_executor(None, self._estimate_gb, model_name), keep)
+            print(f"Loading model {model_name}")
+            return await loop.run_in_executor(None, load)
+        except ValueError as e:  # the model couldn't be sized, or the resource check found it doesn't fit
+            raise HTTPException(status_code=503, detail=f"Could not load model {model_name}: {e}", headers={"Retry-After": "10"})
+
+    def _load(self, model_name: str) -> ServedModel:
+        input_processor = create_input_processor(model_name, self.max_kv_cache_gb)
+        model_manager = input_processor.model_manager
+        memory_gb = calculate_model_size(model_manager.get_model()) + self._cache_gb()
+        if model_manager.get_draft_model() is not None:
+            memory_gb += calculate_model_size(model_manager.get_draft_model())
+        return ServedModel(model_name, input_processor, memory_gb)
+
+    def _estimate_gb(self, model_name: str) -> float:
+        """
+        Sizes a model before loading it, from its safetensors headers (or its config).
+        """
+        weights_gb = estimate_model_size(model_name, load_dtype(Config.QUANTIZATION_MODE), linear_weight_bits(Config.QUANTIZATION_MODE))
+        return weights_gb + self._cache_gb()
+
+    def _cache_gb(self) -> float:
+        return self.max_kv_cache_gb + Config.PREFIX_CACHE_MAX_GB * Config.NUM_WORKERS
+
+    async def _make_room(self, needed_gb: float, keep: Optional[ServedModel] = None):
+        """
+        Unloads the least recently used models (other than keep) until needed_gb more fits in the memory budget.
+        """
+        while self.resident_gb() + needed_gb > self.memory_gb:
+            candidates = [served for served in self.models.values() if served is not keep]
+            if not candidates:
+                break  # nothing left to unload, the resource check decides whether it still fits
+            victim = min(candidates, key=lambda served: served.last_used)
+            print(f"Unloading model {victim.name} to make room ({self.resident_gb():.2f} GB resident, {needed_gb:.2f} GB needed, {self.memory_gb:.2f} GB budget)")
+            await self._retire(victim)
+
+    async def _retire(self, served: ServedModel):
+        """
+        Stops routing requests to the model, waits for its in-flight requests to finish, then frees it.
+        """
+        if self.models.get(served.name) is served:
+            del self.models[served.name]
+        self.retiring.append(served)
+        await served.idle.wait()
+        await asyncio.get_running_loop().run_in_executor(None, served.input_processor.scheduler.stop)
+        await served.input_processor.close()
+        self.retiring.remove(served)
+        served.input_processor = None
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        print(f"Unloaded model {served.name}")
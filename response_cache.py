@@ -0,0 +1,152 @@
+import hashlib
+import json
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+from llama_models.llama3.api.datatypes import ImageMedia, URL
+from config import Config
+from sampling import SamplingOptions
+from utils import model_revision
+
+class ResponseCache:
+    """
+    Caches the streamed text of deterministic requests (greedy, or sampled with a seed), along with their stop reason and
+    token counts, so an exact repeat is replayed chunk by chunk without touching the model.
+
+    Keys are a hash of everything that decides the output: the model and draft model and the exact weights they were
+    loaded from (see model_revision), the quantization mode, the request's content or messages, max_tokens, stop strings
+    and stop token IDs and sampling options. So once a model's weights are updated (and it is reloaded or the server
+    restarted), responses cached for the old weights are never replayed. Entries live in an in-memory LRU and expire after
+    ttl seconds. With a path, they are also written to a sqlite file, so they survive restarts and can outgrow memory.
+    """
+    def __init__(
+        self,
+        max_entries: int = Config.RESPONSE_CACHE_SIZE,
+        ttl: float = Config.RESPONSE_CACHE_TTL,
+        path: str = Config.RESPONSE_CACHE_PATH,
+        model_name: str = Config.MODEL_NAME,
+        draft_model_name: str = Config.DRAFT_MODEL_NAME
+    ):
+        self.model_name = model_name
+        self.draft_model_name = draft_model_name
+        self.revision = _revision(model_name, draft_model_name) if max_entries > 0 else ""
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: OrderedDict = OrderedDict()  # key -> (expiry time, chunks, result)
+        self.hits = 0
+        self.misses = 0
+        self.db = None
+        if path and self.enabled():
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, expires_at REAL, chunks TEXT, result TEXT)")
+            self.db.execute("DELETE FROM completions WHERE expires_at < ?", (time.time(),))
+            self.db.commit()
+
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def key(
+        self,
+        kind: str,
+        prompt,
+        max_tokens: int,
+        sampling: SamplingOptions,
+        stop: Optional[List[str]],
+        stop_token_ids: Optional[List[int]] = None
+    ) -> Optional[str]:
+        """
+        Returns the cache key for a request, or None if it can't be cached: its output isn't deterministic, or it has
+        inline images (hashing their pixels would cost more than it saves).
+        """
+        if not self.enabled() or not (sampling.greedy or sampling.seed is not None):
+            return None
+        if kind == "chat":
+            messages = []
+            for message in prompt:
+                context = getattr(message, "context", None)
+                normalized = {"role": message.role, "content": _normalize(message.content), "context": _normalize(context)}
+                if normalized["content"] is None or (context is not None and normalized["context"] is None):
+                    return None
+                messages.append(normalized)
+            prompt = messages
+        else:
+            prompt = _normalize(prompt)
+            if prompt is None:
+                return None
+        request = {
+            "model": self.model_name,
+            "quantization": Config.QUANTIZATION_MODE,
+            "draft_model": self.draft_model_name,
+            "revision": self.revision,
+            "kind": kind,
+            "prompt": prompt,
+            "max_tokens": max_tokens,
+            "stop": stop,
+            "stop_token_ids": stop_token_ids,
+            "sampling": vars(sampling)
+        }
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[List[str], dict]]:
+        """
+        Returns the cached chunks and result (stop reason and token counts) of a request, or None.
+        """
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry is None and self.db is not None:
+            row = self.db.execute("SELECT expires_at, chunks, result FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                entry = (row[0], json.loads(row[1]), json.loads(row[2]))
+                self._remember(key, entry)
+        if entry is not None and entry[0] < now:
+            del self.entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1], entry[2]
+
+    def put(self, key: str, chunks: List[str], result: dict):
+        entry = (time.time() + self.ttl, chunks, result)
+        self._remember(key, entry)
+        if self.db is not None:
+            self.db.execute("INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?)", (key, entry[0], json.dumps(chunks), json.dumps(result)))
+            self.db.commit()
+
+    def _remember(self, key: str, entry: tuple):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+def _revision(*model_names) -> str:
+    revisions = []
+    for model_name in filter(None, model_names):
+        revision = model_revision(model_name)
+        # weights that can't be told apart are only trusted for as long as this copy of the model is loaded
+        revisions.append(revision if revision is not None else f"loaded at {time.time()}")
+    return ",".join(revisions)
+
+def _normalize(content):
+    """
+    Turns interleaved content into plain JSON for hashing, or returns None if it holds an inline image.
+    """
+    if content is None or isinstance(content, str):
+        return content
+    normalized = []
+    for item in (content if isinstance(content, list) else [content]):
+        if isinstance(item, str):
+            normalized.append(item)
+        elif isinstance(item, ImageMedia) and isinstance(item.image, (URL, str)):
+            normalized.append({"image": item.image.uri if isinstance(item.image, URL) else item.image})
+        else:
+            return None
+    return normalized
@@ -0,0 +1,129 @@
+import torch
+from typing import List, Optional
+from llama_models.llama3.api.datatypes import SamplingParams, SamplingStrategy
+from config import Config
+
+class SamplingOptions:
+    """
+    Per-request sampling settings, resolved from Llama Stack's SamplingParams.
+    A temperature of 0 means greedy decoding (always take the most likely token).
+    """
+    def __init__(
+        self,
+        temperature: float = Config.DEFAULT_TEMPERATURE,
+        top_k: int = 0,
+        top_p: float = 1.0,
+        min_p: float = 0.0,
+        repetition_penalty: float = 1.0,
+        seed: Optional[int] = None
+    ):
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.min_p = min_p
+        self.repetition_penalty = repetition_penalty
+        self.seed = seed
+
+    @property
+    def greedy(self) -> bool:
+        return self.temperature <= 0
+
+    @classmethod
+    def from_sampling_params(cls, params: SamplingParams) -> "SamplingOptions":
+        """
+        Follows the Llama Stack strategy semantics: greedy ignores temperature, top_p only applies nucleus filtering and
+        top_k only applies top-k filtering. min_p and seed are picked up if the client's SamplingParams carries them.
+        """
+        temperature = params.temperature if params.temperature is not None else Config.DEFAULT_TEMPERATURE
+        if params.strategy == SamplingStrategy.greedy:
+            temperature = 0
+        return cls(
+            temperature=temperature,
+            top_k=(params.top_k or 0) if params.strategy == SamplingStrategy.top_k else 0,
+            top_p=(params.top_p or 1.0) if params.strategy == SamplingStrategy.top_p else 1.0,
+            min_p=getattr(params, "min_p", None) or 0.0,
+            repetition_penalty=params.repetition_penalty or 1.0,
+            seed=getattr(params, "seed", None)
+        )
+
+def sample(logits: torch.Tensor, sequences: list) -> List[int]:
+    """
+    Picks the next token for every row of a [batch, vocab] logits tensor in one vectorized pass.
+    Each row uses its sequence's sampling options, repetition penalty history (sequence.seen_tokens) and, for seeded
+    requests, its own random generator (sequence.generator). When every row is greedy this is a single argmax.
+    """
+    logits = logits.float()
+    options = [sequence.sampling for sequence in sequences]
+    apply_repetition_penalty(logits, sequences)
+
+    tokens = logits.argmax(dim=-1)
+    sampled_rows = [row for row, option in enumerate(options) if not option.greedy]
+    if not sampled_rows:
+        return tokens.tolist()
+
+    index = torch.tensor(sampled_rows, device=logits.device)
+    probs = probabilities(logits.index_select(0, index), [options[row] for row in sampled_rows])
+
+    unseeded = [i for i, row in enumerate(sampled_rows) if sequences[row].generator is None]
+    if unseeded:
+        unseeded_index = torch.tensor(unseeded, device=logits.device)
+        sampled = torch.multinomial(probs.index_select(0, unseeded_index), num_samples=1).squeeze(-1)
+        tokens.index_copy_(0, index.index_select(0, unseeded_index), sampled)
+    for i, row in enumerate(sampled_rows):
+        if sequences[row].generator is not None:
+            tokens[row] = torch.multinomial(probs[i], num_samples=1, generator=sequences[row].generator)[0]
+    return tokens.tolist()
+
+def probabilities(logits: torch.Tensor, options: List[SamplingOptions]) -> torch.Tensor:
+    """
+    Turns [batch, vocab] logits into the distribution each row's options sample from: temperature, then top-k, top-p
+    and min-p filtering. Greedy rows come out one-hot. Modifies logits in place.
+    """
+    vocab_size = logits.shape[-1]
+    device = logits.device
+    greedy = torch.tensor([option.greedy for option in options], device=device)
+    temperatures = torch.tensor([1.0 if option.greedy else option.temperature for option in options], device=device)
+    logits.div_(temperatures.unsqueeze(-1))
+
+    top_ks = [option.top_k for option in options]
+    top_ps = [option.top_p for option in options]
+    if any(0 < k < vocab_size for k in top_ks) or any(p < 1.0 for p in top_ps):
+        # one sort serves both top-k and top-p
+        sorted_logits, sorted_index = logits.sort(dim=-1, descending=True)
+        positions = torch.arange(vocab_size, device=device).unsqueeze(0)
+        if any(0 < k < vocab_size for k in top_ks):
+            ks = torch.tensor([k if k > 0 else vocab_size for k in top_ks], device=device).unsqueeze(-1)
+            sorted_logits.masked_fill_(positions >= ks, float("-inf"))
+        if any(p < 1.0 for p in top_ps):
+            sorted_probs = sorted_logits.softmax(dim=-1)
+            # drop a token once the tokens ranked above it already cover top_p (the top token always stays)
+            outside_nucleus = (sorted_probs.cumsum(dim=-1) - sorted_probs) > torch.tensor(top_ps, device=device).unsqueeze(-1)
+            sorted_logits.masked_fill_(outside_nucleus, float("-inf"))
+        logits.scatter_(-1, sorted_index, sorted_logits)
+
+    probs = logits.softmax(dim=-1)
+    min_ps = [option.min_p for option in options]
+    if any(p > 0 for p in min_ps):
+        threshold = probs.max(dim=-1, keepdim=True).values * torch.tensor(min_ps, device=device).unsqueeze(-1)
+        probs.masked_fill_(probs < threshold, 0)
+        probs.div_(probs.sum(dim=-1, keepdim=True))
+
+    if greedy.any():
+        one_hot = torch.zeros_like(probs).scatter_(-1, probs.argmax(dim=-1, keepdim=True), 1.0)
+        probs = torch.where(greedy.unsqueeze(-1), one_hot, probs)
+    return probs
+
+def apply_repetition_penalty(logits: torch.Tensor, sequences: list):
+    """
+    Penalizes every token a sequence has already seen (prompt or output), the same way HF transformers does:
+    positive logits are divided by the penalty and negative ones multiplied. Modifies logits in place.
+    """
+    rows = [row for row, sequence in enumerate(sequences) if sequence.seen_tokens is not None]
+    if not rows:
+        return
+    index = torch.tensor(rows, device=logits.device)
+    penalties = torch.tensor([sequences[row].sampling.repetition_penalty for row in rows], device=logits.device).unsqueeze(-1)
+    seen = torch.stack([sequences[row].seen_tokens for row in rows])
+    selected = logits.index_select(0, index)
+    penalized = torch.where(selected > 0, selected / penalties, selected * penalties)
+    logits.index_copy_(0, index, torch.where(seen, penalized, selected))
@@ -0,0 +1,724 @@
+import asyncio
+import itertools
+import threading
+import time
+import torch
+from collections import deque
+from fastapi import HTTPException
+from typing import AsyncGenerator, List, Optional
+from config import Config
+from detokenizer import IncrementalDetokenizer
+from kv_cache import BlockAllocator, append_mask_column, cache_length, merge_caches, padded_batch_tokens, select_rows, to_legacy_cache, to_model_cache
+from metrics import DECODE_TOKENS, INTER_TOKEN_LATENCY, PREFILL_TOKENS, TIME_TO_FIRST_TOKEN, Trace
+from model import ModelManager
+from prefix_cache import PrefixCache
+from sampling import SamplingOptions, sample
+from speculative import SpeculativeDecoder
+
+PADDING_SEQ_ID = -1  # block table holding the running batch's padding, on top of what its sequences own
+
+class GenerationResult:
+    """
+    How a generation ended and how many tokens it took, filled in by the scheduler when the sequence finishes.
+    """
+    def __init__(self):
+        self.stop_reason: Optional[str] = None  # "stop" (end of sequence token, stop token or stop string) or "length" (max_tokens)
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached = False  # replayed from the response cache instead of generated
+
+    def usage(self) -> dict:
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.prompt_tokens + self.completion_tokens
+        }
+
+class Sequence:
+    """
+    A single generation request tracked by the scheduler, from prefill until it finishes.
+    Generated text is pushed onto its own asyncio queue, from the worker thread, so each request streams back through
+    its own async generator on the event loop.
+    """
+    _ids = itertools.count()
+
+    def __init__(
+        self,
+        model_inputs: dict,
+        max_tokens: int,
+        sampling: SamplingOptions,
+        stop: Optional[List[str]] = None,
+        stop_token_ids: Optional[List[int]] = None,
+        trace: Optional[Trace] = None,
+        result: Optional[GenerationResult] = None
+    ):
+        self.seq_id = next(Sequence._ids)
+        self.model_inputs = model_inputs
+        self.max_tokens = max_tokens
+        self.sampling = sampling
+        self.stop = stop
+        self.stop_token_ids = set(stop_token_ids or [])
+        self.trace = trace
+        self.result = result if result is not None else GenerationResult()
+        self.arrival_time = time.perf_counter()
+        self.last_token_time = 0.0
+        self.detokenizer: Optional[IncrementalDetokenizer] = None
+        self.generator: Optional[torch.Generator] = None  # only for seeded requests
+        self.seen_tokens: Optional[torch.Tensor] = None  # [vocab] mask of prompt and output tokens, only with a repetition penalty
+        self.prompt_len = model_inputs["input_ids"].shape[1] if "input_ids" in model_inputs else 0
+        self.output_ids: List[int] = []
+        self.past_len = 0  # number of real (non padding) positions held in the KV cache
+        self.prefilled = 0  # prompt tokens already in the KV cache, while a long prompt is prefilled chunk by chunk
+        self.past = None  # the sequence's own KV caches, only used while prefilling in chunks or speculative decoding
+        self.draft_past = None
+        self.draft_pending: List[int] = []
+        self.finished = False
+        self.cancelled = False
+        self.loop = asyncio.get_running_loop()
+        self.outputs: asyncio.Queue = asyncio.Queue()
+
+    def emit(self, token_str: str):
+        self.loop.call_soon_threadsafe(self.outputs.put_nowait, token_str)
+
+    def finish(self, error: Optional[Exception] = None, stop_reason: Optional[str] = None):
+        self.finished = True
+        self.result.stop_reason = stop_reason
+        self.result.prompt_tokens = self.prompt_len
+        self.result.completion_tokens = len(self.output_ids)
+        if self.trace is not None:
+            self.trace.attributes.update(prompt_tokens=self.prompt_len, output_tokens=len(self.output_ids), error=repr(error) if error else None)
+            self.trace.finish()
+        self.loop.call_soon_threadsafe(self.outputs.put_nowait, error)
+
+    def cancel(self):
+        """
+        Asks the worker to stop generating for this sequence. It is dropped at the start of the next step.
+        """
+        self.cancelled = True
+
+    async def stream(self) -> AsyncGenerator[str, None]:
+        """
+        Yields the sequence's text as the worker produces it.
+        If the consumer goes away early (e.g. the client disconnected), generation is cancelled mid-stream.
+        """
+        try:
+            while True:
+                item = await self.outputs.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            if not self.finished:
+                self.cancel()
+
+class Scheduler:
+    """
+    Continuous (iteration-level) batching scheduler.
+    Keeps one running batch with a left padded KV cache. At every decode step, waiting sequences are prefilled and
+    admitted into the batch, and finished sequences are retired, so the model always runs one batched forward pass per step.
+
+    All model work happens on a dedicated worker thread that owns the model, so the event loop stays free for other
+    requests, health checks and new connections. PyTorch releases the GIL inside its kernels, so a thread is enough here.
+
+    KV cache memory is reserved from the block allocator when a sequence is admitted, so when memory runs low new
+    sequences wait in the queue rather than running the process out of memory. Every row of the batched cache is as long
+    as the longest one, so besides each sequence's own tokens, admission also reserves the padding the batch will need at
+    its peak (see padded_batch_tokens) plus room for copying one layer while the cache is rebuilt.
+
+    When a draft model is loaded and at most speculative_max_batch_size sequences are decoding, new text-only sequences
+    are decoded speculatively instead, each with its own KV caches. Speculation steps sequences one at a time, so once
+    the batch grows past that size the speculating sequences join the running batch.
+
+    Each step prefills at most max_prefill_tokens prompt tokens. Text-only prompts longer than prefill_chunk_size are
+    prefilled prefill_chunk_size tokens per step, so a long prompt delays the running sequences' next tokens by one chunk
+    at a time rather than by its whole prefill.
+
+    With COMPILE_DECODE, decode steps run through the compiled model, which treats the batch size and cache length as
+    dynamic, so neither admissions nor growing sequences recompile it. The decode inputs are written into buffers
+    allocated once, and the attention mask grows in place.
+    """
+    def __init__(
+        self,
+        model_manager: ModelManager,
+        block_allocator: BlockAllocator,
+        max_batch_size: int = Config.MAX_BATCH_SIZE,
+        max_queue_depth: int = Config.MAX_QUEUE_DEPTH,
+        prefill_chunk_size: int = Config.PREFILL_CHUNK_SIZE,
+        max_prefill_tokens: int = Config.MAX_PREFILL_TOKENS_PER_STEP,
+        max_context_len: int = 0,
+        speculative_max_batch_size: int = Config.SPECULATIVE_MAX_BATCH_SIZE
+    ):
+        if prefill_chunk_size < 1 or max_prefill_tokens < 1:
+            raise ValueError("PREFILL_CHUNK_SIZE and MAX_PREFILL_TOKENS_PER_STEP must be at least 1.")
+        self.model_manager = model_manager
+        self.block_allocator = block_allocator
+        self.max_batch_size = max_batch_size
+        self.max_queue_depth = max_queue_depth
+        self.prefill_chunk_size = prefill_chunk_size
+        self.max_prefill_tokens = max_prefill_tokens
+        self.max_context_len = max_context_len  # the model's position limit, 0 for none
+        self.speculative_max_batch_size = speculative_max_batch_size
+        self.eos_token_ids = model_manager.get_eos_token_ids()
+        self.waiting: deque = deque()  # shared with the event loop, guarded by self._condition
+        self.running: List[Sequence] = []  # only touched by the worker thread
+        self.speculating: List[Sequence] = []  # sequences decoded speculatively, outside the running batch
+        self.prefilling: List[Sequence] = []  # admitted sequences whose prompts are being prefilled chunk by chunk
+        self.admitting: List[Sequence] = []  # taken off the queue by the current step, so a failed step can finish them
+        self.past = None  # batched KV cache of the running sequences, one row per sequence
+        self.attention_mask: Optional[torch.Tensor] = None  # [batch, cache_len], 0 marks left padding
+        device = model_manager.get_device()
+        # reused by every decode step, so the compiled graph always sees the same input buffers
+        self.decode_input_ids = torch.zeros(max_batch_size, 1, dtype=torch.long, device=device)
+        self.decode_position_ids = torch.zeros(max_batch_size, 1, dtype=torch.long, device=device)
+        self.prefix_cache = PrefixCache()
+        self.speculative_decoder = SpeculativeDecoder(model_manager) if model_manager.get_draft_model() is not None else None
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """
+        Warms the model up and compiles the decode step (if WARMUP is set), then starts the worker thread.
+        """
+        if Config.WARMUP:
+            self.model_manager.warmup()
+            self.model_manager.warmup_decode()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="inference-worker", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def add_request(
+        self,
+        model_inputs: dict,
+        max_tokens: int,
+        sampling: SamplingOptions,
+        stop: Optional[List[str]] = None,
+        stop_token_ids: Optional[List[int]] = None,
+        trace: Optional[Trace] = None,
+        result: Optional[GenerationResult] = None
+    ) -> Sequence:
+        """
+        Queues a request for the worker. Raises a 503 instead of queueing when the server is already saturated.
+        Generation ends at the model's end of sequence tokens, any of stop_token_ids, any of the stop strings or after
+        max_tokens, and result (if given) is filled in with why and how many tokens it took.
+        """
+        sequence_tokens = (model_inputs["input_ids"].shape[1] if "input_ids" in model_inputs else 0) + max_tokens
+        if self.max_context_len and sequence_tokens > self.max_context_len:
+            raise HTTPException(status_code=400, detail=f"Request needs {sequence_tokens} tokens of context (prompt plus max_tokens), but the model supports {self.max_context_len}.")
+        if self.block_allocator.blocks_needed(sequence_tokens + sequence_tokens // self.block_allocator.num_layers) > self.block_allocator.num_blocks:
+            raise HTTPException(status_code=400, detail=f"Request needs KV cache for {sequence_tokens} tokens, which is more than this server can hold.")
+
+        with self._condition:
+            if len(self.waiting) >= self.max_queue_depth:
+                raise HTTPException(status_code=503, detail="Server is overloaded, please retry later.", headers={"Retry-After": "1"})
+            sequence = Sequence(model_inputs, max_tokens, sampling, stop, stop_token_ids, trace, result)
+            self.waiting.append(sequence)
+            self._condition.notify()
+        return sequence
+
+    def stats(self) -> dict:
+        """
+        Returns a snapshot of the scheduler's queues and caches.
+        """
+        stats = {
+            "waiting": len(self.waiting),
+            "running": len(self.running) + len(self.speculating),
+            "prefilling": len(self.prefilling),
+            "kv_cache_blocks_used": self.block_allocator.used_blocks(),
+            "kv_cache_blocks_total": self.block_allocator.num_blocks,
+            "prefix_cache": self.prefix_cache.stats()
+        }
+        if self.speculative_decoder is not None:
+            stats["speculative_decoding"] = self.speculative_decoder.stats()
+        return stats
+
+    def _run(self):
+        """
+        Worker thread loop. Sleeps while there is nothing to do, otherwise steps the batch as fast as the model allows.
+        """
+        while True:
+            with self._condition:
+                while not self._stopped and not self.waiting and not self.running and not self.speculating and not self.prefilling:
+                    self._condition.wait()
+                if self._stopped:
+                    break
+            try:
+                self.step()
+            except Exception as e:
+                # the batch may be half updated, so every sequence in it fails and the worker starts over from an empty batch
+                print(f"Scheduler step failed: {e}")
+                self._fail_all(e)
+
+        shutting_down = HTTPException(status_code=503, detail="Server is shutting down.")
+        self._fail_all(shutting_down)
+        with self._condition:
+            waiting, self.waiting = list(self.waiting), deque()
+        for sequence in waiting:
+            sequence.finish(shutting_down)
+
+    def _fail_all(self, error: Exception):
+        """
+        Finishes every admitted sequence with error, frees their blocks and the padding reservation, and empties the batch.
+        """
+        for sequence in self.running + self.speculating + self.prefilling + self.admitting:
+            if not sequence.finished:
+                sequence.finish(error)
+            sequence.past, sequence.draft_past = None, None
+            self.block_allocator.free(sequence.seq_id)
+        self.block_allocator.free(PADDING_SEQ_ID)
+        self.running = []
+        self.speculating = []
+        self.prefilling = []
+        self.admitting = []
+        self.past = None
+        self.attention_mask = None
+
+    def step(self):
+        """
+        Drops cancelled sequences, admits as many waiting sequences as the batch, the KV cache pool and the step's prefill
+        token budget have room for, prefills the next chunks of long prompts, then runs one decode step for the whole batch.
+        """
+        self._retire([row for row, sequence in enumerate(self.running) if not sequence.cancelled])
+        for sequence in self.speculating + self.prefilling:
+            if sequence.cancelled:
+                self.block_allocator.free(sequence.seq_id)
+        self.speculating = [sequence for sequence in self.speculating if not sequence.cancelled]
+        self.prefilling = [sequence for sequence in self.prefilling if not sequence.cancelled]
+
+        self.block_allocator.resize(PADDING_SEQ_ID, self._padding_tokens([]))  # give back what cancelled sequences needed
+
+        # prompts already being prefilled get their next chunks first, so a stream of short prompts can't starve them
+        reserved = sum(min(self.prefill_chunk_size, sequence.prompt_len - sequence.prefilled) for sequence in self.prefilling)
+        admitted = self.admitting = []
+        while len(self.running) + len(self.speculating) + len(self.prefilling) + len(admitted) < self.max_batch_size:
+            with self._condition:
+                if not self.waiting:
+                    break
+                sequence = self.waiting[0]
+                if not sequence.cancelled:
+                    padding = self._padding_tokens(admitted + [sequence])
+                    needed = self.block_allocator.blocks_needed(sequence.prompt_len + sequence.max_tokens) + max(self.block_allocator.blocks_to_resize(PADDING_SEQ_ID, padding), 0)
+                    if needed > len(self.block_allocator.free_blocks):
+                        break  # defer admission until running sequences give their blocks back
+                cost = min(sequence.prompt_len, self.prefill_chunk_size)
+                if not sequence.cancelled and (reserved or admitted) and reserved + cost > self.max_prefill_tokens:
+                    break  # this step's prefill budget is spent
+                self.waiting.popleft()
+            if sequence.cancelled:
+                continue
+            self.block_allocator.allocate(sequence.seq_id, sequence.prompt_len + sequence.max_tokens)
+            self.block_allocator.resize(PADDING_SEQ_ID, padding)
+            admitted.append(sequence)
+            reserved += cost
+        prefilled = self._prefill(admitted) if admitted else 0
+        if self.prefilling:
+            self._prefill_chunks(self.max_prefill_tokens - prefilled)
+
+        if self.speculating and len(self.running) + len(self.speculating) > self.speculative_max_batch_size:
+            self._stop_speculating()
+        if self.speculating:
+            self._speculate()
+        if self.running:
+            try:
+                self._decode()
+            except Exception as e:
+                for sequence in self.running:
+                    sequence.finish(e)
+                    self.block_allocator.free(sequence.seq_id)
+                self.running = []
+                self.past = None
+                self.attention_mask = None
+        self.block_allocator.resize(PADDING_SEQ_ID, self._padding_tokens([]))
+        self.admitting = []
+
+    def _padding_tokens(self, admitted: List[Sequence]) -> int:
+        """
+        How many tokens of KV cache the running batch needs beyond what its sequences own, once the speculating,
+        prefilling and newly admitted sequences have joined it: the padding at its peak, plus one layer's worth for the copy made when rows
+        are merged, selected or grown.
+        """
+        joining = self.prefilling + admitted
+        rows = [(cache_length(self.past), sequence.max_tokens - len(sequence.output_ids)) for sequence in self.running]
+        rows += [(cache_length(sequence.past), sequence.max_tokens - len(sequence.output_ids)) for sequence in self.speculating]
+        rows += [(sequence.prompt_len, sequence.max_tokens) for sequence in joining]
+        owned = sum(sequence.prompt_len + sequence.max_tokens for sequence in self.running + self.speculating + joining)
+        peak = padded_batch_tokens(rows)
+        return max(peak - owned, 0) + peak // self.block_allocator.num_layers
+
+    def _prefill(self, sequences: List[Sequence]):
+        """
+        Runs the newly admitted prompts through the model, samples their first tokens, and merges them into the running batch.
+        Text-only prompts are prefilled together in one left padded forward pass. A prompt that starts with a cached
+        prefix only prefills its unseen suffix, and prompts with images are prefilled on their own. Text-only prompts
+        with more than prefill_chunk_size tokens left to prefill are only queued for _prefill_chunks.
+        Returns the number of prompt tokens prefilled.
+        """
+        batch = []
+        prefilled = 0
+        for sequence in sequences:
+            if sequence.trace is not None:
+                sequence.trace.add_span("queued", sequence.arrival_time, time.perf_counter())
+            prompt_ids = sequence.model_inputs.get("input_ids")
+            cached_len, cached_past = 0, None
+            if self.prefix_cache.enabled() and self._is_text_only(sequence):
+                cached_len, cached_past = self.prefix_cache.lookup(prompt_ids[0].tolist())
+            if self._is_text_only(sequence) and sequence.prompt_len - cached_len > self.prefill_chunk_size:
+                sequence.past, sequence.prefilled = cached_past, cached_len
+                self.prefilling.append(sequence)
+                continue
+            if cached_past is None and self._is_text_only(sequence):
+                batch.append(sequence)
+                continue
+            prefilled += sequence.prompt_len - cached_len
+            try:
+                self._prefill_one(sequence, cached_len, cached_past)
+            except Exception as e:
+                sequence.finish(e)
+                self.block_allocator.free(sequence.seq_id)
+
+        if batch:
+            prefilled += sum(sequence.prompt_len for sequence in batch)
+            try:
+                self._prefill_batch(batch)
+            except Exception as e:
+                for sequence in batch:
+                    if not sequence.finished:
+                        sequence.finish(e)
+                    self.block_allocator.free(sequence.seq_id)
+        return prefilled
+
+    def _prefill_chunks(self, budget: int):
+        """
+        Prefills the next chunk of each long prompt, oldest first, until budget tokens have been prefilled this step.
+        """
+        for sequence in list(self.prefilling):
+            if budget <= 0:
+                break
+            size = min(self.prefill_chunk_size, sequence.prompt_len - sequence.prefilled, budget)
+            try:
+                self._prefill_chunk(sequence, size)
+            except Exception as e:
+                if sequence in self.prefilling:
+                    self.prefilling.remove(sequence)
+                sequence.past = None
+                sequence.finish(e)
+                self.block_allocator.free(sequence.seq_id)
+            budget -= size
+
+    def _prefill_chunk(self, sequence: Sequence, size: int):
+        """
+        Feeds the next size prompt tokens through the model on top of the sequence's own KV cache. After the last chunk,
+        samples the first token and hands the sequence over to decoding like _prefill_one does.
+        """
+        start = time.perf_counter()
+        model = self.model_manager.get_model()
+        prompt_ids = sequence.model_inputs["input_ids"]
+        end = sequence.prefilled + size
+        position_ids = torch.arange(sequence.prefilled, end, dtype=torch.long, device=prompt_ids.device).unsqueeze(0)
+
+        with torch.no_grad():
+            outputs = model(
+                input_ids=prompt_ids[:, sequence.prefilled:end],
+                attention_mask=torch.ones(1, end, dtype=torch.long, device=prompt_ids.device),
+                position_ids=position_ids,
+                past_key_values=to_model_cache(model, sequence.past) if sequence.past is not None else None,
+                use_cache=True
+            )
+        sequence.past = to_legacy_cache(outputs.past_key_values)
+        sequence.prefilled = end
+        PREFILL_TOKENS.inc(size)
+        if sequence.trace is not None:
+            sequence.trace.add_span("prefill_chunk", start, time.perf_counter())
+        if end < sequence.prompt_len:
+            return
+
+        self.prefilling.remove(sequence)
+        past = sequence.past
+        sequence.past = None  # handed over to the running batch or the speculative decoder below
+        sequence.model_inputs = None  # the prompt now lives in the KV cache
+        sequence.past_len = end
+        if self.prefix_cache.enabled():
+            self.prefix_cache.insert(prompt_ids[0].tolist(), past)
+
+        if self._start_decoding([sequence], [prompt_ids], outputs.logits[:, -1, :], True, lambda row: past)[0]:
+            mask = torch.ones(1, sequence.past_len, dtype=torch.long, device=self.model_manager.get_device())
+            self._merge(past, mask)
+
+    def _is_text_only(self, sequence: Sequence) -> bool:
+        # image inputs change the cache contents without changing the token IDs, so they can't share prefixes, be batched
+        # with other prompts or be seen by the draft model
+        return "input_ids" in sequence.model_inputs and "pixel_values" not in sequence.model_inputs
+
+    def _prefill_one(self, sequence: Sequence, cached_len: int, cached_past):
+        start = time.perf_counter()
+        model = self.model_manager.get_model()
+        model_inputs = sequence.model_inputs
+        prompt_ids = model_inputs.get("input_ids")
+        text_only = self._is_text_only(sequence)
+        if cached_past is not None:
+            model_inputs = {
+                "input_ids": prompt_ids[:, cached_len:],
+                "attention_mask": torch.ones_like(prompt_ids),
+                "past_key_values": to_model_cache(model, cached_past)
+            }
+
+        with torch.no_grad():
+            outputs = model(**model_inputs, use_cache=True)
+        past = to_legacy_cache(outputs.past_key_values)
+        sequence.model_inputs = None  # the prompt now lives in the KV cache
+        if "input_ids" in model_inputs:
+            PREFILL_TOKENS.inc(model_inputs["input_ids"].shape[1])
+        if sequence.trace is not None:
+            sequence.trace.add_span("prefill", start, time.perf_counter())
+        if text_only and self.prefix_cache.enabled():
+            self.prefix_cache.insert(prompt_ids[0].tolist(), past)
+        # multimodal models may expand image placeholders, so trust the cache rather than the input length
+        sequence.past_len = cache_length(past)
+
+        if self._start_decoding([sequence], [prompt_ids], outputs.logits[:, -1, :], text_only, lambda row: past)[0]:
+            mask = torch.ones(1, sequence.past_len, dtype=torch.long, device=self.model_manager.get_device())
+            self._merge(past, mask)
+
+    def _prefill_batch(self, sequences: List[Sequence]):
+        """
+        Prefills text-only prompts in one forward pass, left padding the shorter ones.
+        """
+        start = time.perf_counter()
+        model = self.model_manager.get_model()
+        device = self.model_manager.get_device()
+        prompt_ids = [sequence.model_inputs["input_ids"] for sequence in sequences]
+        length = max(ids.shape[1] for ids in prompt_ids)
+
+        input_ids = torch.zeros(len(sequences), length, dtype=torch.long, device=device)
+        attention_mask = torch.zeros(len(sequences), length, dtype=torch.long, device=device)
+        for row, ids in enumerate(prompt_ids):
+            input_ids[row, length - ids.shape[1]:] = ids[0]
+            attention_mask[row, length - ids.shape[1]:] = 1
+        position_ids = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)
+
+        with torch.no_grad():
+            outputs = model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids, use_cache=True)
+        past = to_legacy_cache(outputs.past_key_values)
+        PREFILL_TOKENS.inc(sum(ids.shape[1] for ids in prompt_ids))
+        end = time.perf_counter()
+        for sequence, ids in zip(sequences, prompt_ids):
+            sequence.model_inputs = None  # the prompt now lives in the KV cache
+            sequence.past_len = ids.shape[1]
+            if sequence.trace is not None:
+                sequence.trace.add_span("prefill", start, end)
+
+        def row_past(row: int):
+            return select_rows(past, attention_mask, [row])[0]  # the row's own cache, without padding
+
+        if self.prefix_cache.enabled():
+            for row, ids in enumerate(prompt_ids):
+                self.prefix_cache.insert(ids[0].tolist(), row_past(row))
+
+        joining = self._start_decoding(sequences, prompt_ids, outputs.logits[:, -1, :], True, row_past)
+        rows = [row for row, joins in enumerate(joining) if joins]
+        if len(rows) < len(sequences):
+            past, attention_mask = select_rows(past, attention_mask, rows) if rows else (None, None)
+        if rows:
+            self._merge(past, attention_mask)
+
+    def _start_decoding(
+        self,
+        sequences: List[Sequence],
+        prompt_ids: List[Optional[torch.Tensor]],
+        logits: torch.Tensor,
+        text_only: bool,
+        row_past
+    ) -> List[bool]:
+        """
+        Sets up detokenizing and sampling for freshly prefilled sequences and samples their first tokens from the prompt
+        logits (one row per sequence). Text-only sequences that can be decoded speculatively are handed to the speculative
+        decoder, row_past(row) giving their own KV cache.
+        Returns, for every sequence, whether it should now join the running batch.
+        """
+        for sequence, ids in zip(sequences, prompt_ids):
+            sequence.detokenizer = IncrementalDetokenizer(
+                self.model_manager.get_tokenizer(),
+                ids[0].tolist() if ids is not None else None,
+                sequence.stop
+            )
+            if sequence.sampling.seed is not None:
+                sequence.generator = torch.Generator(device=logits.device).manual_seed(sequence.sampling.seed)
+            if sequence.sampling.repetition_penalty != 1.0:
+                sequence.seen_tokens = torch.zeros(logits.shape[-1], dtype=torch.bool, device=logits.device)
+                if ids is not None:
+                    sequence.seen_tokens[ids[0]] = True
+
+        start = time.perf_counter()
+        tokens = sample(logits, sequences)
+        end = time.perf_counter()
+
+        joining = []
+        for row, (sequence, ids, token) in enumerate(zip(sequences, prompt_ids, tokens)):
+            if sequence.trace is not None:
+                sequence.trace.add_span("sample", start, end)
+            if self._append_token(sequence, token):
+                self.block_allocator.free(sequence.seq_id)
+                joining.append(False)
+            # the draft model's proposals would need the penalty applied token by token, so those sequences stay batched
+            elif (
+                self.speculative_decoder is not None and text_only and sequence.seen_tokens is None
+                and len(self.running) + len(self.speculating) < self.speculative_max_batch_size
+            ):
+                self.speculative_decoder.prefill(sequence, ids, row_past(row))
+                self.speculating.append(sequence)
+                joining.append(False)
+            else:
+                self.running.append(sequence)
+                joining.append(True)
+        return joining
+
+    def _merge(self, past, mask: torch.Tensor):
+        """
+        Appends the KV cache rows of newly admitted sequences to the running batch.
+        """
+        if self.past is None:
+            self.past, self.attention_mask = past, mask
+        else:
+            running_past, self.past = list(self.past), None  # handed over, so merging frees it layer by layer
+            self.past, self.attention_mask = merge_caches(running_past, self.attention_mask, past, mask)
+
+    def _stop_speculating(self):
+        """
+        Moves every speculating sequence into the running batch. After a round, a sequence's own cache ends right before
+        its last token, which is exactly what the next batched decode step feeds in.
+        """
+        device = self.model_manager.get_device()
+        for sequence in self.speculating:
+            sequence.past_len = cache_length(sequence.past)
+            self._merge(sequence.past, torch.ones(1, sequence.past_len, dtype=torch.long, device=device))
+            sequence.past, sequence.draft_past, sequence.draft_pending = None, None, []
+            self.running.append(sequence)
+        self.speculating = []
+
+    def _speculate(self):
+        """
+        Runs one speculative decoding round for every speculating sequence, each of which may produce several tokens.
+        """
+        still_running = []
+        for sequence in self.speculating:
+            start = time.perf_counter()
+            try:
+                tokens = self.speculative_decoder.step(sequence)
+            except Exception as e:
+                sequence.finish(e)
+                self.block_allocator.free(sequence.seq_id)
+                continue
+            if sequence.trace is not None:
+                sequence.trace.add_span("speculative_step", start, time.perf_counter())
+            finished = False
+            for token in tokens:
+                if self._append_token(sequence, token):
+                    finished = True
+                    break
+            if finished:
+                self.block_allocator.free(sequence.seq_id)
+            else:
+                still_running.append(sequence)
+        self.speculating = still_running
+
+    def _decode(self):
+        """
+        Feeds the last sampled token of every running sequence through the model in one batched forward pass.
+        """
+        start = time.perf_counter()
+        model = self.model_manager.get_decode_model()
+        batch_size = len(self.running)
+        input_ids = self.decode_input_ids[:batch_size]
+        position_ids = self.decode_position_ids[:batch_size]
+        input_ids[:, 0] = torch.tensor([sequence.output_ids[-1] for sequence in self.running])
+        position_ids[:, 0] = torch.tensor([sequence.past_len for sequence in self.running])
+        attention_mask = append_mask_column(self.attention_mask)
+        past_key_values = to_model_cache(model, self.past)
+        self.past = None  # a Cache object is then the only owner, and frees each layer's old tensors as it grows them
+
+        with torch.no_grad():
+            outputs = model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=past_key_values,
+                use_cache=True
+            )
+        self.past = to_legacy_cache(outputs.past_key_values)
+        self.attention_mask = attention_mask
+
+        sample_start = time.perf_counter()
+        tokens = sample(outputs.logits[:, -1, :], self.running)
+        sample_end = time.perf_counter()
+        for sequence in self.running:
+            if sequence.trace is not None:
+                sequence.trace.add_span("decode_step", start, sample_start)
+                sequence.trace.add_span("sample", sample_start, sample_end)
+
+        keep = []
+        for row, (sequence, token) in enumerate(zip(self.running, tokens)):
+            sequence.past_len += 1
+            if not self._append_token(sequence, token):
+                keep.append(row)
+        self._retire(keep)
+
+    def _retire(self, keep: List[int]):
+        """
+        Removes finished sequences from the running batch and their rows from the KV cache, and frees their blocks.
+        """
+        if len(keep) == len(self.running):
+            return
+        kept = set(keep)
+        for row, sequence in enumerate(self.running):
+            if row not in kept:
+                self.block_allocator.free(sequence.seq_id)
+        self.running = [self.running[row] for row in keep]
+        if not self.running:
+            self.past = None
+            self.attention_mask = None
+            return
+        running_past, self.past = list(self.past), None
+        self.past, self.attention_mask = select_rows(running_past, self.attention_mask, keep)
+
+    def _append_token(self, sequence: Sequence, token: int) -> bool:
+        """
+        Records a newly sampled token and streams whatever text it completes. Returns True if the sequence is now finished.
+        """
+        now = time.perf_counter()
+        if sequence.output_ids:
+            INTER_TOKEN_LATENCY.observe(now - sequence.last_token_time)
+        else:
+            TIME_TO_FIRST_TOKEN.observe(now - sequence.arrival_time)
+        sequence.last_token_time = now
+        DECODE_TOKENS.inc()
+        sequence.output_ids.append(token)
+        if sequence.seen_tokens is not None:
+            sequence.seen_tokens[token] = True
+
+        # a stop token ends the sequence without its text being streamed
+        stop_token = token in self.eos_token_ids or token in sequence.stop_token_ids
+        delta = sequence.detokenizer.add_token(token) if not stop_token else ""
+        if sequence.trace is not None:
+            sequence.trace.add_span("detokenize", now, time.perf_counter())
+        stop_reason = None
+        if stop_token or sequence.detokenizer.stopped:
+            stop_reason = "stop"
+        elif len(sequence.output_ids) >= sequence.max_tokens:
+            stop_reason = "length"
+        if stop_reason is not None:
+            delta += sequence.detokenizer.flush()
+        if delta:
+            sequence.emit(delta)
+        if stop_reason is not None:
+            sequence.finish(stop_reason=stop_reason)
+        return stop_reason is not None
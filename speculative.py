@@ -0,0 +1,131 @@
+import torch
+from typing import List, Optional
+from config import Config
+from kv_cache import cache_length, to_legacy_cache, to_model_cache, truncate_cache
+from model import ModelManager
+from sampling import probabilities
+
+class SpeculativeDecoder:
+    """
+    Speculative decoding with a small draft model.
+    Each round, the draft model proposes num_speculative_tokens tokens one at a time, then the target model scores all of
+    them in a single forward pass. Proposals are accepted with the standard rejection rule (accept d with probability
+    min(1, p(d) / q(d)), otherwise resample from max(0, p - q)), so the output follows the target model's distribution
+    exactly while costing one target forward pass per round instead of one per token.
+
+    Each sequence keeps its own target and draft KV caches (sequence.past and sequence.draft_past).
+    """
+    def __init__(self, model_manager: ModelManager, num_speculative_tokens: int = Config.SPECULATIVE_TOKENS):
+        self.model_manager = model_manager
+        self.num_speculative_tokens = num_speculative_tokens
+        self.rounds = 0
+        self.proposed = 0
+        self.accepted = 0
+
+    def prefill(self, sequence, prompt_ids: torch.Tensor, past):
+        """
+        Sets the sequence up for speculation. past is the target model's cache for the prompt, and the first output token
+        has already been sampled from it.
+        """
+        draft_model = self.model_manager.get_draft_model()
+        with torch.no_grad():
+            outputs = draft_model(input_ids=prompt_ids, attention_mask=torch.ones_like(prompt_ids), use_cache=True)
+        sequence.past = past
+        sequence.draft_past = to_legacy_cache(outputs.past_key_values)
+        sequence.draft_pending = [sequence.output_ids[-1]]  # tokens the draft model hasn't seen yet
+
+    def step(self, sequence) -> List[int]:
+        """
+        Runs one propose/verify round for the sequence and returns the newly generated tokens (at least one).
+        """
+        draft_model = self.model_manager.get_draft_model()
+        target_model = self.model_manager.get_model()
+        device = self.model_manager.get_device()
+        vocab_size = target_model.get_output_embeddings().weight.shape[0]
+        k = self.num_speculative_tokens
+
+        # propose: k tokens from the draft model, one forward pass each
+        draft_start = cache_length(sequence.draft_past)
+        draft_past = sequence.draft_past
+        draft_inputs = sequence.draft_pending
+        draft_tokens, draft_probs = [], []
+        with torch.no_grad():
+            for _ in range(k):
+                outputs = draft_model(
+                    input_ids=torch.tensor([draft_inputs], dtype=torch.long, device=device),
+                    attention_mask=torch.ones(1, cache_length(draft_past) + len(draft_inputs), dtype=torch.long, device=device),
+                    past_key_values=to_model_cache(draft_model, draft_past),
+                    use_cache=True
+                )
+                draft_past = to_legacy_cache(outputs.past_key_values)
+                q = self._probs(_align_vocab(outputs.logits[0, -1:, :], vocab_size), sequence)[0]
+                token = torch.multinomial(q, num_samples=1, generator=sequence.generator).item()
+                draft_tokens.append(token)
+                draft_probs.append(q)
+                draft_inputs = [token]
+
+            # verify: score the last accepted token plus every proposal in one target forward pass
+            target_start = cache_length(sequence.past)
+            target_inputs = [sequence.output_ids[-1]] + draft_tokens
+            outputs = target_model(
+                input_ids=torch.tensor([target_inputs], dtype=torch.long, device=device),
+                attention_mask=torch.ones(1, target_start + len(target_inputs), dtype=torch.long, device=device),
+                past_key_values=to_model_cache(target_model, sequence.past),
+                use_cache=True
+            )
+        p = self._probs(outputs.logits[0, :, :vocab_size], sequence)  # [k + 1, vocab]
+        new_tokens = accept_proposals(draft_tokens, draft_probs, p, sequence.generator)
+
+        accepted = len(new_tokens) - 1
+        self.rounds += 1
+        self.proposed += k
+        self.accepted += accepted
+
+        # roll both caches back to the accepted tokens; whatever a model hasn't consumed yet is fed next round
+        sequence.past = truncate_cache(to_legacy_cache(outputs.past_key_values), target_start + 1 + accepted)
+        draft_consumed = min(accepted, k - 1)
+        sequence.draft_past = truncate_cache(draft_past, draft_start + len(sequence.draft_pending) + draft_consumed)
+        sequence.draft_pending = new_tokens[draft_consumed:]
+        return new_tokens
+
+    def _probs(self, logits: torch.Tensor, sequence) -> torch.Tensor:
+        return probabilities(logits.float(), [sequence.sampling] * logits.shape[0])
+
+    def stats(self) -> dict:
+        return {
+            "rounds": self.rounds,
+            "proposed_tokens": self.proposed,
+            "accepted_tokens": self.accepted,
+            "acceptance_rate": self.accepted / self.proposed if self.proposed else 0,
+            "tokens_per_round": (self.accepted + self.rounds) / self.rounds if self.rounds else 0
+        }
+
+def accept_proposals(draft_tokens: List[int], draft_probs: List[torch.Tensor], target_probs: torch.Tensor, generator: Optional[torch.Generator] = None) -> List[int]:
+    """
+    The rejection rule: accepts each proposal d with probability min(1, p(d) / q(d)) and stops at the first rejection,
+    resampling that position from max(0, p - q). If every proposal is accepted, a bonus token is sampled from the target
+    distribution after the last one. target_probs holds one row more than there are proposals.
+    Returns the accepted proposals plus the resampled or bonus token.
+    """
+    new_tokens = []
+    for i, token in enumerate(draft_tokens):
+        if torch.rand((), generator=generator, device=target_probs.device).item() * draft_probs[i][token].item() < target_probs[i, token].item():
+            new_tokens.append(token)
+            continue
+        residual = torch.clamp(target_probs[i] - draft_probs[i], min=0)
+        if residual.sum() <= 0:
+            residual = target_probs[i]
+        new_tokens.append(torch.multinomial(residual, num_samples=1, generator=generator).item())
+        return new_tokens
+    new_tokens.append(torch.multinomial(target_probs[len(draft_tokens)], num_samples=1, generator=generator).item())
+    return new_tokens
+
+def _align_vocab(logits: torch.Tensor, vocab_size: int) -> torch.Tensor:
+    """
+    Draft and target models may pad their embedding matrices differently, so line the draft's logits up with the
+    target's vocabulary. Missing entries get zero probability.
+    """
+    if logits.shape[-1] >= vocab_size:
+        return logits[..., :vocab_size]
+    pad = logits.new_full(logits.shape[:-1] + (vocab_size - logits.shape[-1],), float("-inf"))
+    return torch.cat([logits, pad], dim=-1)
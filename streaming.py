@@ -0,0 +1,82 @@
+import asyncio
+from json.encoder import encode_basestring_ascii
+from typing import AsyncIterator, Callable, List, Optional
+from pydantic import BaseModel
+from utils import serialize
+
+DELTA_PLACEHOLDER = "__stream_delta__"
+
+STREAM_FORMATS = {
+    # format -> (media type, bytes before each chunk's JSON, bytes after it)
+    "ndjson": ("application/json", b"", b"\n"),
+    "sse": ("text/event-stream", b"data: ", b"\n\n")
+}
+
+class StreamEncoder:
+    """
+    Serializes streamed chunks straight to bytes, without building or dumping a pydantic model per token.
+    The chunk model is serialized once with a placeholder delta and split around it, so encoding a chunk only escapes the
+    delta (with json's C string encoder) and joins it between the cached template bytes. The JSON is byte for byte what
+    serialize() produces for the same chunk.
+    """
+    def __init__(self, make_chunk: Callable[[str], BaseModel], stream_format: str = "ndjson"):
+        if stream_format not in STREAM_FORMATS:
+            raise ValueError(f"Unknown stream format {stream_format}, expected one of {list(STREAM_FORMATS)}.")
+        self.media_type, start, end = STREAM_FORMATS[stream_format]
+        rendered = serialize(make_chunk(DELTA_PLACEHOLDER)).encode("ascii")
+        before, placeholder, after = rendered.partition(encode_basestring_ascii(DELTA_PLACEHOLDER).encode("ascii"))
+        if not placeholder:
+            raise ValueError("The chunk model doesn't serialize its delta as a JSON string.")
+        self.prefix = start + before
+        self.suffix = after + end
+        self.start = start
+        self.end = end
+
+    def encode(self, delta: str) -> bytes:
+        return self.prefix + encode_basestring_ascii(delta).encode("ascii") + self.suffix
+
+    def encode_chunk(self, chunk: BaseModel) -> bytes:
+        """
+        Serializes a whole chunk model in the stream's format, for the odd chunk that isn't just a delta (e.g. the last one).
+        """
+        return self.start + serialize(chunk).encode("utf-8") + self.end
+
+async def coalesce(tokens: AsyncIterator[str]) -> AsyncIterator[str]:
+    """
+    Yields the text of tokens as it arrives, merging everything generated while the consumer was busy (e.g. waiting for
+    a slow client to read the last write) into one item. A fast reader still gets every token on its own.
+    """
+    pending: List[str] = []
+    ready = asyncio.Event()
+    done = False
+    error: Optional[Exception] = None
+
+    async def produce():
+        nonlocal done, error
+        try:
+            async for token in tokens:
+                pending.append(token)
+                ready.set()
+        except Exception as e:
+            error = e
+        finally:
+            done = True
+            ready.set()
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            if not pending and not done:
+                ready.clear()
+                await ready.wait()
+            if pending:
+                text = "".join(pending)
+                pending.clear()
+                yield text
+            elif error is not None:
+                raise error
+            elif done:
+                return
+    finally:
+        # the consumer went away early (e.g. the client disconnected), so stop generating
+        producer.cancel()
@@ -0,0 +1,89 @@
+import asyncio
+import json
+import torch
+from batch import completed_ids, read_records, run_batch
+
+def read(lines, done_ids=frozenset()):
+    async def line_iterator():
+        for line in lines:
+            yield line
+
+    async def collect():
+        return [record async for record in read_records(line_iterator(), done_ids)]
+    return asyncio.run(collect())
+
+def test_records_get_their_position_as_id():
+    records = read(['{"content": "a"}', "", '{"id": "x", "content": "b"}', '{"content": "c"}'])
+    assert records == [
+        {"id": "0", "request": {"content": "a"}},
+        {"id": "x", "request": {"content": "b"}},
+        {"id": "2", "request": {"content": "c"}}
+    ]
+
+def test_malformed_lines_become_error_records():
+    records = read(['{"content": "a"}', "not json", "[1, 2]", '{"content": "d"}'])
+    assert records[0] == {"id": "0", "request": {"content": "a"}}
+    assert records[1]["id"] == "1" and records[1]["error"].startswith("Invalid JSON")
+    assert records[2] == {"id": "2", "error": "Expected a JSON object, got list"}
+    assert records[3] == {"id": "3", "request": {"content": "d"}}
+
+def test_done_ids_are_skipped_including_bad_lines():
+    records = read(['{"content": "a"}', "not json", '{"content": "c"}'], done_ids={"0", "1"})
+    assert records == [{"id": "2", "request": {"content": "c"}}]
+
+def test_completed_ids_only_counts_successful_results(tmp_path):
+    output = tmp_path / "results.jsonl"
+    output.write_text("\n".join([
+        json.dumps({"id": "0", "response": {"completion_message": {"content": "a"}}}),
+        json.dumps({"id": "1", "error": "Timed out fetching image"}),
+        json.dumps({"id": "2", "response": {}}),
+        '{"id": "3", "resp'  # cut off by a crash
+    ]))
+    assert completed_ids(str(output)) == {"0", "2"}
+
+class HangingSequence:
+    def __init__(self):
+        self.cancelled = asyncio.Event()
+
+    async def stream(self):
+        try:
+            await asyncio.Event().wait()
+            yield ""
+        finally:
+            self.cancelled.set()
+
+class FakeScheduler:
+    max_batch_size = 4
+
+    def __init__(self):
+        self.sequences = []
+
+    def add_request(self, *args, **kwargs):
+        self.sequences.append(HangingSequence())
+        return self.sequences[-1]
+
+class FakeInputProcessor:
+    def __init__(self):
+        self.scheduler = FakeScheduler()
+
+    async def prepare_input(self, content):
+        return {"input_ids": torch.zeros(1, 3, dtype=torch.long)}
+
+def test_closing_a_batch_early_cancels_its_requests():
+    input_processor = FakeInputProcessor()
+
+    async def records():
+        yield {"id": "bad", "error": "Invalid JSON"}
+        for index in range(3):
+            yield {"id": str(index), "request": {"model": "m", "content": "hi"}}
+
+    async def run():
+        results = run_batch(input_processor, records())
+        assert await results.__anext__() == {"id": "bad", "error": "Invalid JSON"}
+        await asyncio.sleep(0)  # let the other requests reach the scheduler
+        await results.aclose()  # what a client disconnect does
+        sequences = input_processor.scheduler.sequences
+        await asyncio.wait_for(asyncio.gather(*(sequence.cancelled.wait() for sequence in sequences)), timeout=5)
+        return len(sequences)
+
+    assert asyncio.run(run()) == 3
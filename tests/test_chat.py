@@ -0,0 +1,75 @@
+import re
+import jinja2
+import pytest
+from fastapi import HTTPException
+from chat import ChatTokenizer
+
+LLAMA_STYLE_TEMPLATE = (
+    "{{ bos_token }}"
+    "{% for message in messages %}<|{{ message['role'] }}|>\n{{ message['content'] }}<|end|>\n{% endfor %}"
+    "{% if add_generation_prompt %}<|assistant|>\n{% endif %}"
+)
+
+class WordTokenizer:
+    """
+    Splits text into words, whitespace runs, template markers and punctuation, so where the text is cut changes the tokens
+    like a real tokenizer's merges would.
+    """
+    def __init__(self, chat_template=LLAMA_STYLE_TEMPLATE):
+        self.chat_template = chat_template
+        self.vocab = {"<s>": 1}
+        self.tokenized = []  # every text encode() was asked for
+
+    def encode(self, text, add_special_tokens=True):
+        self.tokenized.append(text)
+        ids = [self.vocab.setdefault(piece, len(self.vocab) + 1) for piece in re.findall(r"<s>|<\|\w+\|>|\w+|\s+|[^\w\s]", text)]
+        return [1] + ids if add_special_tokens else ids
+
+    def apply_chat_template(self, messages, chat_template, add_generation_prompt, tokenize):
+        return jinja2.Template(chat_template).render(messages=messages, add_generation_prompt=add_generation_prompt, bos_token="<s>")
+
+def full_encode(tokenizer, messages, template=LLAMA_STYLE_TEMPLATE):
+    return tokenizer.encode(tokenizer.apply_chat_template(messages, template, True, False), add_special_tokens=False)
+
+CONVERSATION = [
+    {"role": "system", "content": "You are terse."},
+    {"role": "user", "content": "Capital of France?"},
+    {"role": "assistant", "content": "Paris."},
+    {"role": "user", "content": "And of Italy, please?"},
+    {"role": "assistant", "content": "Rome."},
+    {"role": "user", "content": "Spain?"}
+]
+
+def test_incremental_encoding_matches_full_encoding_across_turns():
+    tokenizer = WordTokenizer()
+    chat_tokenizer = ChatTokenizer(tokenizer)
+    previous = []
+    for turn in (2, 4, 6):
+        token_ids = chat_tokenizer.encode(CONVERSATION[:turn])
+        assert token_ids == full_encode(tokenizer, CONVERSATION[:turn])
+        assert token_ids[:len(previous)] == previous  # each turn starts with exactly the last turn's prompt
+        previous = token_ids
+
+def test_extended_conversation_only_tokenizes_its_new_messages():
+    tokenizer = WordTokenizer()
+    chat_tokenizer = ChatTokenizer(tokenizer)
+    chat_tokenizer.encode(CONVERSATION[:2])
+    assert chat_tokenizer.stats() == {"entries": 1, "hits": 0, "misses": 1}
+
+    tokenizer.tokenized = []
+    chat_tokenizer.encode(CONVERSATION[:4])
+
+    assert chat_tokenizer.stats()["hits"] == 1
+    assert not any("Capital of France" in text for text in tokenizer.tokenized)
+
+def test_fallback_template_starts_with_the_tokenizers_special_tokens():
+    tokenizer = WordTokenizer(chat_template=None)
+    chat_tokenizer = ChatTokenizer(tokenizer)
+    token_ids = chat_tokenizer.encode(CONVERSATION[:4])
+    assert token_ids[0] == 1
+    assert token_ids == [1] + full_encode(tokenizer, CONVERSATION[:4], chat_tokenizer.chat_template)
+
+def test_empty_conversation_is_a_bad_request():
+    with pytest.raises(HTTPException) as error:
+        ChatTokenizer(WordTokenizer()).encode([])
+    assert error.value.status_code == 400
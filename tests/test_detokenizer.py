@@ -0,0 +1,67 @@
+from detokenizer import IncrementalDetokenizer
+
+class ByteTokenizer:
+    """
+    One token per UTF-8 byte, so multi-byte characters always span several tokens.
+    """
+    def encode(self, text: str):
+        return list(text.encode("utf-8"))
+
+    def decode(self, token_ids, skip_special_tokens=True):
+        return bytes(token_ids).decode("utf-8", errors="replace")
+
+def stream(text: str, stop_strings=None, prompt: str = ""):
+    tokenizer = ByteTokenizer()
+    detokenizer = IncrementalDetokenizer(tokenizer, tokenizer.encode(prompt), stop_strings)
+    deltas = []
+    for token in tokenizer.encode(text):
+        deltas.append(detokenizer.add_token(token))
+        if detokenizer.stopped:  # the scheduler finishes the sequence here
+            break
+    deltas.append(detokenizer.flush())
+    return deltas, detokenizer
+
+def test_plain_text_streams_token_by_token():
+    deltas, _ = stream("hello")
+    assert deltas == ["h", "e", "l", "l", "o", ""]
+
+def test_multi_byte_characters_are_held_back_until_complete():
+    deltas, _ = stream("aé€😀b", prompt="ü")
+    assert "".join(deltas) == "aé€😀b"
+    assert not any("�" in delta for delta in deltas)
+    assert [delta for delta in deltas if delta] == ["a", "é", "€", "😀", "b"]
+
+def test_an_incomplete_character_at_the_end_is_flushed():
+    tokenizer = ByteTokenizer()
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    assert detokenizer.add_token(ord("a")) == "a"
+    assert detokenizer.add_token("é".encode("utf-8")[0]) == ""
+    assert detokenizer.flush() == "�"
+
+def test_stop_string_spanning_tokens_is_cut():
+    deltas, detokenizer = stream("Hello END world", stop_strings=["END"])
+    assert detokenizer.stopped
+    assert "".join(deltas) == "Hello "
+    assert detokenizer.text == "Hello "
+
+def test_possible_stop_prefix_is_held_back_then_released():
+    deltas, detokenizer = stream("an ENd", stop_strings=["END"])
+    assert not detokenizer.stopped
+    assert "".join(deltas) == "an ENd"
+    # "E" and "EN" could still start "END", so they only go out once "d" rules it out
+    assert deltas[3:6] == ["", "", "ENd"]
+
+def test_held_back_prefix_is_released_on_flush():
+    deltas, _ = stream("wait EN", stop_strings=["END"])
+    assert deltas[-1] == "EN"
+    assert "".join(deltas) == "wait EN"
+
+def test_earliest_stop_string_wins():
+    deltas, detokenizer = stream("one two three", stop_strings=["three", "two"])
+    assert detokenizer.stopped
+    assert "".join(deltas) == "one "
+
+def test_stop_string_inside_a_multi_byte_character_stream():
+    deltas, detokenizer = stream("café☕stop", stop_strings=["☕"])
+    assert detokenizer.stopped
+    assert "".join(deltas) == "café"
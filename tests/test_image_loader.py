@@ -0,0 +1,169 @@
+import asyncio
+import httpx
+import threading
+import pytest
+import torch
+from fastapi import HTTPException
+from PIL import Image
+from llama_models.llama3.api.datatypes import ImageMedia, URL
+from image_loader import ImageLoader
+
+class FakeProcessor:
+    """
+    Returns the image's pixels as a float tensor, and can hold every call until released, to keep loads in flight.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, images, return_tensors):
+        self.calls += 1
+        self.release.wait(timeout=5)
+        return {"pixel_values": torch.frombuffer(bytearray(images.convert("L").tobytes()), dtype=torch.uint8).float()}
+
+def write_image(tmp_path, name: str, size: int = 4, color: int = 0):
+    path = tmp_path / f"{name}.png"
+    Image.new("L", (size, size), color).save(path)
+    return ImageMedia(image=URL(uri=path.as_uri()))
+
+def make_loader(processor, **kwargs):
+    return ImageLoader(processor, torch.device("cpu"), allow_file_urls=True, **kwargs)
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+def test_images_load_concurrently_in_order(tmp_path):
+    processor = FakeProcessor()
+    images = [write_image(tmp_path, str(color), color=color) for color in (10, 20, 30)]
+
+    async def load():
+        loader = make_loader(processor)
+        try:
+            return await loader.load_all(images)
+        finally:
+            await loader.close()
+
+    pixel_values = run(load())
+    assert [int(values[0]) for values in pixel_values] == [10, 20, 30]
+    assert processor.calls == 3
+
+def test_concurrent_requests_for_one_image_share_a_load(tmp_path):
+    processor = FakeProcessor()
+    processor.release.clear()
+    image = write_image(tmp_path, "shared")
+
+    async def load():
+        loader = make_loader(processor)
+        try:
+            first = asyncio.ensure_future(loader.load(image))
+            second = asyncio.ensure_future(loader.load(image))
+            await asyncio.sleep(0.05)
+            assert len(loader.pending) == 1
+            processor.release.set()
+            results = await asyncio.gather(first, second)
+            return results, loader.pending, loader.stats()
+        finally:
+            await loader.close()
+
+    (first, second), pending, stats = run(load())
+    assert first is second
+    assert processor.calls == 1
+    assert pending == {}
+    assert stats["misses"] == 2 and stats["entries"] == 1
+
+def test_cancelled_request_does_not_cancel_a_shared_load(tmp_path):
+    processor = FakeProcessor()
+    processor.release.clear()
+    image = write_image(tmp_path, "shared")
+
+    async def load():
+        loader = make_loader(processor)
+        try:
+            first = asyncio.ensure_future(loader.load(image))
+            second = asyncio.ensure_future(loader.load(image))
+            await asyncio.sleep(0.05)
+            first.cancel()
+            processor.release.set()
+            return await second
+        finally:
+            await loader.close()
+
+    assert run(load()).numel() == 16
+    assert processor.calls == 1
+
+def test_least_recently_used_images_are_evicted(tmp_path):
+    processor = FakeProcessor()
+    images = {name: write_image(tmp_path, name) for name in "abc"}
+    entry_bytes = 16 * 4
+
+    async def load():
+        loader = make_loader(processor, max_gb=2.5 * entry_bytes / (1024 ** 3))
+        try:
+            await loader.load(images["a"])
+            await loader.load(images["b"])
+            await loader.load(images["a"])  # a is now the most recently used
+            await loader.load(images["c"])  # evicts b
+            calls = processor.calls
+            await loader.load(images["a"])
+            await loader.load(images["c"])
+            assert processor.calls == calls
+            await loader.load(images["b"])
+            assert processor.calls == calls + 1
+            return loader.stats()
+        finally:
+            await loader.close()
+
+    stats = run(load())
+    assert stats["entries"] == 2
+    assert stats["hits"] == 3
+
+def test_file_urls_are_refused_by_default(tmp_path):
+    image = write_image(tmp_path, "secret")
+
+    async def load():
+        loader = ImageLoader(FakeProcessor(), torch.device("cpu"))
+        try:
+            await loader.load(image)
+        finally:
+            await loader.close()
+
+    with pytest.raises(HTTPException) as error:
+        run(load())
+    assert error.value.status_code == 400
+
+def test_oversized_images_are_refused(tmp_path):
+    image = write_image(tmp_path, "large", size=64)
+
+    async def load():
+        loader = make_loader(FakeProcessor(), max_image_bytes=32)
+        try:
+            await loader.load(image)
+        finally:
+            await loader.close()
+
+    with pytest.raises(HTTPException) as error:
+        run(load())
+    assert "larger than 32 bytes" in error.value.detail
+
+def test_oversized_downloads_are_cut_off():
+    async def body():
+        for _ in range(8):
+            yield b"x" * 16
+
+    def respond(request):
+        # streamed without a content-length, so only the running byte count can catch it
+        return httpx.Response(200, content=body())
+
+    async def load():
+        loader = make_loader(FakeProcessor(), max_image_bytes=64)
+        await loader.client.aclose()
+        loader.client = httpx.AsyncClient(transport=httpx.MockTransport(respond))
+        try:
+            await loader.load(ImageMedia(image=URL(uri="https://example.com/large.png")))
+        finally:
+            await loader.close()
+
+    with pytest.raises(HTTPException) as error:
+        run(load())
+    assert "larger than 64 bytes" in error.value.detail
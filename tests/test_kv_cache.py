@@ -0,0 +1,115 @@
+import torch
+from kv_cache import BlockAllocator, append_mask_column, cache_length, merge_caches, padded_batch_tokens, select_rows
+
+LAYERS, HEADS, DIM = 2, 2, 4
+
+def make_cache(batch: int, length: int):
+    return tuple((torch.randn(batch, HEADS, length, DIM), torch.randn(batch, HEADS, length, DIM)) for _ in range(LAYERS))
+
+def test_merge_caches_left_pads_the_shorter_cache():
+    first, second = make_cache(2, 3), make_cache(1, 5)
+    first_mask = torch.tensor([[1, 1, 1], [0, 1, 1]])
+    second_mask = torch.ones(1, 5, dtype=torch.long)
+
+    merged, mask = merge_caches(first, first_mask, second, second_mask)
+
+    assert cache_length(merged) == 5
+    assert mask.tolist() == [[0, 0, 1, 1, 1], [0, 0, 0, 1, 1], [1, 1, 1, 1, 1]]
+    for (key, value), (first_key, first_value), (second_key, second_value) in zip(merged, first, second):
+        assert key.shape == (3, HEADS, 5, DIM)
+        assert torch.equal(key[:2, :, 2:], first_key)
+        assert torch.equal(value[:2, :, 2:], first_value)
+        assert not key[:2, :, :2].any()
+        assert torch.equal(key[2:], second_key)
+        assert torch.equal(value[2:], second_value)
+
+def test_merge_caches_empties_caches_passed_as_lists():
+    first, second = list(make_cache(1, 2)), make_cache(1, 3)
+    merged, _ = merge_caches(first, torch.ones(1, 2), second, torch.ones(1, 3))
+    assert first == []
+    assert len(merged) == LAYERS
+
+def test_select_rows_trims_padding_left_by_removed_rows():
+    past = make_cache(3, 5)
+    mask = torch.tensor([[0, 0, 1, 1, 1], [1, 1, 1, 1, 1], [0, 0, 0, 1, 1]])
+
+    selected, selected_mask = select_rows(past, mask, [0, 2])
+
+    assert selected_mask.tolist() == [[1, 1, 1], [0, 1, 1]]
+    for (key, value), (original_key, original_value) in zip(selected, past):
+        assert torch.equal(key, original_key[[0, 2], :, 2:])
+        assert torch.equal(value, original_value[[0, 2], :, 2:])
+
+def test_select_rows_keeps_columns_still_in_use():
+    past = make_cache(2, 4)
+    mask = torch.tensor([[1, 1, 1, 1], [0, 1, 1, 1]])
+
+    selected, selected_mask = select_rows(past, mask, [1])
+
+    assert selected_mask.tolist() == [[1, 1, 1]]
+    assert torch.equal(selected[0][0], past[0][0][1:, :, 1:])
+
+def test_append_mask_column_writes_in_place_when_the_buffer_has_room():
+    buffer = torch.zeros(3, 8, dtype=torch.long)
+    mask = buffer[:, :4]
+    mask.fill_(1)
+
+    grown = append_mask_column(mask)
+
+    assert grown.shape == (3, 5)
+    assert grown.data_ptr() == buffer.data_ptr()
+    assert buffer[:, :5].eq(1).all()
+    assert not buffer[:, 5:].any()
+
+def test_append_mask_column_reallocates_a_full_mask():
+    mask = torch.tensor([[0, 1], [1, 1]])
+
+    grown = append_mask_column(mask, spare_columns=4)
+
+    assert grown.tolist() == [[0, 1, 1], [1, 1, 1]]
+    assert mask.tolist() == [[0, 1], [1, 1]]
+    assert grown.stride(0) == 2 + 1 + 4
+
+def test_append_mask_column_does_not_write_past_a_trimmed_view():
+    # a mask whose leading columns were trimmed still ends at the edge of its rows, so there is no spare column
+    buffer = torch.zeros(2, 6, dtype=torch.long)
+    mask = buffer[:, 2:]
+    mask.fill_(1)
+
+    grown = append_mask_column(mask)
+
+    assert grown.shape == (2, 5)
+    assert grown.data_ptr() != buffer.data_ptr()
+    assert buffer[1, :2].eq(0).all()
+
+def test_append_mask_column_repeatedly():
+    mask = torch.ones(2, 1, dtype=torch.long)
+    for _ in range(100):
+        mask = append_mask_column(mask, spare_columns=8)
+    assert mask.shape == (2, 101)
+    assert mask.eq(1).all()
+
+def test_padded_batch_tokens_charges_every_row_the_longest_length():
+    # one 2000 token prompt next to 15 short ones: all 16 rows are 2000 long until the short ones finish
+    rows = [(2000, 10)] + [(100, 10)] * 15
+    assert padded_batch_tokens(rows) == 16 * 2010
+
+def test_padded_batch_tokens_peaks_when_long_runners_are_alone():
+    # both rows alive for 10 steps (2 * 20), then one row alone for 90 more (1 * 110)
+    assert padded_batch_tokens([(10, 10), (10, 100)]) == 110
+    assert padded_batch_tokens([]) == 0
+
+def test_resize_grows_and_shrinks_a_table():
+    allocator = BlockAllocator(num_blocks=10, block_size=4)
+    allocator.allocate(1, 8)
+    assert allocator.resize(-1, 16)
+    assert allocator.used_blocks() == 6
+    assert not allocator.resize(-1, 40)
+    assert allocator.used_blocks() == 6
+    assert allocator.blocks_to_resize(-1, 4) == -3
+    assert allocator.resize(-1, 4)
+    assert allocator.used_blocks() == 3
+    assert allocator.resize(-1, 0)
+    assert -1 not in allocator.block_tables
+    allocator.free(1)
+    assert allocator.used_blocks() == 0
@@ -0,0 +1,99 @@
+import pytest
+import torch
+from transformers import LlamaConfig
+import planner
+from config import Config
+from planner import GB, plan_resources
+from utils import count_weight_bytes
+
+TENSORS = {
+    "model.embed_tokens.weight": {"dtype": "F32", "shape": [10, 4]},
+    "model.layers.0.mlp.up_proj.weight": {"dtype": "BF16", "shape": [8, 4]},
+    "model.layers.0.input_layernorm.weight": {"dtype": "BF16", "shape": [4]},
+    "model.layers.0.self_attn.rotary_emb.inv_freq": {"dtype": "I64", "shape": [2]},
+    "lm_head.weight": {"dtype": "F32", "shape": [10, 4]}
+}
+
+def test_count_weight_bytes_uses_the_checkpoint_dtypes_by_default():
+    assert count_weight_bytes(TENSORS) == 40 * 4 + 32 * 2 + 4 * 2 + 2 * 8 + 40 * 4
+
+def test_count_weight_bytes_overrides_floating_point_dtypes_only():
+    assert count_weight_bytes(TENSORS, torch.float16) == 40 * 2 + 32 * 2 + 4 * 2 + 2 * 8 + 40 * 2
+
+def test_count_weight_bytes_quantizes_linear_weights_but_not_embeddings_or_lm_head():
+    assert count_weight_bytes(TENSORS, torch.float16, 4) == 40 * 2 + 32 // 2 + 4 * 2 + 2 * 8 + 40 * 2
+    assert count_weight_bytes(TENSORS, torch.float16, 8) == 40 * 2 + 32 + 4 * 2 + 2 * 8 + 40 * 2
+
+CONFIG = LlamaConfig(
+    hidden_size=64,
+    intermediate_size=128,
+    num_hidden_layers=2,
+    num_attention_heads=4,
+    num_key_value_heads=4,
+    vocab_size=100,
+    max_position_embeddings=512
+)
+KV_BYTES_PER_TOKEN = 2 * 2 * 4 * 16 * 4  # keys and values, layers, heads, head dim, float32
+
+class FakeAutoConfig:
+    @staticmethod
+    def from_pretrained(*args, **kwargs):
+        return CONFIG
+
+@pytest.fixture
+def machine(monkeypatch):
+    """
+    A CPU-only machine with the model already cached, whose free memory the test sets.
+    """
+    monkeypatch.setattr(planner, "AutoConfig", FakeAutoConfig)
+    monkeypatch.setattr(planner, "get_weight_tensors", lambda name: TENSORS)
+    monkeypatch.setattr(planner, "find_local_snapshot", lambda name: "/models/tiny")
+    monkeypatch.setattr(planner, "get_available_vram", lambda: 0)
+    monkeypatch.setattr(planner, "get_available_disk_space", lambda path: 100.0)
+    monkeypatch.setattr(Config, "QUANTIZATION_MODE", "none")
+    monkeypatch.setattr(Config, "KV_CACHE_MEMORY_FRACTION", 0.9)
+    monkeypatch.setattr(Config, "PREFIX_CACHE_MAX_GB", 0.5)
+    monkeypatch.setattr(Config, "NUM_WORKERS", 1)
+
+    def set_memory(available_gb: float):
+        monkeypatch.setattr(planner, "get_available_memory", lambda: available_gb)
+    return set_memory
+
+def test_plan_gives_the_kv_cache_what_is_left(machine):
+    machine(4.0)
+    plan = plan_resources("tiny")
+
+    activation_bytes = planner._activation_bytes(CONFIG, 4, 512)
+    assert plan.weights_gb == count_weight_bytes(TENSORS, torch.float32) / GB
+    assert plan.activation_gb == activation_bytes / GB
+    assert plan.kv_bytes_per_token == KV_BYTES_PER_TOKEN
+    assert plan.max_context_len == 512
+    assert plan.disk_needed_gb == 0
+    assert plan.kv_cache_gb == pytest.approx((4.0 - plan.weights_gb - plan.activation_gb) * 0.9 - 0.5)
+    assert plan.max_kv_tokens() == int(plan.kv_cache_gb * GB) // KV_BYTES_PER_TOKEN
+    assert plan.max_sequences(512) == plan.max_kv_tokens() // 512
+
+def test_plan_caps_the_kv_cache(machine):
+    machine(4.0)
+    assert plan_resources("tiny", max_kv_cache_gb=0.25).kv_cache_gb == 0.25
+
+def test_plan_rejects_a_model_that_does_not_fit(machine):
+    machine(0.001)
+    with pytest.raises(ValueError, match="exceeds available cpu memory"):
+        plan_resources("tiny")
+
+def test_plan_rejects_a_kv_cache_too_small_for_one_sequence(machine, monkeypatch):
+    machine(0.5)  # the model fits, but the prefix cache takes everything after it
+    with pytest.raises(ValueError, match="can't hold one 512 token sequence"):
+        plan_resources("tiny")
+
+    monkeypatch.setattr(Config, "PREFIX_CACHE_MAX_GB", 0)
+    # one sequence needs 512 tokens plus a layer's copy, in whole 16 token blocks
+    sequence_gb = 768 * KV_BYTES_PER_TOKEN / GB
+    assert plan_resources("tiny", max_kv_cache_gb=sequence_gb).kv_cache_gb == sequence_gb
+    with pytest.raises(ValueError, match="can't hold one"):
+        plan_resources("tiny", max_kv_cache_gb=sequence_gb * 0.99)
+
+    monkeypatch.setattr(Config, "NUM_WORKERS", 2)  # each worker gets half the pool
+    with pytest.raises(ValueError, match="over 2 worker"):
+        plan_resources("tiny", max_kv_cache_gb=sequence_gb)
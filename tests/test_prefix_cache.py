@@ -0,0 +1,78 @@
+import torch
+from prefix_cache import PrefixCache
+
+def make_past(length: int):
+    return tuple((torch.randn(1, 2, length, 4), torch.randn(1, 2, length, 4)) for _ in range(2))
+
+def test_longest_cached_prefix_is_found():
+    cache = PrefixCache(max_gb=1, block_size=4)
+    past = make_past(8)
+    cache.insert(list(range(8)), past)
+
+    cached_len, cached_past = cache.lookup(list(range(8)) + [99, 100])
+
+    assert cached_len == 8
+    assert torch.equal(cached_past[0][0], past[0][0])
+
+def test_at_least_one_token_is_left_to_prefill():
+    cache = PrefixCache(max_gb=1, block_size=4)
+    cache.insert(list(range(4)), make_past(4))
+    cache.insert(list(range(8)), make_past(8))
+    assert cache.lookup(list(range(8)))[0] == 4
+
+def test_different_prefix_misses():
+    cache = PrefixCache(max_gb=1, block_size=4)
+    cache.insert(list(range(8)), make_past(8))
+    assert cache.lookup([0, 1, 2, 5, 4, 5, 6, 7, 8]) == (0, None)
+
+def test_colliding_key_is_not_served(monkeypatch):
+    cache = PrefixCache(max_gb=1, block_size=4)
+    # force every prompt onto the same key, as a hash collision would
+    monkeypatch.setattr(cache, "_block_hashes", lambda token_ids: [b"collision"] * (len(token_ids) // 4))
+    cache.insert([1, 2, 3, 4, 5], make_past(4))
+    assert cache.lookup([9, 9, 9, 9, 9]) == (0, None)
+    assert cache.lookup([1, 2, 3, 4, 5])[0] == 4
+
+def test_least_recently_used_entries_are_evicted():
+    entry_bytes = 2 * 2 * (1 * 2 * 4 * 4) * 4  # layers * (key, value) * elements * float32
+    cache = PrefixCache(max_gb=2.5 * entry_bytes / (1024 ** 3), block_size=4)
+    cache.insert([1, 1, 1, 1], make_past(4))
+    cache.insert([2, 2, 2, 2], make_past(4))
+    cache.lookup([1, 1, 1, 1, 0])
+    cache.insert([3, 3, 3, 3], make_past(4))
+
+    assert cache.lookup([1, 1, 1, 1, 0])[0] == 4
+    assert cache.lookup([2, 2, 2, 2, 0])[0] == 0
+    assert cache.lookup([3, 3, 3, 3, 0])[0] == 4
+
+def test_shared_leading_blocks_hit_across_different_prompts():
+    cache = PrefixCache(max_gb=1, block_size=4)
+    system_prompt = [7] * 8
+    past = make_past(16)
+    cache.insert(system_prompt + [1] * 8, past)
+
+    cached_len, cached_past = cache.lookup(system_prompt + [2] * 8)
+
+    assert cached_len == 8
+    assert cached_past[0][0].shape[2] == 8
+    assert torch.equal(cached_past[0][0], past[0][0][..., :8, :])
+    assert cache.lookup([7] * 4 + [2] * 8)[0] == 4
+
+def test_prefixes_of_cached_prompts_are_not_stored_again():
+    cache = PrefixCache(max_gb=1, block_size=4)
+    cache.insert(list(range(12)), make_past(12))
+    cache.insert(list(range(8)), make_past(8))
+    assert len(cache.entries) == 1
+    assert len(cache.blocks) == 3
+
+def test_evicting_a_clone_drops_its_block_boundaries():
+    clone_bytes = 2 * 2 * (1 * 2 * 8 * 4) * 4  # layers * (key, value) * elements * float32
+    cache = PrefixCache(max_gb=1.5 * clone_bytes / (1024 ** 3), block_size=4)
+    cache.insert([1] * 8, make_past(8))
+    cache.insert([1] * 4 + [2] * 4, make_past(8))  # shares its first block with the first clone, which is evicted
+
+    assert len(cache.entries) == 1
+    assert cache.used_bytes == clone_bytes
+    assert cache.lookup([1] * 8 + [0])[0] == 4  # still served by the surviving clone
+    assert cache.lookup([1] * 4 + [2] * 4 + [0])[0] == 8
+    assert set(cache.blocks) == set(cache._block_hashes([1] * 4 + [2] * 4))
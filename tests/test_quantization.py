@@ -0,0 +1,49 @@
+import pytest
+import torch
+import torch.nn as nn
+from transformers import LlamaConfig, LlamaForCausalLM
+from quantization import WeightOnlyLinear, quantize_model
+
+@pytest.mark.parametrize("bits, in_features", [(8, 96), (4, 256), (4, 96)])
+def test_weight_only_linear_round_trips_within_half_a_step(bits, in_features):
+    torch.manual_seed(0)
+    linear = nn.Linear(in_features, 48)
+    quantized = WeightOnlyLinear(linear, bits)
+
+    weight = quantized.dequantize()
+    assert weight.shape == linear.weight.shape
+    # rounding to the nearest step is off by at most half a step, each group having its own step
+    steps = quantized.scales.repeat_interleave(quantized.group_size, dim=1)
+    assert ((weight - linear.weight).abs() <= steps / 2 + 1e-6).all()
+    if bits == 4:
+        assert quantized.weight_quantized.shape == (48, in_features // 2)  # two weights per byte
+        assert quantized.group_size == (128 if in_features % 128 == 0 else in_features)
+
+def test_weight_only_linear_matches_nn_linear():
+    torch.manual_seed(0)
+    linear = nn.Linear(64, 32)
+    x = torch.randn(2, 5, 64)
+    for bits in (8, 4):
+        quantized = WeightOnlyLinear(linear, bits)
+        with torch.no_grad():
+            output, expected = quantized(x), linear(x)
+        assert output.shape == expected.shape
+        assert torch.allclose(output, nn.functional.linear(x, quantized.dequantize(), linear.bias), atol=1e-4)
+        # each weight is off by at most half its step, so each output by at most the inputs weighted by those
+        steps = quantized.scales.repeat_interleave(quantized.group_size, dim=1)
+        assert ((output - expected).abs() <= x.abs() @ (steps / 2).T + 1e-4).all()
+
+def tiny_model():
+    config = LlamaConfig(hidden_size=32, intermediate_size=64, num_hidden_layers=1, num_attention_heads=2, vocab_size=50)
+    return LlamaForCausalLM(config).eval()
+
+def test_weight_only_modes_leave_the_output_head_alone():
+    model = quantize_model(tiny_model(), "int4_weight_only")
+    assert isinstance(model.model.layers[0].mlp.up_proj, WeightOnlyLinear)
+    assert isinstance(model.lm_head, nn.Linear)
+
+def test_int8_dynamic_quantizes_in_place():
+    model = tiny_model()
+    assert quantize_model(model, "int8_dynamic") is model
+    assert isinstance(model.model.layers[0].mlp.up_proj, torch.ao.nn.quantized.dynamic.Linear)
+    assert type(model.lm_head) is nn.Linear
@@ -0,0 +1,81 @@
+import os
+from types import SimpleNamespace
+import pytest
+import response_cache
+from response_cache import ResponseCache
+from sampling import SamplingOptions
+
+GREEDY = SamplingOptions(temperature=0)
+
+@pytest.fixture
+def model_dir(tmp_path):
+    directory = tmp_path / "model"
+    directory.mkdir()
+    (directory / "config.json").write_text("{}")
+    (directory / "model.safetensors").write_bytes(b"weights")
+    return directory
+
+def make_cache(model_dir, **kwargs) -> ResponseCache:
+    return ResponseCache(model_name=str(model_dir), draft_model_name="", **{"max_entries": 8, "ttl": 60, "path": "", **kwargs})
+
+def test_key_is_stable_and_covers_the_request(model_dir):
+    cache = make_cache(model_dir)
+    key = cache.key("completion", "Hello", 16, GREEDY, ["\n"])
+    assert key == make_cache(model_dir).key("completion", "Hello", 16, SamplingOptions(temperature=0), ["\n"])
+    assert key != cache.key("completion", "Hello!", 16, GREEDY, ["\n"])
+    assert key != cache.key("completion", "Hello", 17, GREEDY, ["\n"])
+    assert key != cache.key("completion", "Hello", 16, GREEDY, None)
+    assert key != cache.key("completion", "Hello", 16, GREEDY, ["\n"], [2])
+    chat_key = cache.key("chat", [SimpleNamespace(role="user", content="Hello")], 16, GREEDY, ["\n"])
+    assert chat_key is not None and chat_key != key
+
+def test_only_deterministic_requests_are_cached(model_dir):
+    cache = make_cache(model_dir)
+    assert cache.key("completion", "Hello", 16, SamplingOptions(temperature=0.7), None) is None
+    assert cache.key("completion", "Hello", 16, SamplingOptions(temperature=0.7, seed=1), None) is not None
+    assert make_cache(model_dir, max_entries=0).key("completion", "Hello", 16, GREEDY, None) is None
+
+def test_updated_weights_change_the_key(model_dir):
+    key = make_cache(model_dir).key("completion", "Hello", 16, GREEDY, None)
+    (model_dir / "model.safetensors").write_bytes(b"new weights")
+    assert make_cache(model_dir).key("completion", "Hello", 16, GREEDY, None) != key
+
+def test_unversioned_models_never_share_keys_across_loads(monkeypatch):
+    monkeypatch.setattr(response_cache, "model_revision", lambda model_name: None)
+    monkeypatch.setattr(response_cache.time, "time", iter([1.0, 2.0]).__next__)
+    first = ResponseCache(max_entries=8, path="", model_name="hub/model", draft_model_name="")
+    second = ResponseCache(max_entries=8, path="", model_name="hub/model", draft_model_name="")
+    assert first.key("completion", "Hello", 16, GREEDY, None) != second.key("completion", "Hello", 16, GREEDY, None)
+
+def test_entries_expire_after_ttl(model_dir, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(response_cache.time, "time", lambda: now[0])
+    cache = make_cache(model_dir, ttl=10)
+    cache.put("key", ["Hel", "lo"], {"stop_reason": "stop"})
+    now[0] += 9
+    assert cache.get("key") == (["Hel", "lo"], {"stop_reason": "stop"})
+    now[0] += 2
+    assert cache.get("key") is None
+    assert cache.stats() == {"entries": 0, "hits": 1, "misses": 1}
+
+def test_least_recently_used_entries_are_evicted(model_dir):
+    cache = make_cache(model_dir, max_entries=2)
+    cache.put("a", ["a"], {})
+    cache.put("b", ["b"], {})
+    cache.get("a")
+    cache.put("c", ["c"], {})
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+
+def test_sqlite_store_survives_restarts_but_not_weight_updates(model_dir, tmp_path):
+    path = str(tmp_path / "responses.sqlite")
+    cache = make_cache(model_dir, path=path)
+    key = cache.key("completion", "Hello", 16, GREEDY, None)
+    cache.put(key, ["Hi"], {"stop_reason": "stop"})
+
+    restarted = make_cache(model_dir, path=path)
+    assert restarted.get(restarted.key("completion", "Hello", 16, GREEDY, None)) == (["Hi"], {"stop_reason": "stop"})
+
+    os.utime(model_dir / "model.safetensors", ns=(0, 0))  # weights swapped in place
+    reloaded = make_cache(model_dir, path=path)
+    assert reloaded.get(reloaded.key("completion", "Hello", 16, GREEDY, None)) is None
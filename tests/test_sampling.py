@@ -0,0 +1,73 @@
+import torch
+from types import SimpleNamespace
+from sampling import SamplingOptions, probabilities, sample
+
+def make_sequence(seed=None, seen_tokens=None, **options):
+    generator = torch.Generator().manual_seed(seed) if seed is not None else None
+    return SimpleNamespace(sampling=SamplingOptions(**options), generator=generator, seen_tokens=seen_tokens)
+
+def test_greedy_rows_take_the_argmax():
+    logits = torch.tensor([[0.1, 2.0, 0.3], [5.0, 1.0, 0.0]])
+    assert sample(logits, [make_sequence(temperature=0), make_sequence(temperature=0)]) == [1, 0]
+
+def test_mixed_batch_keeps_greedy_rows_greedy():
+    logits = torch.tensor([[0.0, 0.0, 9.0], [0.0, 0.0, 0.0]])
+    for _ in range(20):
+        token, _ = sample(logits.clone(), [make_sequence(temperature=0), make_sequence(temperature=1.0)])
+        assert token == 2
+
+def test_top_k_limits_the_support():
+    logits = torch.tensor([[4.0, 3.0, 2.0, 1.0]])
+    probs = probabilities(logits.clone(), [SamplingOptions(temperature=1.0, top_k=2)])[0]
+    assert probs[2:].eq(0).all()
+    assert torch.allclose(probs[:2], torch.tensor([4.0, 3.0]).softmax(dim=-1))
+
+def test_top_p_keeps_the_smallest_set_covering_p():
+    logits = torch.tensor([[0.5, 0.3, 0.15, 0.05]]).log()
+    probs = probabilities(logits.clone(), [SamplingOptions(temperature=1.0, top_p=0.7)])[0]
+    assert probs.nonzero().flatten().tolist() == [0, 1]
+    assert torch.allclose(probs[:2], torch.tensor([0.625, 0.375]))
+
+def test_top_p_always_keeps_the_top_token():
+    logits = torch.tensor([[0.9, 0.1]]).log()
+    probs = probabilities(logits.clone(), [SamplingOptions(temperature=1.0, top_p=0.01)])[0]
+    assert probs.tolist() == [1.0, 0.0]
+
+def test_min_p_drops_tokens_below_a_fraction_of_the_top_probability():
+    logits = torch.tensor([[0.6, 0.3, 0.1]]).log()
+    probs = probabilities(logits.clone(), [SamplingOptions(temperature=1.0, min_p=0.4)])[0]
+    assert probs[2] == 0
+    assert torch.allclose(probs[:2], torch.tensor([2 / 3, 1 / 3]))
+
+def test_options_apply_per_row():
+    logits = torch.tensor([[4.0, 3.0, 2.0], [4.0, 3.0, 2.0]])
+    probs = probabilities(logits.clone(), [SamplingOptions(temperature=1.0, top_k=1), SamplingOptions(temperature=1.0)])
+    assert probs[0].tolist() == [1.0, 0.0, 0.0]
+    assert probs[1].gt(0).all()
+
+def test_seeded_sequences_are_reproducible():
+    logits = torch.randn(1, 50)
+    first, second = make_sequence(seed=7, temperature=1.0), make_sequence(seed=7, temperature=1.0)
+    assert [sample(logits.clone(), [first])[0] for _ in range(10)] == [sample(logits.clone(), [second])[0] for _ in range(10)]
+
+def test_seeded_row_is_unaffected_by_its_batch():
+    logits = torch.randn(1, 50)
+    alone = make_sequence(seed=3, temperature=1.0)
+    batched = make_sequence(seed=3, temperature=1.0)
+    expected = [sample(logits.clone(), [alone])[0] for _ in range(10)]
+    actual = [sample(torch.cat([torch.randn(1, 50), logits]), [make_sequence(temperature=1.0), batched])[1] for _ in range(10)]
+    assert actual == expected
+
+def test_repetition_penalty_matches_transformers():
+    logits = torch.tensor([[2.0, -2.0, 1.0, 0.5]])
+    seen = torch.tensor([True, True, False, False])
+    sequence = make_sequence(seen_tokens=seen, temperature=0, repetition_penalty=4.0)
+    # 2.0 / 4 = 0.5 and -2.0 * 4 = -8.0, so the unseen 1.0 wins
+    assert sample(logits.clone(), [sequence]) == [2]
+
+def test_sampling_follows_the_distribution():
+    torch.manual_seed(0)
+    logits = torch.tensor([0.5, 0.3, 0.2]).log().repeat(4000, 1)
+    tokens = sample(logits, [make_sequence(temperature=1.0) for _ in range(4000)])
+    frequencies = torch.bincount(torch.tensor(tokens), minlength=3).float() / 4000
+    assert torch.allclose(frequencies, torch.tensor([0.5, 0.3, 0.2]), atol=0.03)
@@ -0,0 +1,71 @@
+import asyncio
+import pytest
+import torch
+from fastapi import HTTPException
+from config import Config
+from kv_cache import BlockAllocator
+from sampling import SamplingOptions
+from scheduler import PADDING_SEQ_ID, Scheduler
+
+class FakeModelManager:
+    def get_eos_token_ids(self):
+        return set()
+
+    def get_device(self):
+        return "cpu"
+
+    def get_draft_model(self):
+        return None
+
+def make_scheduler() -> Scheduler:
+    return Scheduler(FakeModelManager(), BlockAllocator(num_blocks=64, block_size=4), max_batch_size=4)
+
+def add(scheduler: Scheduler, prompt_len: int = 3):
+    return scheduler.add_request({"input_ids": torch.zeros(1, prompt_len, dtype=torch.long)}, 5, SamplingOptions())
+
+async def drain(sequence):
+    return [token async for token in sequence.stream()]
+
+def test_failed_step_fails_its_sequences_and_keeps_the_worker_alive(monkeypatch):
+    monkeypatch.setattr(Config, "WARMUP", False)
+    scheduler = make_scheduler()
+    steps = []
+
+    def failing_step():
+        steps.append(len(scheduler.waiting))
+        # admit the waiting sequence and fail halfway through, like a merge running out of memory
+        sequence = scheduler.waiting.popleft()
+        scheduler.block_allocator.allocate(sequence.seq_id, 8)
+        scheduler.block_allocator.resize(PADDING_SEQ_ID, 8)
+        scheduler.admitting.append(sequence)
+        raise RuntimeError("out of memory")
+    scheduler.step = failing_step
+
+    async def run():
+        scheduler.start()
+        try:
+            for _ in range(2):
+                with pytest.raises(RuntimeError, match="out of memory"):
+                    await asyncio.wait_for(drain(add(scheduler)), timeout=5)
+        finally:
+            scheduler.stop()
+
+    asyncio.run(run())
+    assert steps == [1, 1]  # the second request was still picked up after the first step failed
+    assert scheduler.block_allocator.used_blocks() == 0
+    assert scheduler.admitting == [] and scheduler.running == []
+
+def test_shutdown_finishes_waiting_sequences():
+    scheduler = make_scheduler()
+
+    async def run():
+        sequences = [add(scheduler) for _ in range(3)]
+        scheduler._stopped = True
+        scheduler._run()
+        for sequence in sequences:
+            with pytest.raises(HTTPException) as error:
+                await asyncio.wait_for(drain(sequence), timeout=5)
+            assert error.value.status_code == 503
+
+    asyncio.run(run())
+    assert not scheduler.waiting
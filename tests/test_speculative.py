@@ -0,0 +1,43 @@
+import torch
+from speculative import accept_proposals
+
+def test_proposals_the_target_agrees_with_are_all_accepted():
+    q = torch.tensor([0.0, 1.0, 0.0])
+    p = torch.tensor([[0.0, 1.0, 0.0], [0.0, 1.0, 0.0], [1.0, 0.0, 0.0]])
+    assert accept_proposals([1, 1], [q, q], p, torch.Generator().manual_seed(0)) == [1, 1, 0]
+
+def test_a_proposal_the_target_rules_out_is_rejected_and_resampled():
+    q = torch.tensor([0.0, 1.0, 0.0])
+    p = torch.tensor([[0.0, 0.0, 1.0], [1.0, 0.0, 0.0]])
+    for seed in range(10):
+        assert accept_proposals([1], [q], p, torch.Generator().manual_seed(seed)) == [2]
+
+def test_generation_stops_at_the_first_rejection():
+    q = torch.tensor([0.5, 0.5])
+    p = torch.tensor([[1.0, 0.0], [0.0, 1.0], [0.0, 1.0]])
+    for seed in range(10):
+        tokens = accept_proposals([1, 1], [q, q], p, torch.Generator().manual_seed(seed))
+        assert tokens == [0]
+
+def test_accepted_tokens_follow_the_target_distribution():
+    # whatever the draft proposes, the first token out must be distributed like the target's first row
+    generator = torch.Generator().manual_seed(0)
+    q = torch.tensor([0.6, 0.3, 0.1])
+    p = torch.tensor([[0.1, 0.3, 0.6], [1 / 3, 1 / 3, 1 / 3]])
+    counts = torch.zeros(3)
+    trials = 20000
+    for _ in range(trials):
+        proposal = torch.multinomial(q, num_samples=1, generator=generator).item()
+        counts[accept_proposals([proposal], [q], p, generator)[0]] += 1
+    assert torch.allclose(counts / trials, p[0], atol=0.015)
+
+def test_acceptance_rate_is_the_overlap_of_the_distributions():
+    generator = torch.Generator().manual_seed(1)
+    q = torch.tensor([0.6, 0.3, 0.1])
+    p = torch.tensor([[0.1, 0.3, 0.6], [1.0, 0.0, 0.0]])
+    trials, accepted = 20000, 0
+    for _ in range(trials):
+        proposal = torch.multinomial(q, num_samples=1, generator=generator).item()
+        accepted += len(accept_proposals([proposal], [q], p, generator)) - 1
+    # sum(min(p, q)) = 0.1 + 0.3 + 0.1
+    assert abs(accepted / trials - 0.5) < 0.015
@@ -0,0 +1,105 @@
+import asyncio
+from enum import Enum
+from typing import Optional
+import pytest
+from pydantic import BaseModel
+from streaming import StreamEncoder, coalesce
+from utils import serialize
+
+class EventType(Enum):
+    progress = "progress"
+
+class Event(BaseModel):
+    event_type: EventType
+    delta: str
+    logprobs: Optional[list] = None
+
+class ChatChunk(BaseModel):
+    event: Event
+
+class Chunk(BaseModel):
+    delta: str
+    stop_reason: Optional[str] = None
+
+TRICKY_DELTAS = [
+    "",
+    "plain",
+    'say "hi"',
+    "back\\slash \\n not a newline",
+    "\n\r\t\b\f",
+    "\x00\x01\x1f\x7f",
+    "héllo wörld",
+    "日本語",
+    "emoji 😀 needs a surrogate pair",
+    "  ",
+    "\ud800 lone surrogate",
+    "__stream_delta__",
+    "</script>{\"delta\": 1}"
+]
+
+@pytest.mark.parametrize("stream_format, start, end", [("ndjson", b"", b"\n"), ("sse", b"data: ", b"\n\n")])
+@pytest.mark.parametrize("make_chunk", [
+    lambda delta: Chunk(delta=delta),
+    lambda delta: ChatChunk(event={"event_type": "progress", "delta": delta})
+])
+def test_encode_matches_serialize_byte_for_byte(stream_format, start, end, make_chunk):
+    encoder = StreamEncoder(make_chunk, stream_format)
+    for delta in TRICKY_DELTAS:
+        assert encoder.encode(delta) == start + serialize(make_chunk(delta)).encode("utf-8") + end
+
+def test_encode_chunk_wraps_a_whole_chunk():
+    encoder = StreamEncoder(lambda delta: Chunk(delta=delta), "sse")
+    chunk = Chunk(delta="", stop_reason="end_of_turn")
+    assert encoder.encode_chunk(chunk) == b"data: " + serialize(chunk).encode("utf-8") + b"\n\n"
+
+def test_unknown_format_is_rejected():
+    with pytest.raises(ValueError):
+        StreamEncoder(lambda delta: Chunk(delta=delta), "xml")
+
+async def tokens(items, delay: float = 0, error: Optional[Exception] = None, closed: Optional[list] = None):
+    try:
+        for item in items:
+            await asyncio.sleep(delay)
+            yield item
+        if error is not None:
+            raise error
+    finally:
+        if closed is not None:
+            closed.append(True)
+
+def test_fast_reader_gets_every_token_on_its_own():
+    async def run():
+        return [text async for text in coalesce(tokens(["a", "b", "c"], delay=0.01))]
+    assert asyncio.run(run()) == ["a", "b", "c"]
+
+def test_slow_reader_gets_what_piled_up_in_one_item():
+    async def run():
+        received = []
+        async for text in coalesce(tokens([str(index) for index in range(10)], delay=0.001)):
+            received.append(text)
+            await asyncio.sleep(0.05)  # a slow client
+        return received
+    received = asyncio.run(run())
+    assert "".join(received) == "0123456789"
+    assert received[0] == "0"
+    assert len(received) < 10
+
+def test_error_is_raised_after_the_text_before_it():
+    async def run():
+        received = []
+        with pytest.raises(RuntimeError, match="boom"):
+            async for text in coalesce(tokens(["a", "b"], error=RuntimeError("boom"))):
+                received.append(text)
+        return received
+    assert "".join(asyncio.run(run())) == "ab"
+
+def test_closing_early_stops_the_producer():
+    closed = []
+
+    async def run():
+        stream = coalesce(tokens(["a"] * 100, delay=0.01, closed=closed))
+        assert await stream.__anext__() == "a"
+        await stream.aclose()
+        await asyncio.sleep(0.05)
+    asyncio.run(run())
+    assert closed == [True]
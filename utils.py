@@ -1,73 +1,189 @@
 import torch
 import psutil
-from transformers import AutoModelForCausalLM
 import shutil
-from huggingface_hub import model_info, login
+from huggingface_hub import get_safetensors_metadata, snapshot_download
 from config import Config
+import glob
+import hashlib
 import json
+import math
+import os
+import struct
+from typing import Optional
 from enum import Enum
 from pydantic import BaseModel
 
+class EnumEncoder(json.JSONEncoder):
+    """
+    JSON encoder that writes Enums as their values, so pydantic model dumps serialize without error.
+    """
+    def default(self, obj):
+        if isinstance(obj, Enum):
+            return obj.value
+        return super().default(obj)
+
 def serialize(request: BaseModel) -> str:
     """
     Turns a pydantic model (request param) into serialized JSON string format.
-    Uses the EnumEncoder class to get the value of the Enum so we can model dump without error.
     """
-    class EnumEncoder(json.JSONEncoder):
-        def default(self, obj):
-            if isinstance(obj, Enum):
-                return obj.value
-            return super().default(obj)
     return json.dumps(request.model_dump(), cls=EnumEncoder)
 
-def estimate_model_size(model_name) -> int:
+# bytes per element for each dtype that can appear in a safetensors header
+SAFETENSORS_DTYPE_BYTES = {
+    "F64": 8, "I64": 8, "U64": 8,
+    "F32": 4, "I32": 4, "U32": 4,
+    "F16": 2, "BF16": 2, "I16": 2, "U16": 2,
+    "F8_E4M3": 1, "F8_E5M2": 1, "I8": 1, "U8": 1, "BOOL": 1
+}
+
+def read_safetensors_header(path: str) -> dict:
+    """
+    Reads the tensor index at the start of a safetensors file (an 8 byte length, then a JSON header) without touching the weights.
     """
-    Estimates the model size with the model's name, considering different precisions.
-    Uses the model's configuration file to get the number of parameters.
-    """    
-    if Config.HUGGINGFACE_ACCESS_TOKEN:
-        login(token=Config.HUGGINGFACE_ACCESS_TOKEN)
+    with open(path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    header.pop("__metadata__", None)
+    return header
 
+def get_safetensors_tensors(model_name) -> dict:
+    """
+    Returns every tensor's dtype, shape and data_offsets from the model's safetensors headers.
+    Reads local files when the model is a local directory or already in the Huggingface cache, otherwise fetches just
+    the headers from the hub.
+    """
+    token = Config.HUGGINGFACE_ACCESS_TOKEN or None
+    directory = find_local_snapshot(model_name)
+    if directory is None and Config.OFFLINE_MODE:
+        raise FileNotFoundError(f"{model_name} is not in the local Huggingface cache and OFFLINE_MODE is on.")
+
+    if directory is not None:
+        tensors = {}
+        for path in glob.glob(os.path.join(directory, "*.safetensors")):
+            tensors.update(read_safetensors_header(path))
+        if tensors:
+            return tensors
+
+    metadata = get_safetensors_metadata(model_name, token=token)
+    return {
+        name: {"dtype": info.dtype, "shape": info.shape, "data_offsets": info.data_offsets}
+        for file_metadata in metadata.files_metadata.values()
+        for name, info in file_metadata.tensors.items()
+    }
+
+def get_config_tensors(model_name) -> dict:
+    """
+    Estimates the tensor index from the model's config alone, for checkpoints without safetensors headers to read (e.g.
+    .bin-only ones). The model is built on the meta device, so nothing is allocated. Shapes are exact, and every tensor
+    is given the config's torch_dtype.
+    """
+    from accelerate import init_empty_weights
+    from transformers import AutoConfig, AutoModelForCausalLM
+    config = AutoConfig.from_pretrained(model_name, token=Config.HUGGINGFACE_ACCESS_TOKEN or None, local_files_only=Config.OFFLINE_MODE)
+    with init_empty_weights():
+        model = AutoModelForCausalLM.from_config(config)
+    dtype = getattr(config, "torch_dtype", None)
+    dtype = getattr(torch, dtype) if isinstance(dtype, str) else dtype
+    code = {torch.float16: "F16", torch.bfloat16: "BF16"}.get(dtype, "F32")
+    return {name: {"dtype": code, "shape": list(parameter.shape)} for name, parameter in model.named_parameters()}
+
+def get_weight_tensors(model_name) -> dict:
+    """
+    Returns the model's tensor index from its safetensors headers, or estimated from its config when the headers can't
+    be read. Raises a ValueError when neither works, since sizing a model as 0 GB would let everything else overcommit.
+    """
+    try:
+        return get_safetensors_tensors(model_name)
+    except Exception as e:
+        print(f"Could not read the safetensors headers of {model_name} ({e}), estimating its size from its config instead")
     try:
-        info = model_info(model_name)
-        tensor_params = info.safetensors.parameters
-        total_bytes = 0
-        for key, value in tensor_params.items():
-            if '32' in key:
-                total_bytes += value * 4  # 32-bit float
-            elif '16' in key:
-                total_bytes += value * 2  # 16-bit float
-            elif '8' in key:
-                total_bytes += value  # 8-bit integer
-            elif '4' in key:
-                total_bytes += value / 2  # 4-bit integer
-            else:
-                total_bytes += value * 4  # default to 32-bit float if precision is not specified
-        estimated_size_gb = total_bytes / (1024 ** 3)
-        return estimated_size_gb
+        return get_config_tensors(model_name)
     except Exception as e:
-        print(f"Error estimating model size: {str(e)}. Continuing naively...")
-        return 0
+        raise ValueError(f"Could not size {model_name} from its safetensors headers or its config: {e}")
 
-def calculate_model_size(model) -> float:
+def find_local_snapshot(model_name) -> Optional[str]:
     """
-    Calculates the size of the model, in GB, counting param by param.
+    Returns the directory holding the model's safetensors files, if it is a local directory or already in the
+    Huggingface cache, without touching the network.
     """
-    total_size = 0
-    for param in model.parameters():
-        if param.dtype == torch.float32:
-            bits = 32
-        elif param.dtype == torch.float16 or param.dtype == torch.bfloat16:
-            bits = 16
-        elif param.dtype == torch.int8:
-            bits = 8
-        elif param.dtype == torch.int4:
-            bits = 4
+    if os.path.isdir(model_name):
+        return model_name
+    try:
+        directory = snapshot_download(model_name, allow_patterns=["*.safetensors"], local_files_only=True, token=Config.HUGGINGFACE_ACCESS_TOKEN or None)
+    except Exception:
+        return None
+    return directory if glob.glob(os.path.join(directory, "*.safetensors")) else None
+
+def model_revision(model_name) -> Optional[str]:
+    """
+    Identifies the weights a model name resolves to right now, without reading them: a digest of the resolved local
+    directory (a hub snapshot is named after its commit) and the name, size and modification time of every file in it,
+    so weights updated in place count as a new revision too. Returns None if the model isn't available locally.
+    """
+    directory = model_name if os.path.isdir(model_name) else None
+    if directory is None:
+        try:
+            directory = snapshot_download(model_name, local_files_only=True, token=Config.HUGGINGFACE_ACCESS_TOKEN or None)
+        except Exception:
+            return None
+    digest = hashlib.sha256(os.path.realpath(directory).encode("utf-8"))
+    for path in sorted(glob.glob(os.path.join(directory, "**", "*"), recursive=True)):
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            digest.update(f"{os.path.relpath(path, directory)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+def estimate_model_size(model_name, dtype: Optional[torch.dtype] = None, linear_bits: Optional[int] = None) -> float:
+    """
+    Sizes the model, in GB, from its safetensors headers (or its config, see get_weight_tensors) alone, without
+    downloading or materializing any weights.
+    Without a dtype this is the checkpoint's size on disk. With one, floating point tensors are counted at that dtype's
+    size, which is what they take in memory once loaded.
+    With linear_bits, 2D weight matrices (other than embeddings and the output head) are counted at that many bits, to
+    size a quantized model.
+    """
+    return count_weight_bytes(get_weight_tensors(model_name), dtype, linear_bits) / (1024 ** 3)
+
+def count_weight_bytes(tensors: dict, dtype: Optional[torch.dtype] = None, linear_bits: Optional[int] = None) -> int:
+    """
+    Adds up the bytes of the tensors in a safetensors index, counted as estimate_model_size describes.
+    """
+    total_bytes = 0
+    for name, info in tensors.items():
+        numel = math.prod(info["shape"])
+        if linear_bits is not None and _is_quantizable_weight(name, info):
+            total_bytes += numel * linear_bits / 8
+        elif dtype is not None and info["dtype"].startswith(("F", "BF")):
+            total_bytes += numel * torch.tensor([], dtype=dtype).element_size()
         else:
-            print("dtype not detected. Falling back to full precision...")
-            bits = 32
+            total_bytes += numel * SAFETENSORS_DTYPE_BYTES.get(info["dtype"], 4)
+    return int(total_bytes)
 
-        total_size += param.numel() * (bits / 8)
+def _is_quantizable_weight(name: str, info: dict) -> bool:
+    """
+    Guesses from a tensor's name and shape whether quantization would turn it into int8/int4 (Linear weights do,
+    embeddings and the output head don't).
+    """
+    return (
+        len(info["shape"]) == 2
+        and name.endswith(".weight")
+        and not any(part in name for part in ("embed", "lm_head", "wte", "wpe"))
+    )
+
+def calculate_model_size(model) -> float:
+    """
+    Calculates the size of the model, in GB, counting tensor by tensor.
+    Goes through the state dict rather than the parameters, so quantized weights (stored as buffers or packed params)
+    are counted too, and counts tensors shared between layers (like tied embeddings) once.
+    """
+    total_size = 0
+    seen = set()
+    for value in model.state_dict().values():
+        for tensor in (value if isinstance(value, tuple) else (value,)):
+            if not isinstance(tensor, torch.Tensor) or tensor.data_ptr() in seen:
+                continue
+            seen.add(tensor.data_ptr())
+            total_size += tensor.numel() * tensor.element_size()
     
     return total_size / (1024 ** 3)
 
@@ -87,75 +203,13 @@ def get_available_memory():
     """
     return psutil.virtual_memory().available / (1024 ** 3)
 
-def get_available_disk_space():
-    """
-    Returns available disk space in GB.
-    """
-    _, _, free = shutil.disk_usage("/")
-    return free // (2**30)
-
-def check_system_resources(model_name):
+def get_available_disk_space(path: str = "/") -> float:
     """
-    Checks the model size against system parameters, with or without GPU, and disk space.
-    Actually calculates the size of the model after the estimate check by looping through each downloaded parameter.
-    Raises an error if the model won't fit in memory or if there's not enough disk space.
+    Returns available disk space in GB on the filesystem holding path (or its closest existing parent, for a cache
+    directory that doesn't exist yet).
     """
-    print("\n" + "=" * 50)
-    print(f"System Resource Check for Model: {model_name}")
-    print("=" * 50)
-
-    estimated_size = estimate_model_size(model_name)  # estimate the model's size before actually downloading it
-    available_disk_space = get_available_disk_space()
-    available_vram = get_available_vram()
-    available_memory = get_available_memory()
-
-    if estimated_size > available_disk_space:
-        raise ValueError(f"Estimated model size ({estimated_size:.2f} GB) exceeds available disk space ({available_disk_space:.2f} GB). Refusing to download model.")
-    
-    if available_vram > 0 and estimated_size > available_vram:
-        raise ValueError(f"Estimated model size ({estimated_size:.2f} GB) exceeds available GPU memory ({available_vram:.2f} GB). Refusing to download model.")
-    elif available_vram == 0 and estimated_size > available_memory:
-        raise ValueError(f"Estimated model size ({estimated_size:.2f} GB) exceeds available system memory ({available_memory:.2f} GB). Refusing to download model.")
-    
-    print("System requirements estimate check passed. Proceeding to ensure model feasibility...")
-
-    model = AutoModelForCausalLM.from_pretrained(model_name)
-    model_size = calculate_model_size(model)
-    
-    del model
-    torch.cuda.empty_cache()
-
-    print(f"Actual model size: {model_size:.2f} GB")
-
-    if available_vram > 0:
-        print("\nGPU Information:")
-        print(f"  - Available GPU memory: {available_vram:.2f} GB")
-        
-        if model_size > available_vram:
-            raise ValueError(f"The model size ({model_size:.2f} GB) exceeds available GPU memory ({available_vram:.2f} GB).")
-        else:
-            print("  - The model should fit in GPU memory.")
-    else:
-        print("\nCPU Information:")
-        print("  - CUDA is not available. Using CPU.")
-        print(f"  - Available system memory: {available_memory:.2f} GB")
-        
-        if model_size > available_memory:
-            raise ValueError(f"The model size ({model_size:.2f} GB) exceeds available system memory ({available_memory:.2f} GB).")
-        else:
-            print("  - The model should fit in system memory.")
-
-    print("\nMemory Requirement:")
-    print(f"  - Required: {model_size:.2f} GB")
-    print(f"  - Available: {max(available_vram, available_memory):.2f} GB")
-
-    print("\nDisk Space:")
-    print(f"  - Available: {available_disk_space:.2f} GB")
-    print(f"  - Required: {model_size:.2f} GB")
-
-    if available_disk_space < model_size:
-        raise ValueError(f"Not enough disk space to store the model. Required: {model_size:.2f} GB, Available: {available_disk_space:.2f} GB")
-    else:
-        print("  - Sufficient disk space available.")
-
-    print("=" * 50 + "\n")
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    _, _, free = shutil.disk_usage(path)
+    return free / (1024 ** 3)
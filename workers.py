@@ -0,0 +1,252 @@
+import asyncio
+import itertools
+import multiprocessing
+import os
+import threading
+import torch
+from fastapi import HTTPException
+from typing import AsyncGenerator, List, Optional
+from config import Config
+from kv_cache import BlockAllocator
+from metrics import Trace
+from model import ModelManager
+from sampling import SamplingOptions
+from scheduler import GenerationResult, Scheduler
+
+STATS_INTERVAL = 1  # seconds between each worker's stats reports
+
+def split_cores(num_workers: int) -> List[List[int]]:
+    """
+    Splits the cores this process may run on into num_workers disjoint, contiguous sets (neighbouring core IDs usually
+    share a socket and cache). With fewer cores than workers, workers share cores round robin.
+    """
+    cores = sorted(os.sched_getaffinity(0))
+    if len(cores) < num_workers:
+        print(f"Only {len(cores)} cores for {num_workers} workers, some workers will share cores")
+        return [[cores[index % len(cores)]] for index in range(num_workers)]
+    size, extra = divmod(len(cores), num_workers)
+    core_sets = []
+    start = 0
+    for index in range(num_workers):
+        end = start + size + (1 if index < extra else 0)
+        core_sets.append(cores[start:end])
+        start = end
+    return core_sets
+
+class RemoteSequence:
+    """
+    The front end's handle on a request running in a worker process. Mirrors Sequence.stream().
+    """
+    def __init__(self, pool: "WorkerPool", worker: int, request_id: int, trace: Optional[Trace], result: Optional[GenerationResult]):
+        self.pool = pool
+        self.worker = worker
+        self.request_id = request_id
+        self.trace = trace
+        self.result = result if result is not None else GenerationResult()
+        self.finished = False
+        self.loop = asyncio.get_running_loop()
+        self.outputs: asyncio.Queue = asyncio.Queue()
+
+    async def stream(self) -> AsyncGenerator[str, None]:
+        try:
+            while True:
+                kind, payload = await self.outputs.get()
+                if kind == "delta":
+                    yield payload
+                    continue
+                self.finished = True
+                if self.trace is not None:
+                    self.trace.finish()
+                if kind == "error":
+                    status_code, detail, headers = payload
+                    raise HTTPException(status_code=status_code, detail=detail, headers=headers)
+                if payload is not None:
+                    vars(self.result).update(payload)
+                return
+        finally:
+            if not self.finished:
+                self.pool.cancel(self)
+
+class WorkerPool:
+    """
+    Serves requests from num_workers inference processes, each pinned to its own set of cores and running its own
+    scheduler. Stands in for the Scheduler in InputProcessor, so tokenization, chat templating and image loading stay in
+    the front end process and only the model inputs are sent to a worker.
+
+    The model is loaded once, in the front end, and the workers are forked from it, so they all read the same copy of the
+    weights (the pages are shared copy-on-write and never written to). Each worker warms up after forking and sizes
+    its threads to its cores. New requests go to the worker with the fewest requests in flight.
+    """
+    def __init__(
+        self,
+        model_manager: ModelManager,
+        kv_cache_gb: float,
+        num_workers: int = Config.NUM_WORKERS,
+        max_batch_size: int = Config.MAX_BATCH_SIZE,
+        max_queue_depth: int = Config.MAX_QUEUE_DEPTH,
+        max_context_len: int = 0
+    ):
+        if model_manager.get_device().type != "cpu":
+            raise ValueError("Multiple workers are only supported on CPU, set NUM_WORKERS to 1 on GPU.")
+        self.model_manager = model_manager
+        self.kv_cache_gb = kv_cache_gb / num_workers
+        self.num_workers = num_workers
+        self.max_batch_size = max_batch_size * num_workers  # what the whole pool decodes at once
+        self.max_requests_per_worker = max_batch_size + max_queue_depth
+        self.max_context_len = max_context_len
+        self.context = multiprocessing.get_context("fork")
+        self.request_queues = []
+        self.result_queue = None
+        self.processes = []
+        self.in_flight = [0] * num_workers
+        self.sequences = {}  # request ID -> RemoteSequence
+        self.worker_stats = [{} for _ in range(num_workers)]
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._reader: Optional[threading.Thread] = None
+
+    def start(self):
+        # workers only decode, so the fast tokenizer's thread pool isn't worth the fork warning
+        os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+        self.result_queue = self.context.Queue()
+        for index, cores in enumerate(split_cores(self.num_workers)):
+            request_queue = self.context.Queue()
+            process = self.context.Process(
+                target=_worker_main,
+                args=(index, cores, self.model_manager, self.kv_cache_gb, self.max_context_len, request_queue, self.result_queue),
+                name=f"inference-worker-{index}",
+                daemon=True
+            )
+            process.start()
+            self.request_queues.append(request_queue)
+            self.processes.append(process)
+        self._reader = threading.Thread(target=self._read_results, name="worker-results", daemon=True)
+        self._reader.start()
+
+    def stop(self):
+        for request_queue in self.request_queues:
+            request_queue.put(("stop",))
+        for process in self.processes:
+            process.join(timeout=10)
+        self.result_queue.put((None, "stop", None))
+        self._reader.join()
+        self.request_queues = []
+        self.processes = []
+
+    def add_request(
+        self,
+        model_inputs: dict,
+        max_tokens: int,
+        sampling: SamplingOptions,
+        stop: Optional[List[str]] = None,
+        stop_token_ids: Optional[List[int]] = None,
+        trace: Optional[Trace] = None,
+        result: Optional[GenerationResult] = None
+    ) -> RemoteSequence:
+        """
+        Sends the request to the least loaded worker. Raises a 503 when every worker is saturated.
+        """
+        with self._lock:
+            worker = min(range(self.num_workers), key=lambda index: self.in_flight[index])
+            if self.in_flight[worker] >= self.max_requests_per_worker:
+                raise HTTPException(status_code=503, detail="Server is overloaded, please retry later.", headers={"Retry-After": "1"})
+            sequence = RemoteSequence(self, worker, next(self._ids), trace, result)
+            self.sequences[sequence.request_id] = sequence
+            self.in_flight[worker] += 1
+        self.request_queues[worker].put(("generate", sequence.request_id, model_inputs, max_tokens, sampling, stop, stop_token_ids))
+        return sequence
+
+    def cancel(self, sequence: RemoteSequence):
+        self.request_queues[sequence.worker].put(("cancel", sequence.request_id))
+
+    def stats(self) -> dict:
+        """
+        Sums up the workers' latest reports, alongside each worker's own.
+        """
+        return {
+            "waiting": sum(stats.get("waiting", 0) for stats in self.worker_stats),
+            "running": sum(stats.get("running", 0) for stats in self.worker_stats),
+            "kv_cache_blocks_used": sum(stats.get("kv_cache_blocks_used", 0) for stats in self.worker_stats),
+            "kv_cache_blocks_total": sum(stats.get("kv_cache_blocks_total", 0) for stats in self.worker_stats),
+            "in_flight": list(self.in_flight),
+            "workers": self.worker_stats
+        }
+
+    def _read_results(self):
+        """
+        Front end thread that hands every message coming back from the workers to the request it belongs to.
+        """
+        while True:
+            request_id, kind, payload = self.result_queue.get()
+            if kind == "stop":
+                return
+            if kind == "stats":
+                index, stats = payload
+                self.worker_stats[index] = stats
+                continue
+            with self._lock:
+                sequence = self.sequences.get(request_id)
+                if sequence is not None and kind != "delta":
+                    del self.sequences[request_id]
+                    self.in_flight[sequence.worker] -= 1
+            if sequence is not None:
+                sequence.loop.call_soon_threadsafe(sequence.outputs.put_nowait, (kind, payload))
+
+def _worker_main(index: int, cores: List[int], model_manager: ModelManager, kv_cache_gb: float, max_context_len: int, request_queue, result_queue):
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    print(f"Worker {index} (pid {os.getpid()}) running on cores {cores}")
+    block_allocator = BlockAllocator.from_memory(kv_cache_gb, model_manager.get_model(), Config.KV_CACHE_BLOCK_SIZE)
+    print(f"Worker {index} KV cache pool: {block_allocator.num_blocks} blocks of {block_allocator.block_size} tokens ({kv_cache_gb:.2f} GB)")
+    scheduler = Scheduler(model_manager, block_allocator, max_context_len=max_context_len)
+    asyncio.run(_serve(index, scheduler, request_queue, result_queue))
+
+async def _serve(index: int, scheduler: Scheduler, request_queue, result_queue):
+    """
+    A worker's event loop: takes requests from the front end, runs them on its own scheduler and streams the text back.
+    """
+    loop = asyncio.get_running_loop()
+    scheduler.start()
+    tasks = {}
+
+    async def generate(
+        request_id: int,
+        model_inputs: dict,
+        max_tokens: int,
+        sampling: SamplingOptions,
+        stop: Optional[List[str]],
+        stop_token_ids: Optional[List[int]]
+    ):
+        try:
+            sequence = scheduler.add_request(model_inputs, max_tokens, sampling, stop, stop_token_ids)
+            async for delta in sequence.stream():
+                result_queue.put((request_id, "delta", delta))
+            result_queue.put((request_id, "done", vars(sequence.result)))
+        except HTTPException as e:
+            result_queue.put((request_id, "error", (e.status_code, e.detail, e.headers)))
+        except asyncio.CancelledError:
+            result_queue.put((request_id, "done", None))  # the front end stopped listening, it only needs the slot back
+        except Exception as e:
+            result_queue.put((request_id, "error", (500, f"{type(e).__name__}: {e}", None)))
+        finally:
+            tasks.pop(request_id, None)
+
+    async def report_stats():
+        while True:
+            result_queue.put((None, "stats", (index, scheduler.stats())))
+            await asyncio.sleep(STATS_INTERVAL)
+
+    reporter = asyncio.create_task(report_stats())
+    while True:
+        message = await loop.run_in_executor(None, request_queue.get)
+        if message[0] == "stop":
+            break
+        if message[0] == "generate":
+            tasks[message[1]] = asyncio.create_task(generate(*message[1:]))
+        elif message[0] == "cancel" and message[1] in tasks:
+            tasks[message[1]].cancel()
+
+    reporter.cancel()
+    for task in list(tasks.values()):
+        task.cancel()
+    scheduler.stop()